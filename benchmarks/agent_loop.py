@@ -0,0 +1,481 @@
+"""
+固定のサンプルissueについて、エージェントのループ全体を実行して時間の内訳を測る。
+モデルの応答は台本どおりの記録をリプレイサーバーから返し、Forgejoはスタブのサーバー、
+リポジトリは使い捨てのgitリポジトリを使うので、APIを呼ばずに毎回同じ結果になる
+
+    python -m benchmarks.agent_loop --repeat 3
+    python -m benchmarks.agent_loop --json > bench.json  # コミット間の比較用
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import cassette
+import forgejo
+import tracing
+from main import IMAGE_BUILD_INPUTS
+
+base_dir = Path(__file__).parent.parent
+MODEL = "gpt-4o-2024-11-20"
+OWNER = "bench"
+
+
+def tool_call(index: int, tool: str, /, **arguments) -> dict:
+    return {
+        "id": f"call_{index}_{tool}",
+        "type": "function",
+        "function": {"name": tool, "arguments": json.dumps(arguments)},
+    }
+
+
+def sample_calc(origin: str) -> dict:
+    repository = f"{OWNER}/calc"
+    return {
+        "name": "calc",
+        "repository": repository,
+        "files": {
+            "calc.py": "def add(a, b):\n    return a - b\n",
+            "test_calc.py": (
+                "import unittest\n\nfrom calc import add\n\n\n"
+                "class TestAdd(unittest.TestCase):\n"
+                "    def test_add(self):\n"
+                "        self.assertEqual(add(1, 2), 3)\n"
+            ),
+        },
+        "issue": {"title": "add returns the wrong value", "body": "add(1, 2) != 3"},
+        "turns": [
+            [
+                tool_call(1, "read_file", file_path="calc/calc.py"),
+                tool_call(1, "search_code", root="calc", query="add("),
+            ],
+            [
+                tool_call(
+                    2,
+                    "apply_patch",
+                    cwd="calc",
+                    patch=(
+                        "--- a/calc.py\n+++ b/calc.py\n@@ -1,2 +1,2 @@\n"
+                        " def add(a, b):\n-    return a - b\n+    return a + b\n"
+                    ),
+                )
+            ],
+            [tool_call(3, "execute_command", command="python -m unittest", cwd="calc")],
+            [
+                tool_call(
+                    4,
+                    "execute_command",
+                    command="git checkout -q -b fix-add && git commit -q -am '[AI] fix: add'",
+                    cwd="calc",
+                )
+            ],
+            [
+                tool_call(
+                    5,
+                    "create_pull_request",
+                    repository_type="forgejo",
+                    origin=origin,
+                    repository_name=repository,
+                    branch_name="fix-add",
+                    title="[AI] fix: add",
+                    body="Fixes #1",
+                )
+            ],
+        ],
+    }
+
+
+def sample_greet(origin: str) -> dict:
+    repository = f"{OWNER}/greet"
+    files = {
+        f"greet/module_{i}.py": f"def helper_{i}():\n    return {i}\n"
+        for i in range(50)
+    }
+    files["greet/__init__.py"] = ""
+    files["greet/core.py"] = "def greet():\n    return 'hello'\n"
+    files["test_greet.py"] = (
+        "import unittest\n\nfrom greet.core import greet\n\n\n"
+        "class TestGreet(unittest.TestCase):\n"
+        "    def test_greet(self):\n"
+        "        self.assertEqual(greet('bob'), 'hello bob')\n"
+    )
+    return {
+        "name": "greet",
+        "repository": repository,
+        "files": files,
+        "issue": {"title": "greet should take a name", "body": "greet('bob')"},
+        "turns": [
+            [
+                tool_call(1, "find_symbol", root="greet", name="greet"),
+                tool_call(
+                    1, "execute_command", command="git log --oneline", cwd="greet"
+                ),
+                tool_call(1, "read_file", file_path="greet/test_greet.py"),
+            ],
+            [
+                tool_call(
+                    2,
+                    "apply_patch",
+                    cwd="greet",
+                    patch=(
+                        "--- a/greet/core.py\n+++ b/greet/core.py\n@@ -1,2 +1,2 @@\n"
+                        "-def greet():\n-    return 'hello'\n"
+                        "+def greet(name):\n+    return f'hello {name}'\n"
+                    ),
+                )
+            ],
+            [
+                tool_call(
+                    3, "execute_command", command="python -m unittest", cwd="greet"
+                )
+            ],
+            [
+                tool_call(
+                    4,
+                    "execute_command",
+                    command="git checkout -q -b greet-name && git commit -q -am '[AI] feat: name'",
+                    cwd="greet",
+                )
+            ],
+            [
+                tool_call(
+                    5,
+                    "create_pull_request",
+                    repository_type="forgejo",
+                    origin=origin,
+                    repository_name=repository,
+                    branch_name="greet-name",
+                    title="[AI] feat: greet takes a name",
+                    body="Fixes #1",
+                )
+            ],
+        ],
+    }
+
+
+SAMPLES = [sample_calc, sample_greet]
+
+
+def script_cassette(turns: list[list[dict]], model_latency: float) -> list[dict]:
+    """
+    台本のtool callを順に返し、最後に終了のメッセージを返すカセットを作る
+    """
+    messages = [
+        {"role": "assistant", "content": None, "tool_calls": calls} for calls in turns
+    ]
+    messages.append({"role": "assistant", "content": "作業が完了しました"})
+    entries = []
+    for index, message in enumerate(messages):
+        entries.append(
+            {
+                # 台本なのでリクエストとは照合せず、順番に返す
+                "key": "",
+                "latency_seconds": model_latency,
+                "response": {
+                    "id": f"chatcmpl-bench-{index}",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": MODEL,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": message,
+                            "finish_reason": "tool_calls"
+                            if message.get("tool_calls")
+                            else "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 2000 + 500 * index,
+                        "completion_tokens": 100,
+                        "total_tokens": 2100 + 500 * index,
+                    },
+                },
+            }
+        )
+    return entries
+
+
+class StubForgejo:
+    """
+    issue・リポジトリ情報の取得とPRの作成だけに答えるForgejo APIのスタブ
+    """
+
+    def __init__(self):
+        self.issues: dict[str, dict] = {}
+        self.files: dict[str, list[str]] = {}
+        self.pulls: list[dict] = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = re.fullmatch(
+                    r"/api/v1/repos/([^/]+/[^/]+)(?:/(contents|issues/\d+(?:/\w+)?))?",
+                    self.path,
+                )
+                if match is None or match[1] not in stub.issues:
+                    self._reply(404, {"message": "not found"})
+                    return
+                repository, rest = match[1], match[2] or ""
+                if rest == "":
+                    self._reply(200, {"default_branch": "main", "clone_url": ""})
+                elif rest == "contents":
+                    entries = [
+                        {"name": name, "type": "file"}
+                        for name in stub.files[repository]
+                    ]
+                    self._reply(200, entries)
+                elif rest.endswith(("/comments", "/timeline")):
+                    self._reply(200, [])
+                else:
+                    self._reply(200, stub.issues[repository])
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not self.path.endswith("/pulls"):
+                    self._reply(404, {"message": "not found"})
+                    return
+                stub.pulls.append(json.loads(body))
+                self._reply(201, {"number": len(stub.pulls)})
+
+            def _reply(self, status: int, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.origin = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def git(*args: str, cwd: Path):
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+def prepare_workspace(sample: dict, origin: str, work: Path) -> Path:
+    """
+    サンプルのリポジトリをミラーとして用意し、コンテナの/appに相当するディレクトリを作る
+    returns:
+        container.pyを置いたディレクトリ
+    """
+    source = work / "source"
+    for name, content in sample["files"].items():
+        path = source / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    git("init", "-q", "-b", "main", cwd=source)
+    git("add", ".", cwd=source)
+    git("commit", "-q", "-m", "initial", cwd=source)
+    mirror = work / "mirrors" / forgejo.mirror_key(origin, sample["repository"])
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+    git("clone", "-q", "--bare", str(source), str(mirror), cwd=work)
+
+    app = work / "app"
+    app.mkdir()
+    for name in IMAGE_BUILD_INPUTS:
+        if name.endswith(".py"):
+            shutil.copy(base_dir / name, app / name)
+    return app
+
+
+def run_sample(sample: dict, forgejo_stub: StubForgejo, model_latency: float):
+    """
+    サンプル1件をcontainer.pyで最後まで実行する
+    returns:
+        フェーズごとの時間（秒）
+    """
+    repository = sample["repository"]
+    forgejo_stub.issues[repository] = {"number": 1, "state": "open", **sample["issue"]}
+    forgejo_stub.files[repository] = sorted(sample["files"])
+    pulls_before = len(forgejo_stub.pulls)
+
+    replay = cassette.start_replay_server(
+        ("127.0.0.1", 0),
+        script_cassette(sample["turns"], model_latency),
+        latency_scale=1.0,
+    )
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            work = Path(tmp)
+            app = prepare_workspace(sample, forgejo_stub.origin, work)
+            process_env = {
+                key: value
+                for key, value in os.environ.items()
+                if not key.startswith(("HOSTSELF_", "OPENAI_"))
+            }
+            process_env.update(
+                {
+                    "OPENAI_API_KEY": "dummy",
+                    "OPENAI_BASE_URL": f"http://127.0.0.1:{replay.server_address[1]}/v1",
+                    "FORGEJO_TOKEN": "dummy",
+                    "FORGEJO_USER_NAME": OWNER,
+                    "GH_TOKEN": "dummy",
+                    "HOSTSELF_TRACE_DIR": str(work / "logs"),
+                    "HOSTSELF_MIRROR_ROOT": str(work / "mirrors"),
+                    # 台本の応答は順番に返すので、呼び直しが起きないように1つのモデルで通す
+                    "HOSTSELF_ROUTING": '{"small_model": null}',
+                    "GIT_AUTHOR_NAME": "bench",
+                    "GIT_AUTHOR_EMAIL": "bench@example.com",
+                    "GIT_COMMITTER_NAME": "bench",
+                    "GIT_COMMITTER_EMAIL": "bench@example.com",
+                }
+            )
+            issue_str = (
+                f"{forgejo_stub.origin}/{repository}/issues/1 を解決してください"
+            )
+
+            launched = time.time()
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "container.py",
+                    issue_str,
+                    "--tool-output-dir",
+                    str(work / "tool_outputs"),
+                ],
+                check=False,
+                cwd=app,
+                env=process_env,
+                capture_output=True,
+                text=True,
+                timeout=300,
+            )
+            finished = time.time()
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"{sample['name']} failed (exit {result.returncode}):\n"
+                    f"{result.stdout[-2000:]}{result.stderr[-2000:]}"
+                )
+            if len(forgejo_stub.pulls) != pulls_before + 1:
+                raise RuntimeError(f"{sample['name']} did not create a pull request")
+            events = tracing.load_events(work / "logs")
+    finally:
+        replay.shutdown()
+
+    return phases(events, launched, finished)
+
+
+def phases(events: list[dict], launched: float, finished: float) -> dict[str, float]:
+    """
+    トレースから、起動・モデル呼び出し・ツール実行・PR作成の時間を求める。
+    overlapはツール実行のうちモデルの生成と並行して進んだ時間
+    """
+    llm_calls = [event for event in events if event["type"] == "llm_call"]
+    first_call = min(event["ts"] - event["latency_seconds"] for event in llm_calls)
+    model = sum(event["latency_seconds"] for event in llm_calls)
+    pr_creation = sum(
+        event["duration_seconds"]
+        for event in events
+        if event["type"] == "tool_call" and event["name"] == "create_pull_request"
+    )
+    tool_turns = [event for event in events if event["type"] == "tool_turn"]
+    # モデルの生成と重なった分は、モデル呼び出しの時間に含まれている
+    overlap = sum(event.get("overlap_seconds", 0.0) for event in tool_turns)
+    tools = sum(event["wall_seconds"] for event in tool_turns) - overlap
+    total = finished - launched
+    result = {
+        "startup": first_call - launched,
+        "model": model,
+        "tools": tools,
+    }
+    result["other"] = total - sum(result.values())
+    # 内訳。PR作成はtoolsに、overlapはmodelに含まれている
+    result["pr_creation"] = pr_creation
+    result["overlap"] = overlap
+    result["total"] = total
+    return result
+
+
+def head_commit() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        check=False,
+        cwd=base_dir,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--model-latency",
+        type=float,
+        default=0.0,
+        help="Simulated seconds per model call (0 measures only our own overhead)",
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    forgejo_stub = StubForgejo()
+    results: dict[str, dict[str, list[float]]] = {}
+    try:
+        for make_sample in SAMPLES:
+            sample = make_sample(forgejo_stub.origin)
+            timings = results.setdefault(sample["name"], {})
+            for _ in range(args.repeat):
+                measured = run_sample(sample, forgejo_stub, args.model_latency)
+                for phase, seconds in measured.items():
+                    timings.setdefault(phase, []).append(seconds)
+    finally:
+        forgejo_stub.shutdown()
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "commit": head_commit(),
+                    "repeat": args.repeat,
+                    "samples": {
+                        name: {
+                            phase: round(statistics.median(values), 4)
+                            for phase, values in timings.items()
+                        }
+                        for name, timings in results.items()
+                    },
+                },
+                indent=2,
+            )
+        )
+        return
+
+    print(f"commit {head_commit()}, median of {args.repeat} runs (ms)")
+    for name, timings in results.items():
+        print(
+            f"{name:8}"
+            + "".join(
+                f"  {phase} {statistics.median(values) * 1000:8.1f}"
+                for phase, values in timings.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Dockerfileのステージごとに、イメージのサイズ・ビルド時間・コンテナを起動してから
+最初のモデル呼び出しが届くまでの時間を測る。fullは以前と同じ構成（フルのpythonイメージとgh cli）、
+slimが既定のイメージ。モデル呼び出しはホストのリプレイサーバーがすぐに終了の応答を返す
+
+    python -m benchmarks.image_startup --repeat 5
+    python -m benchmarks.image_startup --cold --json  # キャッシュを使わずにビルドする
+"""
+
+import argparse
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import cassette
+from benchmarks.agent_loop import head_commit, script_cassette
+from main import IMAGE_BUILD_INPUTS, IMAGE_TARGETS
+
+base_dir = Path(__file__).parent.parent
+HOST_ALIAS = "hostself-bench-host"
+BUILD_ARGS = {"GIT_USER_EMAIL": "bench@example.com", "GIT_USER_NAME": "bench"}
+
+
+class TimedReplayer(cassette.Replayer):
+    """
+    最初のリクエストが届いた時刻を記録する
+    """
+
+    def __init__(self, entries: list[dict]):
+        super().__init__(entries)
+        self.first_request_at: float | None = None
+
+    def next(self, request: dict) -> dict | None:
+        if self.first_request_at is None:
+            self.first_request_at = time.time()
+        return super().next(request)
+
+
+def build(context: Path, target: str, tag: str, no_cache: bool) -> float:
+    """
+    returns:
+        docker buildにかかった時間（秒）
+    """
+    command = ["docker", "build", "--quiet", "--target", target, "-t", tag]
+    if no_cache:
+        command.append("--no-cache")
+    for key, value in BUILD_ARGS.items():
+        command += ["--build-arg", f"{key}={value}"]
+    start = time.perf_counter()
+    subprocess.run([*command, str(context)], check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def image_size(tag: str) -> int:
+    result = subprocess.run(
+        ["docker", "image", "inspect", "--format", "{{.Size}}", tag],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return int(result.stdout)
+
+
+def start_container(tag: str) -> dict[str, float]:
+    """
+    コンテナを1回起動して、最初のモデル呼び出しまでと終了までの時間を測る
+    """
+    replayer = TimedReplayer(script_cassette([], 0.0))
+    # コンテナからはホストの別名で届くように、全てのアドレスで待ち受ける
+    server = cassette.make_replay_server(("0.0.0.0", 0), replayer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        port = server.server_address[1]
+        launched = time.time()
+        subprocess.run(
+            [
+                "docker",
+                "run",
+                "--rm",
+                "--add-host",
+                f"{HOST_ALIAS}:host-gateway",
+                "--env",
+                "OPENAI_API_KEY=dummy",
+                "--env",
+                f"OPENAI_BASE_URL=http://{HOST_ALIAS}:{port}/v1",
+                tag,
+                "python",
+                "container.py",
+                "ベンチマーク",
+            ],
+            check=True,
+            capture_output=True,
+        )
+        finished = time.time()
+    finally:
+        server.shutdown()
+        server.server_close()
+    if replayer.first_request_at is None:
+        raise RuntimeError(f"{tag} exited without calling the model")
+    return {
+        "first_request": replayer.first_request_at - launched,
+        "total": finished - launched,
+    }
+
+
+def measure(target: str, repeat: int, cold: bool) -> dict[str, float]:
+    """
+    1つのステージについて、ビルド・再ビルド・起動の時間とイメージのサイズを測る
+    """
+    tag = f"hostself-bench:{target}"
+    with tempfile.TemporaryDirectory() as tmp:
+        context = Path(tmp)
+        for name in IMAGE_BUILD_INPUTS:
+            if (base_dir / name).exists():
+                shutil.copy(base_dir / name, context / name)
+        build_seconds = build(context, target, tag, no_cache=cold)
+        # container.pyだけを変えたときに、どれだけのレイヤーを作り直すか
+        with (context / "container.py").open("a") as f:
+            f.write(f"\n# benchmark rebuild {time.time()}\n")
+        rebuild_seconds = build(context, target, tag, no_cache=False)
+
+    runs = [start_container(tag) for _ in range(repeat)]
+    return {
+        "size_mb": image_size(tag) / 1_000_000,
+        "build": build_seconds,
+        "rebuild": rebuild_seconds,
+        "first_request": statistics.median(run["first_request"] for run in runs),
+        "total": statistics.median(run["total"] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--targets", nargs="+", choices=IMAGE_TARGETS, default=["full", "slim"]
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="Build without the layer cache"
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = {
+        target: measure(target, args.repeat, args.cold) for target in args.targets
+    }
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "commit": head_commit(),
+                    "repeat": args.repeat,
+                    "cold": args.cold,
+                    "targets": {
+                        target: {key: round(value, 3) for key, value in result.items()}
+                        for target, result in results.items()
+                    },
+                },
+                indent=2,
+            )
+        )
+        return
+
+    print(
+        f"commit {head_commit()}, {'cold' if args.cold else 'cached'} build, "
+        f"median of {args.repeat} starts"
+    )
+    for target, result in results.items():
+        print(
+            f"{target:6}"
+            f"  size {result['size_mb']:8.1f} MB"
+            f"  build {result['build']:7.1f}s"
+            f"  rebuild {result['rebuild']:6.1f}s"
+            f"  first request {result['first_request'] * 1000:7.0f}ms"
+            f"  total {result['total'] * 1000:7.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+従来のpatch_file（patchコマンドを1ファイルずつ呼ぶ）とpatcher.apply_patchを比べる。
+失敗したhunkはモデルがファイルを読み直して再送するので、1回の失敗を1往復として数える
+
+    python -m benchmarks.patching --repeat 20
+"""
+
+import argparse
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from patcher import apply_patch, parse_patch
+
+FILES = 5
+LINES = 400
+
+
+def source(index: int, trailing: str = "") -> str:
+    return "".join(
+        f"def f{index}_{i}():{trailing}\n    return {i}\n\n" for i in range(LINES)
+    )
+
+
+def hunk(index: int, line: int, stated: int, count: str = "4,4") -> str:
+    old_count, new_count = count.split(",")
+    return (
+        f"@@ -{stated},{old_count} +{stated},{new_count} @@\n"
+        f" def f{index}_{line}():\n"
+        f"-    return {line}\n"
+        f"+    return {line} * 2\n"
+        f"\n"
+        f" def f{index}_{line + 1}():\n"
+    )
+
+
+def scenario(kind: str) -> str:
+    parts = []
+    for index in range(FILES):
+        line = 100
+        actual = line * 3 + 1
+        stated = {"exact": actual, "drifted": actual - 40}.get(kind, actual)
+        # モデルが書くdiffでよくある、hunkの行数の間違い
+        count = "2,2" if kind == "miscounted" else "4,4"
+        parts.append(
+            f"--- a/f{index}.py\n+++ b/f{index}.py\n" + hunk(index, line, stated, count)
+        )
+    return "".join(parts)
+
+
+def run_patch_cli(directory: Path, patch: str) -> tuple[bool, int]:
+    ok = True
+    calls = 0
+    for file_patch, text in zip(parse_patch(patch), patch.split("--- a/")[1:]):
+        calls += 1
+        result = subprocess.run(
+            f"patch {file_patch.new_path}",
+            input="--- a/" + text,
+            shell=True,
+            check=False,
+            capture_output=True,
+            text=True,
+            cwd=directory,
+        )
+        if result.returncode != 0:
+            ok = False
+            calls += 1
+    return ok, calls
+
+
+def run_engine(directory: Path, patch: str) -> tuple[bool, int]:
+    result = apply_patch(patch, cwd=directory)
+    return result.applied, 1 if result.applied else 2
+
+
+def measure(runner, kind: str, repeat: int) -> tuple[float, bool, int]:
+    durations = []
+    ok = True
+    calls = 0
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            # whitespace: ファイル側だけ行末に空白が残っている
+            trailing = "  " if kind == "whitespace" else ""
+            for index in range(FILES):
+                (directory / f"f{index}.py").write_text(source(index, trailing))
+            patch = scenario(kind)
+            start = time.perf_counter()
+            ok, calls = runner(directory, patch)
+            durations.append(time.perf_counter() - start)
+            # 終了コードだけでなく、結果の中身も正しいかを確かめる
+            for index in range(FILES):
+                expected = source(index, trailing).replace(
+                    "    return 100\n", "    return 100 * 2\n"
+                )
+                if (directory / f"f{index}.py").read_text() != expected:
+                    ok = False
+    return statistics.median(durations), ok, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{FILES} files, 1 hunk each")
+    print(
+        f"{'scenario':12} {'backend':12} {'correct':>8} {'tool calls':>11} {'median ms':>10}"
+    )
+    for kind in ["exact", "drifted", "miscounted", "whitespace"]:
+        for name, runner in [
+            ("patch_file", run_patch_cli),
+            ("apply_patch", run_engine),
+        ]:
+            median, ok, calls = measure(runner, kind, args.repeat)
+            print(f"{kind:12} {name:12} {ok!s:>8} {calls:>11} {median * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
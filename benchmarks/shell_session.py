@@ -0,0 +1,51 @@
+"""
+execute_command（毎回新しいシェル）とShellSession（シェルを使い回す）の1コマンドあたりの時間を比べる
+
+    OPENAI_API_KEY=dummy python -m benchmarks.shell_session --repeat 200
+"""
+
+import argparse
+import statistics
+import time
+
+from container import ShellSession, run_command
+
+COMMANDS = ["true", "pwd", "echo hello", "ls"]
+
+
+def measure(run, repeat: int) -> list[float]:
+    durations = []
+    for i in range(repeat):
+        command = COMMANDS[i % len(COMMANDS)]
+        start = time.perf_counter()
+        run(command)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    session = ShellSession(forward_output=False)
+    try:
+        results = {
+            "execute_command": measure(
+                lambda command: run_command(command, forward_output=False), args.repeat
+            ),
+            "shell_session": measure(session.run, args.repeat),
+        }
+    finally:
+        session.close()
+
+    for name, durations in results.items():
+        print(
+            f"{name:16} mean {statistics.fmean(durations) * 1000:7.2f} ms"
+            f"  median {statistics.median(durations) * 1000:7.2f} ms"
+            f"  total {sum(durations):6.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
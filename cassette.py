@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from ratelimit import bearer_token_matches
+
+
+def to_jsonable(value):
+    """
+    openaiのレスポンスオブジェクトを含む値を、JSONにできる値に変換する
+    """
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_unset=True)
+    if isinstance(value, dict):
+        return {key: to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    return value
+
+
+def request_key(request: dict) -> str:
+    """
+    リクエストのうち、レスポンスを決める部分（model・messages・tools）のハッシュ
+    """
+    relevant = {
+        key: request.get(key) for key in ("model", "messages", "tools", "tool_choice")
+    }
+    data = json.dumps(to_jsonable(relevant), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class CassetteRecorder:
+    """
+    chat.completions.createのリクエストとレスポンスの組をJSONLに追記する
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, request: dict, response, latency: float):
+        entry = {
+            "key": request_key(request),
+            "request": to_jsonable(request),
+            "response": to_jsonable(response),
+            "latency_seconds": round(latency, 3),
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock, self.path.open("a") as f:
+            f.write(line + "\n")
+
+
+def load_cassette(path: Path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+
+class Replayer:
+    """
+    記録したレスポンスを順番に返す。
+    リクエストが記録と同じなら対応するレスポンスを、違えば（ツールの出力の時刻などで
+    ずれた場合）まだ返していない次のレスポンスを返す
+    """
+
+    def __init__(self, entries: list[dict]):
+        self.entries = entries
+        self.used = [False] * len(entries)
+        self.stats = {"served": 0, "matched": 0, "drifted": 0, "exhausted": 0}
+        self._lock = threading.Lock()
+
+    def next(self, request: dict) -> dict | None:
+        key = request_key(request)
+        with self._lock:
+            unused = [index for index, used in enumerate(self.used) if not used]
+            if not unused:
+                self.stats["exhausted"] += 1
+                return None
+            matched = [index for index in unused if self.entries[index]["key"] == key]
+            index = matched[0] if matched else unused[0]
+            self.used[index] = True
+            self.stats["served"] += 1
+            self.stats["matched" if matched else "drifted"] += 1
+            return self.entries[index]
+
+
+def stream_chunks(response: dict, pieces: int = 3) -> list[dict]:
+    """
+    記録した応答を、ストリーミングのチャンクの列に分ける。
+    tool callの引数は途中で区切って、少しずつ届くようにする
+    """
+    base = {
+        "id": response.get("id", ""),
+        "object": "chat.completion.chunk",
+        "created": response.get("created", 0),
+        "model": response.get("model", ""),
+    }
+    choice = response["choices"][0]
+    message = choice["message"]
+
+    def chunk(delta: dict, finish_reason=None) -> dict:
+        return {
+            **base,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    chunks = [chunk({"role": "assistant", "content": message.get("content")})]
+    for index, call in enumerate(message.get("tool_calls") or []):
+        arguments = call["function"]["arguments"]
+        size = max(1, -(-len(arguments) // pieces))
+        parts = [arguments[i : i + size] for i in range(0, len(arguments), size)]
+        for number, part in enumerate(parts or [""]):
+            delta = {"index": index, "function": {"arguments": part}}
+            if number == 0:
+                delta.update(id=call["id"], type="function")
+                delta["function"]["name"] = call["function"]["name"]
+            chunks.append(chunk({"tool_calls": [delta]}))
+    chunks.append(chunk({}, choice.get("finish_reason")))
+    if response.get("usage") is not None:
+        chunks.append({**base, "choices": [], "usage": response["usage"]})
+    return chunks
+
+
+def make_replay_server(
+    address: tuple[str, int],
+    replayer: Replayer,
+    latency_scale: float = 0.0,
+    token: str | None = None,
+) -> ThreadingHTTPServer:
+    """
+    OpenAI互換の/v1/chat/completionsを、記録したレスポンスで答えるサーバーを作る
+    params:
+        address: 待ち受けるアドレス
+        replayer: 返すレスポンス
+        latency_scale: 記録したレイテンシに掛ける倍率。0なら待たずに返す
+        token: 指定すると、APIキーとしてこのトークンを送らないリクエストを401で断る
+    """
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not bearer_token_matches(self.headers, token):
+                self._reply(401, {"error": {"message": "unauthorized"}})
+                return
+            if not self.path.endswith("/chat/completions"):
+                self._reply(404, {"error": {"message": "not found"}})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            request = json.loads(body)
+            entry = replayer.next(request)
+            if entry is None:
+                # 5xxだとクライアントが再試行するので、4xxで打ち切らせる
+                self._reply(
+                    400, {"error": {"message": "cassette exhausted", "type": "replay"}}
+                )
+                return
+            latency = entry.get("latency_seconds", 0) * latency_scale
+            if not request.get("stream"):
+                time.sleep(latency)
+                self._reply(200, entry["response"])
+                return
+
+            # 記録したレイテンシをチャンクの間に均等に配って、生成中の様子を再現する
+            chunks = stream_chunks(entry["response"])
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for chunk in chunks:
+                time.sleep(latency / len(chunks))
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def do_GET(self):
+            if not bearer_token_matches(self.headers, token):
+                self._reply(401, {"error": {"message": "unauthorized"}})
+            elif self.path == "/stats":
+                self._reply(200, replayer.stats)
+            else:
+                self._reply(404, {"error": {"message": "not found"}})
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer(address, ReplayHandler)
+
+
+def start_replay_server(
+    address: tuple[str, int],
+    entries: list[dict],
+    latency_scale: float = 0.0,
+    token: str | None = None,
+) -> ThreadingHTTPServer:
+    """
+    リプレイサーバーをバックグラウンドのスレッドで起動する。止めるときはshutdown()を呼ぶ
+    """
+    server = make_replay_server(address, Replayer(entries), latency_scale, token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Serve a recorded LLM cassette")
+    argparser.add_argument("cassette")
+    argparser.add_argument("--listen", default="127.0.0.1:8081")
+    argparser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=0.0,
+        help="Multiplier for the recorded latency (0 replies immediately)",
+    )
+    args = argparser.parse_args()
+
+    host, port = args.listen.rsplit(":", 1)
+    server = make_replay_server(
+        (host, int(port)),
+        Replayer(load_cassette(Path(args.cassette))),
+        args.latency_scale,
+    )
+    print(f"OPENAI_BASE_URL=http://{host}:{port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,251 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+CHECKPOINT_FILE = "state.json"
+# ステップの途中で完了したtool callの結果。会話と作業ツリーを保存し直さずに書き足す
+TOOL_RESULTS_FILE = "tool_results.json"
+# 作業ツリーのスナップショットを指すref。バンドルに含めて復元に使う
+SNAPSHOT_REF = "refs/hostself/checkpoint"
+
+
+def message_param(message) -> dict:
+    """
+    メッセージをAPIにそのまま送り直せるdictにする
+    """
+    if isinstance(message, dict):
+        return message
+    param = {"role": message.role, "content": message.content}
+    if message.tool_calls:
+        param["tool_calls"] = [
+            {
+                "id": call.id,
+                "type": "function",
+                "function": {
+                    "name": call.function.name,
+                    "arguments": call.function.arguments,
+                },
+            }
+            for call in message.tool_calls
+        ]
+    return param
+
+
+def write_atomic(path: Path, data: bytes):
+    # 書き込み途中で止まっても、前回のチェックポイントが壊れないようにする
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def git(repository: Path, *args: str, env: dict | None = None) -> str:
+    result = subprocess.run(
+        ["git", "-C", str(repository), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, **env} if env else None,
+    )
+    return result.stdout.strip()
+
+
+def workspace_repositories(workspace: Path) -> list[Path]:
+    return sorted(path for path in workspace.iterdir() if (path / ".git").is_dir())
+
+
+def snapshot_repository(repository: Path, bundle: Path) -> dict | None:
+    """
+    ブランチ・コミット・未コミットの変更（未追跡のファイルも含む）をバンドルに保存する。
+    originにあるコミットは含めないので、復元時はoriginかミラーからcloneしておく
+    returns:
+        復元に必要な情報。まだコミットがないリポジトリならNone
+    """
+    try:
+        head = git(repository, "rev-parse", "HEAD")
+    except subprocess.CalledProcessError:
+        return None
+    try:
+        branch = git(repository, "symbolic-ref", "-q", "--short", "HEAD")
+    except subprocess.CalledProcessError:
+        branch = None
+    try:
+        origin = git(repository, "remote", "get-url", "origin")
+    except subprocess.CalledProcessError:
+        origin = None
+
+    # 本来のindexを変えないように、一時的なindexで作業ツリー全体をコミットにする
+    index = {"GIT_INDEX_FILE": str(repository / ".git" / "hostself-checkpoint-index")}
+    git(repository, "read-tree", "HEAD", env=index)
+    git(repository, "add", "-A", env=index)
+    tree = git(repository, "write-tree", env=index)
+    snapshot = git(repository, "commit-tree", tree, "-p", head, "-m", "checkpoint")
+    git(repository, "update-ref", SNAPSHOT_REF, snapshot)
+
+    tmp = bundle.with_name(f".{bundle.name}.tmp")
+    git(repository, "bundle", "create", str(tmp), "--all", "--not", "--remotes")
+    os.replace(tmp, bundle)
+    return {"head": head, "branch": branch, "origin": origin, "bundle": bundle.name}
+
+
+def restore_repository(repository: Path, snapshot: dict, bundle: Path):
+    """
+    snapshot_repositoryで保存した状態を、clone済みのリポジトリに戻す
+    """
+    git(
+        repository,
+        "fetch",
+        "--quiet",
+        "--update-head-ok",
+        str(bundle),
+        "+refs/heads/*:refs/heads/*",
+        f"+{SNAPSHOT_REF}:{SNAPSHOT_REF}",
+    )
+    if snapshot["branch"]:
+        git(repository, "checkout", "--quiet", "--force", snapshot["branch"])
+    else:
+        git(repository, "checkout", "--quiet", "--force", "--detach", snapshot["head"])
+    # 作業ツリーをスナップショットにしてから、indexだけHEADに戻す
+    git(repository, "read-tree", "-u", "--reset", SNAPSHOT_REF)
+    git(repository, "reset", "--quiet")
+
+
+class Checkpointer:
+    """
+    1回の実行の会話と作業ツリーをステップごとに保存する。
+    作業ツリーは前回から変わったリポジトリだけバンドルを作り直す。
+    ステップの途中のtool callの結果は、save_tool_resultsで結果だけを書き足せる
+    """
+
+    def __init__(
+        self, directory: Path, workspace: Path, fingerprint: Callable[[str], str]
+    ):
+        self.directory = directory
+        self.workspace = workspace
+        self.fingerprint = fingerprint
+        self.repositories: dict[str, dict] = {}
+        self._fingerprints: dict[str, str] = {}
+        self._snapshotted = False
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def save(
+        self,
+        issue_str: str,
+        step: int,
+        messages: list,
+        compacted: list[int],
+        tool_results: dict[str, str],
+        snapshot: bool = True,
+    ) -> float:
+        """
+        チェックポイントを書き出す
+        params:
+            issue_str: ユーザーの指示
+            step: 完了したモデル呼び出しの回数
+            messages: 会話のメッセージ
+            compacted: 縮めたツール出力のメッセージの位置
+            tool_results: 最後のアシスタントのメッセージのtool callのうち、完了したものの結果
+            snapshot: Falseなら、作業ツリーは前回の保存から変わっていないものとして
+                スナップショットを取り直さない（まだ一度も取っていなければ取る）
+        returns:
+            保存にかかった時間（秒）
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if snapshot or not self._snapshotted:
+                self._snapshot_workspace()
+                self._snapshotted = True
+            state = {
+                "issue_str": issue_str,
+                "step": step,
+                "messages": [message_param(message) for message in messages],
+                "compacted": compacted,
+                "tool_results": tool_results,
+                "repositories": self.repositories,
+            }
+            write_atomic(
+                self.directory / CHECKPOINT_FILE,
+                json.dumps(state, ensure_ascii=False).encode(),
+            )
+            # 結果はstate.jsonに含めたので、書き足した分は要らない
+            (self.directory / TOOL_RESULTS_FILE).unlink(missing_ok=True)
+        return time.perf_counter() - start
+
+    def save_tool_results(self, step: int, tool_results: dict[str, str]):
+        """
+        作業ツリーを変更しないtool callの結果だけを書き足す。会話と作業ツリーは保存し直さない
+        params:
+            step: 完了したモデル呼び出しの回数。最後のsaveと同じステップの結果だけが読み込まれる
+            tool_results: 最後のアシスタントのメッセージのtool callのうち、完了したものの結果
+        """
+        with self._lock:
+            write_atomic(
+                self.directory / TOOL_RESULTS_FILE,
+                json.dumps(
+                    {"step": step, "tool_results": tool_results}, ensure_ascii=False
+                ).encode(),
+            )
+
+    def _snapshot_workspace(self):
+        for repository in workspace_repositories(self.workspace):
+            fingerprint = self.fingerprint(str(repository))
+            if self._fingerprints.get(repository.name) == fingerprint:
+                continue
+            snapshot = snapshot_repository(
+                repository, self.directory / f"{repository.name}.bundle"
+            )
+            if snapshot is not None:
+                self.repositories[repository.name] = snapshot
+            # スナップショットのrefの更新で.gitが変わるので、指紋は保存後に取り直す
+            self._fingerprints[repository.name] = self.fingerprint(str(repository))
+
+
+def load_checkpoint(directory: Path) -> dict:
+    """
+    returns:
+        Checkpointer.saveで保存した状態
+    raises:
+        FileNotFoundError: チェックポイントがない
+    """
+    state = json.loads((directory / CHECKPOINT_FILE).read_text())
+    results_path = directory / TOOL_RESULTS_FILE
+    if results_path.exists():
+        results = json.loads(results_path.read_text())
+        if results["step"] == state["step"]:
+            state["tool_results"] = {**state["tool_results"], **results["tool_results"]}
+    return state
+
+
+def restore_workspace(directory: Path, workspace: Path, state: dict) -> list[dict]:
+    """
+    チェックポイントのリポジトリを作業ディレクトリに戻す。
+    まだcloneされていないリポジトリはoriginからcloneする
+    returns:
+        リポジトリごとの復元結果
+    """
+    stats = []
+    for name, snapshot in state["repositories"].items():
+        start = time.perf_counter()
+        repository = workspace / name
+        if not repository.exists():
+            if not snapshot["origin"]:
+                stats.append({"repository": name, "status": "skipped"})
+                continue
+            subprocess.run(
+                ["git", "clone", "--quiet", snapshot["origin"], str(repository)],
+                check=True,
+                capture_output=True,
+            )
+        restore_repository(repository, snapshot, directory / snapshot["bundle"])
+        stats.append(
+            {
+                "repository": name,
+                "status": "restored",
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+        )
+    return stats
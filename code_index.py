@@ -0,0 +1,268 @@
+import fnmatch
+import os
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+# 索引に含めないディレクトリ
+SKIP_DIRS = {
+    ".git",
+    "node_modules",
+    "__pycache__",
+    ".venv",
+    "venv",
+    ".mypy_cache",
+    ".pytest_cache",
+    ".ruff_cache",
+}
+MAX_FILE_BYTES = 1_000_000
+# 定義とみなす行のパターン。nameグループがシンボル名
+DEFINITION_PATTERNS = [
+    re.compile(p)
+    for p in [
+        r"^\s*(?:async\s+)?def\s+(?P<name>\w+)",
+        r"^\s*class\s+(?P<name>\w+)",
+        r"^(?P<name>[A-Za-z_]\w*)\s*(?::[^=]+)?=(?!=)",
+        r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\*?\s+(?P<name>\w+)",
+        r"^\s*(?:export\s+)?(?:const|let|var)\s+(?P<name>\w+)\s*=",
+        r"^\s*(?:export\s+)?(?:interface|type|enum)\s+(?P<name>\w+)",
+        r"^func\s+(?:\([^)]*\)\s*)?(?P<name>\w+)",
+        r"^type\s+(?P<name>\w+)",
+        r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:fn|struct|enum|trait|mod)\s+(?P<name>\w+)",
+    ]
+]
+
+
+@dataclass
+class Match:
+    path: str
+    line_number: int
+    line: str
+
+    def render(self) -> str:
+        return f"{self.path}:{self.line_number}: {self.line.strip()}"
+
+
+def split_lines(text: str) -> list[str]:
+    """
+    grepやpatcherと同じ行番号になるように、LFだけで行に分ける。
+    改ページなどLF以外の区切り文字は行の内容として残し、CRLFの\rだけを落とす
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return [line.removesuffix("\r") for line in lines]
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class CodeIndex:
+    """
+    チェックアウト1つ分のテキスト検索用のtrigram索引と、シンボルの定義の一覧。
+    最初の問い合わせで作り、その後は変更のあったファイルだけを読み直す
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._lines: dict[str, list[str]] = {}
+        self._stats: dict[str, tuple[int, int]] = {}
+        self._trigrams: dict[str, set[str]] = {}
+        self._postings: dict[str, set[str]] = {}
+        self._definitions: dict[str, dict[str, list[int]]] = {}
+        self._built = False
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def mark_dirty(self):
+        """
+        パッチ以外の方法（コマンドなど）でファイルが変わったかもしれない時に呼ぶ。
+        次の問い合わせの前に、ディレクトリを走査して変わったファイルを読み直す
+        """
+        self._dirty = True
+
+    def update(self, paths: list[Path]):
+        """
+        パッチで変更したファイルを読み直す
+        """
+        with self._lock:
+            if not self._built:
+                return
+            for path in paths:
+                relative = self._relative(path)
+                if relative is not None:
+                    self._index_file(relative)
+
+    def search(
+        self,
+        query: str,
+        regex: bool = False,
+        ignore_case: bool = False,
+        path_glob: str | None = None,
+        max_results: int = 50,
+    ) -> tuple[list[Match], int]:
+        """
+        returns:
+            最大max_results件の一致と、一致した総数
+        """
+        flags = re.IGNORECASE if ignore_case else 0
+        pattern = re.compile(query if regex else re.escape(query), flags)
+        with self._lock:
+            self._ensure_fresh()
+            candidates = self._candidates(query) if not regex else set(self._lines)
+            matches = []
+            for path in sorted(candidates):
+                if path_glob and not fnmatch.fnmatch(path, path_glob):
+                    continue
+                for number, line in enumerate(self._lines[path], 1):
+                    if pattern.search(line):
+                        matches.append(Match(path, number, line))
+        return matches[:max_results], len(matches)
+
+    def definitions(self, name: str) -> list[Match]:
+        with self._lock:
+            self._ensure_fresh()
+            return [
+                Match(path, number, self._lines[path][number - 1])
+                for path in sorted(self._definitions)
+                for number in self._definitions[path].get(name, [])
+            ]
+
+    def references(self, name: str, max_results: int = 50) -> tuple[list[Match], int]:
+        defined = {(m.path, m.line_number) for m in self.definitions(name)}
+        matches, _ = self.search(
+            rf"\b{re.escape(name)}\b", regex=True, max_results=10**9
+        )
+        references = [m for m in matches if (m.path, m.line_number) not in defined]
+        return references[:max_results], len(references)
+
+    def _candidates(self, query: str) -> set[str]:
+        grams = trigrams(query.lower())
+        if not grams:
+            return set(self._lines)
+        postings = [self._postings.get(gram, set()) for gram in grams]
+        return set.intersection(*sorted(postings, key=len))
+
+    def _ensure_fresh(self):
+        if self._built and not self._dirty:
+            return
+        self._dirty = False
+        seen = set()
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+            for filename in filenames:
+                relative = os.path.relpath(os.path.join(directory, filename), self.root)
+                seen.add(relative)
+                self._index_file(relative)
+        for relative in set(self._stats) - seen:
+            self._forget(relative)
+        self._built = True
+
+    def _index_file(self, relative: str):
+        path = self.root / relative
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._forget(relative)
+            return
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._stats.get(relative) == key:
+            return
+        self._forget(relative)
+        self._stats[relative] = key
+        if stat.st_size > MAX_FILE_BYTES or not path.is_file():
+            return
+        data = path.read_bytes()
+        # バイナリファイルは索引に含めない
+        if b"\0" in data[:8192]:
+            return
+        text = data.decode(errors="replace")
+        lines = split_lines(text)
+        self._lines[relative] = lines
+
+        grams = trigrams(text.lower())
+        self._trigrams[relative] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(relative)
+
+        definitions: dict[str, list[int]] = {}
+        for number, line in enumerate(lines, 1):
+            for definition in DEFINITION_PATTERNS:
+                match = definition.match(line)
+                if match:
+                    definitions.setdefault(match["name"], []).append(number)
+                    break
+        self._definitions[relative] = definitions
+
+    def _forget(self, relative: str):
+        self._stats.pop(relative, None)
+        self._lines.pop(relative, None)
+        self._definitions.pop(relative, None)
+        for gram in self._trigrams.pop(relative, set()):
+            paths = self._postings.get(gram)
+            if paths is not None:
+                paths.discard(relative)
+                if not paths:
+                    del self._postings[gram]
+
+    def _relative(self, path: Path) -> str | None:
+        try:
+            return str(path.resolve().relative_to(self.root))
+        except ValueError:
+            return None
+
+
+_indexes: dict[Path, CodeIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(root: str | Path) -> CodeIndex:
+    resolved = Path(root).resolve()
+    with _indexes_lock:
+        if resolved not in _indexes:
+            _indexes[resolved] = CodeIndex(resolved)
+        return _indexes[resolved]
+
+
+def notify_changed(paths: list[Path]):
+    """
+    パッチで変わったファイルを、それを含む全ての索引に反映する
+    """
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        index.update(paths)
+
+
+def mark_all_dirty():
+    with _indexes_lock:
+        for index in _indexes.values():
+            index.mark_dirty()
+
+
+def read_file(
+    file_path: str,
+    start_line: int = 1,
+    end_line: int | None = None,
+    max_lines: int = 400,
+) -> str:
+    """
+    ファイルの指定した行範囲を行番号付きで返す
+    """
+    lines = split_lines(Path(file_path).read_bytes().decode(errors="replace"))
+    start = max(1, start_line)
+    if start > len(lines):
+        # 空の本文に行範囲を付けて返すと、内容がない行を読んだように見える
+        return (
+            f"[{file_path}: start_line {start_line} is past the end of the file,"
+            f" which has {len(lines)} lines]"
+        )
+    end = min(len(lines), end_line if end_line is not None else len(lines))
+    end = min(end, start + max_lines - 1)
+    width = len(str(end))
+    body = "\n".join(
+        f"{number:>{width}}  {lines[number - 1]}" for number in range(start, end + 1)
+    )
+    return f"{body}\n[{file_path}: lines {start}-{end} of {len(lines)}]"
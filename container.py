@@ -1,46 +1,528 @@
 import argparse
+import functools
+import hashlib
 import json
 import os
+import queue
+import re
+import shlex
+import signal
 import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Literal
 
 import openai
 import requests
 
+import cassette
+import checkpoint
+import code_index
+import forgejo
+import impact
+import patcher
+import ratelimit
+import tracing
+from conversation import ConversationContext
+
 base_dir = Path(__file__).parent
 
 OPENAI_MODEL = "gpt-4o-2024-11-20"
+# 定型的なステップに使う小さく速いモデル
+OPENAI_SMALL_MODEL = "gpt-4o-mini-2024-07-18"
 # DEEPSEEK_MODEL = "deepseek-reasoning"
 
 # openai_client = openai.Client(api_key=env["OPENAI_API_KEY"])
 openai_client = openai.Client(
     api_key=os.getenv("OPENAI_API_KEY", ""),
     # base_url="https://api.deepseek.com"
+    # 再試行はcreate_with_retriesで、共有のレート制限と合わせて行う
+    max_retries=0,
+)
+# ホストのブローカーが設定されていれば、他のコンテナと合わせてレート制限する
+rate_limiter = (
+    ratelimit.BrokerClient(
+        os.environ["HOSTSELF_RATE_LIMIT_URL"],
+        token=os.getenv("HOSTSELF_RATE_LIMIT_TOKEN"),
+    )
+    if os.getenv("HOSTSELF_RATE_LIMIT_URL")
+    else None
 )
+# 応答のトークン数の見積もり。実際の値との差は応答を受け取った後に精算する
+COMPLETION_TOKENS_ESTIMATE = 1024
+# 再試行する状態コード。429以外はレート制限を縮めない
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+# コマンドの実行時間の上限（秒）と、モデルに返す出力の上限（バイト）
+COMMAND_TIMEOUT = float(os.getenv("HOSTSELF_COMMAND_TIMEOUT", "600"))
+COMMAND_OUTPUT_LIMIT = int(os.getenv("HOSTSELF_COMMAND_OUTPUT_LIMIT", "65536"))
+
+
+class HeadTailBuffer:
+    """
+    先頭と末尾をそれぞれlimitの半分まで保持し、間を捨てるバッファ
+    """
+
+    def __init__(self, limit: int):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        if len(self.tail) > self.tail_limit:
+            del self.tail[: len(self.tail) - self.tail_limit]
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > len(self.head) + len(self.tail)
+
+    def getvalue(self) -> str:
+        if not self.truncated:
+            return (self.head + self.tail).decode(errors="replace")
+        omitted = self.total - len(self.head) - len(self.tail)
+        return (
+            self.head.decode(errors="replace")
+            + f"\n...[{omitted} bytes omitted]...\n"
+            + self.tail.decode(errors="replace")
+        )
+
+
+@dataclass
+class CommandResult:
+    output: str
+    exit_code: int | None
+    truncated: bool
+    timed_out: bool
+    duration: float
+    # 打ち切った時間の上限（秒）。タイムアウトした時だけモデルに伝える
+    timeout: float | None = None
+
+    def render(self) -> str:
+        status = "timed out" if self.timed_out else f"exit code {self.exit_code}"
+        notes = [status, f"{self.duration:.2f}s"]
+        if self.truncated:
+            notes.append("output truncated")
+        if self.timed_out and self.timeout is not None:
+            # ツールの説明は実行をまたいで同じにしたいので、既定値はここで伝える
+            notes.append(
+                f"timeout {self.timeout:g}s (default {COMMAND_TIMEOUT:g}s),"
+                " pass a larger timeout if the command needs more time"
+            )
+        return f"{self.output}\n[{', '.join(notes)}]"
+
+
+def run_command(
+    command: str,
+    cwd: str | None = None,
+    timeout: float = COMMAND_TIMEOUT,
+    output_limit: int = COMMAND_OUTPUT_LIMIT,
+    forward_output: bool = True,
+) -> CommandResult:
+    """
+    コマンドを実行し、出力を読みながら上限付きのバッファに溜める
+    params:
+        command: シェルで実行するコマンド
+        cwd: 作業ディレクトリ
+        timeout: これを超えたらプロセスグループごと強制終了する（秒）
+        output_limit: 保持する出力の上限（バイト）。超えた分は中間を捨てる
+        forward_output: 出力をそのままコンテナのログにも流すか
+    returns:
+        実行結果
+    """
+    start = time.perf_counter()
+    # 子プロセスごと止められるように、新しいプロセスグループで起動する
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    buffer = HeadTailBuffer(output_limit)
+
+    def pump():
+        assert process.stdout is not None
+        while chunk := process.stdout.read1(65536):
+            buffer.write(chunk)
+            if forward_output:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+
+    reader = threading.Thread(target=pump, daemon=True)
+    reader.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+    # プロセスグループの外に逃げた子がパイプを握っていても待ち続けない
+    reader.join(timeout=1)
+    process.stdout.close()
+
+    return CommandResult(
+        output=buffer.getvalue(),
+        exit_code=None if timed_out else process.returncode,
+        truncated=buffer.truncated,
+        timed_out=timed_out,
+        duration=time.perf_counter() - start,
+        timeout=timeout,
+    )
 
 
-def execute_command(command: str, replace_dict: dict[str, str], cwd: str | None = None):
+# 読み取り専用のコマンドに加えて、結果を使い回してよいコマンド
+MEMOIZABLE_COMMANDS = [
+    re.compile(r"(python3? -m )?pytest\b[^;&|>`$\n]*--collect-only[^;&|>`$\n]*")
+]
+# 作業ツリーの指紋に含めないディレクトリ（キャッシュなど）
+FINGERPRINT_SKIP_DIRS = code_index.SKIP_DIRS - {".git"}
+# .gitの中で、git status/log/diffの結果に影響するもの
+GIT_STATE_FILES = ["HEAD", "index", "packed-refs"]
+
+
+def is_memoizable_command(command: str) -> bool:
+    return is_read_only_command(command) or any(
+        pattern.fullmatch(command.strip()) for pattern in MEMOIZABLE_COMMANDS
+    )
+
+
+def tree_fingerprint(root: str) -> str:
+    """
+    root以下のファイルのパス・mtime・サイズから作るハッシュ。ファイルが変わると値が変わる
+    """
+    digest = hashlib.sha256()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if ".git" in dirnames:
+            git_dir = os.path.join(directory, ".git")
+            for name in GIT_STATE_FILES:
+                _update_fingerprint(digest, os.path.join(git_dir, name))
+            for ref_dir, _, ref_names in os.walk(os.path.join(git_dir, "refs")):
+                for name in sorted(ref_names):
+                    _update_fingerprint(digest, os.path.join(ref_dir, name))
+        dirnames[:] = [
+            d for d in dirnames if d not in FINGERPRINT_SKIP_DIRS and d != ".git"
+        ]
+        for filename in sorted(filenames):
+            _update_fingerprint(digest, os.path.join(directory, filename))
+    return digest.hexdigest()
+
+
+def _update_fingerprint(digest, path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    digest.update(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode())
+
+
+@dataclass
+class MemoEntry:
+    step: int
+    generation: int
+    fingerprint: str
+    output_digest: str
+
+
+class CommandMemo:
+    """
+    セッション中の読み取り専用コマンドの結果を、コマンドと作業ディレクトリをキーに覚えておく。
+    パッチや書き込みのあるコマンドが実行されるか、作業ツリーの指紋が変わるまでは
+    コマンドを再実行せず、前回の出力を参照する短いメッセージを返す。
+    再実行しても出力が同じだった場合も同じように短いメッセージを返す
+    """
+
+    def __init__(self):
+        self.entries: dict[tuple[str, str], MemoEntry] = {}
+        self.generation = 0
+        self.step = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def run(
+        self, command: str, cwd: str | None, execute: Callable[[], CommandResult]
+    ) -> str:
+        root = os.path.abspath(cwd or ".")
+        key = (command, root)
+        with self._lock:
+            entry = self.entries.get(key)
+            generation = self.generation
+        if (
+            entry is not None
+            and entry.generation == generation
+            and entry.fingerprint == tree_fingerprint(root)
+        ):
+            self.hits += 1
+            return (
+                f"[unchanged since step {entry.step}: no files have changed since then]"
+            )
+
+        result = execute()
+        output_digest = hashlib.sha256(
+            f"{result.exit_code}\0{result.output}".encode()
+        ).hexdigest()
+        fingerprint = tree_fingerprint(root)
+        if entry is not None and entry.output_digest == output_digest:
+            self.hits += 1
+            with self._lock:
+                self.entries[key] = MemoEntry(
+                    entry.step, generation, fingerprint, output_digest
+                )
+            return (
+                f"[exit code {result.exit_code}, {result.duration:.2f}s; "
+                f"output unchanged since step {entry.step}]"
+            )
+
+        with self._lock:
+            self.entries[key] = MemoEntry(
+                self.step, generation, fingerprint, output_digest
+            )
+        return result.render()
+
+
+# HOSTSELF_MEMOIZE_COMMANDS=1 の時だけ有効にする
+command_memo: CommandMemo | None = (
+    CommandMemo() if os.getenv("HOSTSELF_MEMOIZE_COMMANDS") == "1" else None
+)
+
+
+def files_may_have_changed():
+    """
+    コマンドがファイルを変更したかもしれない時に、索引と結果のキャッシュを無効にする
+    """
+    code_index.mark_all_dirty()
+    if command_memo is not None:
+        command_memo.invalidate()
+
+
+def execute_command(
+    command: str,
+    replace_dict: dict[str, str],
+    cwd: str | None = None,
+    timeout: float = COMMAND_TIMEOUT,
+):
     for key, value in replace_dict.items():
         command = command.replace(f"${{{key}}}", value)
 
     try:
-        if cwd:
-            result = subprocess.run(
-                command, shell=True, capture_output=True, text=True, cwd=cwd
+        if command_memo is not None and is_memoizable_command(command):
+            return command_memo.run(
+                command,
+                cwd,
+                lambda: run_command(command, cwd=cwd or None, timeout=timeout),
             )
-        else:
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
-
-        # 標準出力と標準エラーを結合して返す
-        output = result.stdout + "\n" + result.stderr
-        return output
-    except subprocess.CalledProcessError as e:
-        return f"Error executing command:\n{e}"
-    except FileNotFoundError as e:
+        return run_command(command, cwd=cwd or None, timeout=timeout).render()
+    except (FileNotFoundError, NotADirectoryError) as e:
         return f"Working Directory {cwd} does not exist:\n{e}"
     except Exception as e:
         return f"Error executing command:\n{e}"
+    finally:
+        if not is_read_only_command(command):
+            files_may_have_changed()
+
+
+class ShellSession:
+    """
+    1つのbashを起動したまま使い回し、コマンドを順に送って実行する。
+    cd・環境変数・virtualenvの有効化などの状態が次のコマンドに引き継がれる。
+    シェルが終了したりタイムアウトで止めたりした場合は、次のコマンドで新しいシェルを起動する
+    """
+
+    def __init__(
+        self,
+        cwd: str | None = None,
+        output_limit: int = COMMAND_OUTPUT_LIMIT,
+        forward_output: bool = True,
+    ):
+        self.cwd = cwd
+        self.output_limit = output_limit
+        self.forward_output = forward_output
+        self.restarts = 0
+        self._started = False
+        self._process: subprocess.Popen | None = None
+        self._chunks: queue.Queue[bytes | None] = queue.Queue()
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._kill()
+
+    def run(
+        self, command: str, cwd: str | None = None, timeout: float = COMMAND_TIMEOUT
+    ) -> CommandResult:
+        """
+        params:
+            command: 実行するコマンド
+            cwd: 指定した場合は実行前にcdする。このcdは以降のコマンドにも引き継がれる
+            timeout: これを超えたらシェルごと強制終了する（秒）
+        returns:
+            実行結果
+        """
+        with self._lock:
+            if self._process is not None and self._process.poll() is not None:
+                self._process = None
+            if self._process is None:
+                self._start()
+            assert self._process is not None and self._process.stdin is not None
+
+            marker = f"__HOSTSELF_DONE_{uuid.uuid4().hex}__"
+            # evalに渡すことで、引用符の閉じ忘れなどがあってもシェルが入力待ちにならない
+            script = f"eval {shlex.quote(command)} < /dev/null"
+            if cwd:
+                script = f"cd -- {shlex.quote(cwd)} && {script}"
+            script += f"\nprintf '\\n{marker} %s\\n' \"$?\"\n"
+
+            start = time.perf_counter()
+            self._process.stdin.write(script.encode())
+            self._process.stdin.flush()
+            return self._collect(marker.encode(), start, timeout)
+
+    def _start(self):
+        if self._started:
+            self.restarts += 1
+        self._started = True
+        self._process = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        self._chunks = queue.Queue()
+        threading.Thread(
+            target=self._pump, args=(self._process, self._chunks), daemon=True
+        ).start()
+
+    @staticmethod
+    def _pump(process: subprocess.Popen, chunks: "queue.Queue[bytes | None]"):
+        assert process.stdout is not None
+        while chunk := process.stdout.read1(65536):
+            chunks.put(chunk)
+        chunks.put(None)
+
+    def _kill(self):
+        if self._process is None:
+            return
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._process.wait()
+        self._process = None
+
+    def _collect(self, marker: bytes, start: float, timeout: float) -> CommandResult:
+        buffer = HeadTailBuffer(self.output_limit)
+        pending = bytearray()
+        # 終了マーカーがチャンクの境目で分かれても見つけられるように、末尾は残しておく
+        keep = len(marker) + 16
+        deadline = start + timeout
+        exit_code = None
+        note = ""
+
+        while True:
+            try:
+                chunk = self._chunks.get(
+                    timeout=max(0.0, deadline - time.perf_counter())
+                )
+            except queue.Empty:
+                self._kill()
+                self._emit(buffer, pending)
+                return CommandResult(
+                    output=buffer.getvalue() + "\n[shell session was restarted]",
+                    exit_code=None,
+                    truncated=buffer.truncated,
+                    timed_out=True,
+                    duration=time.perf_counter() - start,
+                    timeout=timeout,
+                )
+
+            if chunk is None:
+                # exitなどでシェル自体が終了した
+                assert self._process is not None
+                exit_code = self._process.wait()
+                self._process = None
+                note = "\n[shell exited; a new session will be started]"
+                break
+
+            pending += chunk
+            index = pending.find(b"\n" + marker + b" ")
+            if index >= 0:
+                line_end = pending.find(b"\n", index + 1 + len(marker))
+                if line_end < 0:
+                    continue
+                exit_code = int(pending[index + 1 + len(marker) : line_end])
+                del pending[index:]
+                break
+            if len(pending) > keep:
+                self._emit(buffer, pending[:-keep])
+                del pending[:-keep]
+
+        self._emit(buffer, pending)
+        return CommandResult(
+            output=buffer.getvalue() + note,
+            exit_code=exit_code,
+            truncated=buffer.truncated,
+            timed_out=False,
+            duration=time.perf_counter() - start,
+        )
+
+    def _emit(self, buffer: HeadTailBuffer, data: bytes | bytearray):
+        buffer.write(bytes(data))
+        if self.forward_output:
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+
+
+_shell_session: ShellSession | None = None
+
+
+def execute_in_session(
+    command: str,
+    replace_dict: dict[str, str],
+    cwd: str | None = None,
+    timeout: float = COMMAND_TIMEOUT,
+):
+    global _shell_session
+    if _shell_session is None:
+        _shell_session = ShellSession()
+
+    for key, value in replace_dict.items():
+        command = command.replace(f"${{{key}}}", value)
+
+    try:
+        return _shell_session.run(command, cwd=cwd or None, timeout=timeout).render()
+    except (OSError, subprocess.SubprocessError, TimeoutError) as e:
+        return f"Error executing command:\n{e}"
+    finally:
+        if not is_read_only_command(command):
+            files_may_have_changed()
 
 
 def fetch_issue(
@@ -54,16 +536,14 @@ def fetch_issue(
             # Not Implemented Yet
             raise NotImplementedError("GitHub is not implemented yet")
         case "forgejo":
-            FORGEJO_PAT = os.environ["FORGEJO_TOKEN"]
-
-            # リクエストヘッダーの設定
-            headers = {"Authorization": f"token {FORGEJO_PAT}"}
-
             # APIエンドポイントURL
             url = f"{origin}/api/v1/repos/{repository_name}/issues/{issue_id}"
 
-            # GETリクエストを送信
-            response = requests.get(url, headers=headers)
+            # GETリクエストを送信（ETagが一致すればキャッシュから返る）
+            try:
+                response = forgejo.get_client().get(url)
+            except requests.RequestException as e:
+                return f"Error fetching issue: {e}"
 
             # レスポンスをチェック
             if response.status_code == 200:
@@ -81,28 +561,245 @@ def patch_file(file_path: str, patch: str):
         file_path: パッチを適用するファイルのパス
         patch: 適用するパッチ。unified diff形式
     returns:
-        適用後のファイルの内容
+        hunkごとの適用結果
     """
 
     # パッチを適用する
     try:
-        result = subprocess.run(
-            f"patch {file_path}",
-            input=patch,
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-
-        # 標準出力と標準エラーを結合して返す
-        output = result.stdout + "\n" + result.stderr
-        return output
-    except subprocess.CalledProcessError as e:
-        return f"Error patching file:\n{e}"
-    except FileNotFoundError as e:
-        return f"File {file_path} does not exist:\n{e}"
+        result = patcher.apply_patch(patch, file_path=file_path)
     except Exception as e:
         return f"Error patching file:\n{e}"
+    code_index.notify_changed(result.changed_files)
+    if command_memo is not None and result.changed_files:
+        command_memo.invalidate()
+    return result.report
+
+
+def apply_patch(patch: str, cwd: str | None = None):
+    """
+    複数ファイルのパッチをまとめて適用する。1つでも適用できないhunkがあれば何も変更しない
+    params:
+        patch: 適用するパッチ。unified diff形式
+        cwd: パッチ内のパスの基準になるディレクトリ
+    returns:
+        hunkごとの適用結果
+    """
+    try:
+        result = patcher.apply_patch(patch, cwd=cwd)
+    except (patcher.PatchError, OSError, ValueError) as e:
+        return f"Error patching files:\n{e}"
+    code_index.notify_changed(result.changed_files)
+    if command_memo is not None and result.changed_files:
+        command_memo.invalidate()
+    return result.report
+
+
+def read_file(file_path: str, start_line: int = 1, end_line: int | None = None):
+    try:
+        return code_index.read_file(file_path, start_line, end_line)
+    except (FileNotFoundError, IsADirectoryError) as e:
+        return f"Error reading file:\n{e}"
+
+
+def search_code(
+    root: str,
+    query: str,
+    regex: bool = False,
+    ignore_case: bool = False,
+    path_glob: str | None = None,
+):
+    """
+    rootのチェックアウトをtrigram索引で検索する
+    """
+    if not Path(root).is_dir():
+        return f"Directory {root} does not exist"
+    try:
+        matches, total = code_index.get_index(root).search(
+            query, regex=regex, ignore_case=ignore_case, path_glob=path_glob
+        )
+    except re.error as e:
+        return f"Invalid regular expression:\n{e}"
+    lines = [match.render() for match in matches]
+    lines.append(f"[{total} matches, showing {len(matches)}]")
+    return "\n".join(lines)
+
+
+def find_symbol(root: str, name: str, kind: str = "definitions"):
+    """
+    rootのチェックアウトからシンボルの定義または参照を探す
+    """
+    if not Path(root).is_dir():
+        return f"Directory {root} does not exist"
+    index = code_index.get_index(root)
+    if kind == "references":
+        matches, total = index.references(name)
+    else:
+        matches = index.definitions(name)
+        total = len(matches)
+    lines = [match.render() for match in matches]
+    lines.append(f"[{total} {kind}, showing {len(matches)}]")
+    return "\n".join(lines)
+
+
+# 成功したテストの結果。HOSTSELF_TEST_CACHEがあればコンテナをまたいで使う
+test_results = impact.ResultCache(
+    Path(os.environ["HOSTSELF_TEST_CACHE"]) / "results.json"
+    if os.getenv("HOSTSELF_TEST_CACHE")
+    else None
+)
+# テストファイルを並列に実行する数の既定値
+TEST_WORKERS = int(os.getenv("HOSTSELF_TEST_WORKERS", "1"))
+_import_graphs: dict[str, impact.ImportGraph] = {}
+# 全てのテストを実行して成功した時の、リポジトリごとのファイルのハッシュ
+_full_suite_passed: dict[str, dict[str, str]] = {}
+
+
+def _import_graph(root: Path) -> impact.ImportGraph:
+    key = str(root.resolve())
+    if key not in _import_graphs:
+        _import_graphs[key] = impact.ImportGraph(root)
+    graph = _import_graphs[key]
+    graph.refresh()
+    return graph
+
+
+def run_tests(
+    root: str,
+    paths: list[str] | None = None,
+    full: bool = False,
+    framework: str = "auto",
+    workers: int = TEST_WORKERS,
+):
+    """
+    rootのリポジトリのテストを、テストファイルごとに実行する。
+    前回成功した時から依存するファイルが変わっていないテストは実行せずに前回の結果を使う
+    params:
+        root: リポジトリのルート
+        paths: 対象にするテストファイルかディレクトリ。省略すると全て
+        full: キャッシュを使わずに全てのテストを実行する
+        framework: unittest・pytest・auto
+        workers: 並列に実行するテストファイルの数
+    returns:
+        テストファイルごとの結果
+    """
+    root_path = Path(root)
+    if not root_path.is_dir():
+        return f"Directory {root} does not exist"
+    graph = _import_graph(root_path)
+    tests = graph.test_files()
+    if paths:
+        prefixes = []
+        for path in paths:
+            if Path(path).is_absolute():
+                try:
+                    path = Path(path).relative_to(root_path).as_posix()
+                except ValueError:
+                    continue
+            prefixes.append(path.removeprefix("./").strip("/"))
+        tests = [
+            test
+            for test in tests
+            if any(
+                test == prefix or test.startswith(f"{prefix}/") for prefix in prefixes
+            )
+        ]
+    if not tests:
+        return f"No test files ({', '.join(impact.TEST_FILE_PATTERNS)}) found in {root}"
+    if framework == "auto":
+        framework = impact.detect_framework(root_path)
+
+    selections = impact.select_tests(graph, test_results, framework, tests, full)
+    selected = [selection for selection in selections if selection.action == "run"]
+
+    def run_one(selection: impact.Selection) -> CommandResult:
+        result = run_command(
+            impact.command_for(framework, selection.test),
+            cwd=root,
+            forward_output=False,
+        )
+        # 5はテストが1つもなかった場合
+        if result.exit_code in (0, 5):
+            test_results.record(
+                root_path,
+                selection.test,
+                selection.key,
+                selection.hashes,
+                result.duration,
+            )
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = dict(
+                zip(
+                    [selection.test for selection in selected],
+                    executor.map(run_one, selected),
+                )
+            )
+    finally:
+        files_may_have_changed()
+
+    failed = [
+        test for test, result in results.items() if result.exit_code not in (0, 5)
+    ]
+    counts = {
+        action: sum(selection.action == action for selection in selections)
+        for action in ("run", "cached", "unaffected")
+    }
+    lines = [
+        (
+            f"{framework}: {len(selections)} test files, {counts['run']} run, "
+            f"{counts['cached']} passed before with the same files, "
+            f"{counts['unaffected']} not affected by the changes"
+        )
+    ]
+    for selection in selections:
+        changed = ""
+        if selection.changed:
+            shown = ", ".join(selection.changed[:3])
+            more = len(selection.changed) - 3
+            changed = f"; changed: {shown}" + (f" and {more} more" if more > 0 else "")
+        match selection.action:
+            case "cached":
+                lines.append(f"CACHED {selection.test}")
+            case "unaffected":
+                lines.append(f"SKIPPED {selection.test}")
+            case _:
+                result = results[selection.test]
+                status = "FAIL" if selection.test in failed else "PASS"
+                lines.append(
+                    f"{status} {selection.test} ({result.duration:.2f}s{changed})"
+                )
+    for test in failed:
+        lines.append(f"\n--- {test}\n{results[test].render()}")
+    lines.append(
+        f"{len(failed)} of {counts['run']} test files failed"
+        if failed
+        else "all selected test files passed"
+    )
+
+    if full and not paths and not failed:
+        _full_suite_passed[str(root_path.resolve())] = graph.hashes(graph.files)
+    return "\n".join(lines)
+
+
+def full_suite_failure(root: Path) -> str | None:
+    """
+    PRを作る前に、今のファイルで全てのテストを一度実行しておく
+    returns:
+        テストが失敗した場合はその結果。成功したか、テストがなければNone
+    """
+    if not root.is_dir():
+        return None
+    graph = _import_graph(root)
+    if not graph.test_files():
+        return None
+    if _full_suite_passed.get(str(root.resolve())) == graph.hashes(graph.files):
+        return None
+    report = run_tests(str(root), full=True)
+    if _full_suite_passed.get(str(root.resolve())) == graph.hashes(graph.files):
+        return None
+    return report
 
 
 def create_pull_request(
@@ -112,21 +809,23 @@ def create_pull_request(
     branch_name: str,
     title: str,
     body: str,
+    allow_failing_tests: bool = False,
 ):
     FORGEJO_USER_NAME = os.environ["FORGEJO_USER_NAME"]
+    if not allow_failing_tests:
+        report = full_suite_failure(base_dir / repository_name.split("/")[-1])
+        if report is not None:
+            return (
+                "Pull request not created because the full test suite failed. "
+                "Fix the failures, or call create_pull_request again with "
+                "allow_failing_tests=true if they also fail without your changes.\n"
+                f"{report}"
+            )
     match repository_type:
         case "github":
             # Not Implemented Yet
             raise NotImplementedError("GitHub is not implemented yet")
         case "forgejo":
-            FORGEJO_PAT = os.environ["FORGEJO_TOKEN"]
-
-            # リクエストヘッダーの設定
-            headers = {
-                "Authorization": f"token {FORGEJO_PAT}",
-                "Content-Type": "application/json",
-            }
-
             # リクエストボディの設定
             payload = {
                 "base": "main",
@@ -139,7 +838,10 @@ def create_pull_request(
             url = f"{origin}/api/v1/repos/{repository_name}/pulls"
 
             # POSTリクエストを送信
-            response = requests.post(url, headers=headers, json=payload)
+            try:
+                response = forgejo.get_client().post(url, payload)
+            except requests.RequestException as e:
+                return f"Error creating PR: {e}"
 
             # レスポンスをチェック
             if response.status_code >= 200 and response.status_code < 300:
@@ -150,238 +852,1536 @@ def create_pull_request(
             raise ValueError(f"Unknown repository type {repository_type}")
 
 
-if __name__ == "__main__":
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("issue_str", type=str)
-    args = argparser.parse_args()
+# 作業ツリーを変更しないので、同じターンの他の呼び出しと並列に実行してよいツール
+PARALLEL_SAFE_TOOLS = {"fetch_issue", "read_file", "search_code", "find_symbol"}
+# 読み取り専用とみなすコマンド
+READ_ONLY_COMMANDS = {
+    "cat",
+    "cmp",
+    "diff",
+    "du",
+    "echo",
+    "egrep",
+    "file",
+    "find",
+    "grep",
+    "head",
+    "ls",
+    "pwd",
+    "rg",
+    "stat",
+    "tail",
+    "tree",
+    "wc",
+    "which",
+}
+READ_ONLY_GIT_SUBCOMMANDS = {
+    "blame",
+    "cat-file",
+    "describe",
+    "diff",
+    "grep",
+    "log",
+    "ls-files",
+    "ls-tree",
+    "rev-parse",
+    "shortlog",
+    "show",
+    "status",
+}
+# 読み取りだけのコマンドのうち、ファイルに書き込んだり任意のコマンドを実行したりするオプション。
+# --output=x.patch のように値を=で繋いだものも含む
+WRITE_OPTIONS = {
+    "find": {
+        "-delete",
+        "-exec",
+        "-execdir",
+        "-ok",
+        "-okdir",
+        "-fprint",
+        "-fprint0",
+        "-fprintf",
+        "-fls",
+    },
+    # -cは core.pager などの設定で任意のコマンドを実行できる
+    "git": {
+        "--output",
+        "-o",
+        "-O",
+        "--open-files-in-pager",
+        "--ext-diff",
+        "-c",
+        "--config-env",
+    },
+    "rg": {"--pre"},
+    "tree": {"-o"},
+}
+
+
+def has_write_option(program: str, words: list[str]) -> bool:
+    options = WRITE_OPTIONS.get(program, set())
+    return any(word.split("=", 1)[0] in options for word in words)
+
+
+def is_read_only_command(command: str) -> bool:
+    """
+    コマンドが作業ツリーを変更しないかを判定する。判断できないものは変更するとみなす
+    """
+    # リダイレクトやコマンド置換・プロセス置換は書き込みの可能性があるので安全側に倒す
+    if any(token in command for token in (">", "`", "$(", "<(", ">(")):
+        return False
+
+    for segment in re.split(r"&&|\|\||[;|&\n]", command):
+        try:
+            words = shlex.split(segment)
+        except ValueError:
+            return False
+        if not words:
+            continue
+
+        program = words[0]
+        if program == "git":
+            # git -C <path> status のようなオプションを読み飛ばしてサブコマンドを探す
+            rest = iter(words[1:])
+            subcommand = None
+            for word in rest:
+                if word in ("-C", "-c"):
+                    next(rest, None)
+                elif not word.startswith("-"):
+                    subcommand = word
+                    break
+            if subcommand not in READ_ONLY_GIT_SUBCOMMANDS:
+                return False
+        elif program not in READ_ONLY_COMMANDS:
+            return False
+        if has_write_option(program, words[1:]):
+            return False
+    return True
+
+
+def is_parallel_safe(name: str, arguments: dict) -> bool:
+    if name in PARALLEL_SAFE_TOOLS:
+        return True
+    if name == "execute_command":
+        return is_read_only_command(arguments["command"])
+    return False
+
+
+def run_tool(name: str, arguments: dict) -> str:
+    match name:
+        case "fetch_issue":
+            return fetch_issue(
+                arguments["repository_type"],
+                arguments["origin"],
+                arguments["repository_name"],
+                arguments["issue_id"],
+            )
+        case "patch_file":
+            return patch_file(
+                arguments["file_path"],
+                arguments["patch"],
+            )
+        case "apply_patch":
+            return apply_patch(arguments["patch"], arguments.get("cwd"))
+        case "execute_command":
+            return execute_command(
+                arguments["command"],
+                {
+                    "GH_TOKEN": os.environ["GH_TOKEN"],
+                    "FORGEJO_TOKEN": os.environ["FORGEJO_TOKEN"],
+                },
+                arguments.get("cwd"),
+                arguments.get("timeout", COMMAND_TIMEOUT),
+            )
+        case "execute_in_session":
+            return execute_in_session(
+                arguments["command"],
+                {
+                    "GH_TOKEN": os.environ["GH_TOKEN"],
+                    "FORGEJO_TOKEN": os.environ["FORGEJO_TOKEN"],
+                },
+                arguments.get("cwd"),
+                arguments.get("timeout", COMMAND_TIMEOUT),
+            )
+        case "read_file":
+            return read_file(
+                arguments["file_path"],
+                arguments.get("start_line", 1),
+                arguments.get("end_line"),
+            )
+        case "search_code":
+            return search_code(
+                arguments["root"],
+                arguments["query"],
+                arguments.get("regex", False),
+                arguments.get("ignore_case", False),
+                arguments.get("path_glob"),
+            )
+        case "find_symbol":
+            return find_symbol(
+                arguments["root"],
+                arguments["name"],
+                arguments.get("kind", "definitions"),
+            )
+        case "run_tests":
+            return run_tests(
+                arguments["root"],
+                arguments.get("paths"),
+                arguments.get("full", False),
+                arguments.get("framework", "auto"),
+                arguments.get("workers", TEST_WORKERS),
+            )
+        case "create_pull_request":
+            return create_pull_request(
+                arguments["repository_type"],
+                arguments["origin"],
+                arguments["repository_name"],
+                arguments["branch_name"],
+                arguments["title"],
+                arguments["body"],
+                arguments.get("allow_failing_tests", False),
+            )
+        case "notify_finished":
+            return arguments["message"]
+        case _:
+            raise ValueError(f"Unknown tool {name}")
+
+
+class ToolCallRunner:
+    """
+    tool callを受け取った順に実行する。
+    作業ツリーを変更しない呼び出しは続いている分をまとめて並列に実行し、
+    変更する呼び出しはそれより前の呼び出しが全て終わってから単独で実行する。
+    ストリーミング中に引数が揃った呼び出しから順に渡せるように、1つずつ受け付ける
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        on_result: Callable[[int, str], None] | None = None,
+    ):
+        self.on_result = on_result
+        self.calls: list[tuple[str, dict]] = []
+        self.contents: list[str] = []
+        self.intervals: list[tuple[float, float]] = []
+        self._futures = []
+        # 最後に受け付けた、作業ツリーを変更する呼び出し
+        self._barrier = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, name: str, arguments: dict) -> int:
+        index = len(self.calls)
+        self.calls.append((name, arguments))
+        self.contents.append("")
+        self.intervals.append((0.0, 0.0))
+        if is_parallel_safe(name, arguments):
+            waits = [self._barrier] if self._barrier is not None else []
+        else:
+            waits = list(self._futures)
+        # 待つのは先に受け付けた呼び出しだけなので、先に実行が始まっていてデッドロックしない
+        future = self._executor.submit(self._run, index, waits)
+        if not is_parallel_safe(name, arguments):
+            self._barrier = future
+        self._futures.append(future)
+        return index
+
+    def _run(self, index: int, waits: list):
+        for future in waits:
+            future.result()
+        name, arguments = self.calls[index]
+        start = time.perf_counter()
+        try:
+            self.contents[index] = run_tool(name, arguments)
+        finally:
+            self.intervals[index] = (start, time.perf_counter())
+        if self.on_result is not None:
+            self.on_result(index, self.contents[index])
+
+    def finish(self, stream_end: float | None = None) -> tuple[list[str], dict]:
+        """
+        受け付けた呼び出しが全て終わるのを待つ
+        params:
+            stream_end: モデルの応答を受け取り終えた時刻。指定すると、生成と重なった時間を求める
+        returns:
+            受け付けた順の実行結果と、ターン内の時間の内訳
+        """
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+        durations = [end - start for start, end in self.intervals]
+        # ストリーミング中は呼び出しの間に生成待ちの空きがあるので、実行中だった時間だけを数える
+        wall_seconds = busy_seconds(self.intervals)
+        sequential_seconds = sum(durations)
+        timing = {
+            "wall_seconds": round(wall_seconds, 3),
+            "sequential_seconds": round(sequential_seconds, 3),
+            "speedup": round(sequential_seconds / wall_seconds, 2)
+            if wall_seconds
+            else 1.0,
+            "tools": [
+                {"name": name, "seconds": round(duration, 3)}
+                for (name, _), duration in zip(self.calls, durations)
+            ],
+        }
+        if stream_end is not None:
+            timing["overlap_seconds"] = round(
+                busy_seconds(self.intervals, stream_end), 3
+            )
+        return self.contents, timing
+
+
+def busy_seconds(
+    intervals: list[tuple[float, float]], until: float = float("inf")
+) -> float:
+    """
+    いずれかのtool callが実行中だった時間のうち、untilより前の部分の長さ
+    """
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        end = min(end, until)
+        if start >= end:
+            continue
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class ToolTurn:
+    """
+    1ステップ分のtool callの実行状態。完了した呼び出しの結果をtool_resultsに記録し、
+    アシスタントのメッセージを保存した後（saved）は、そのたびにon_resultを呼ぶ
+    params:
+        tool_results: 完了したtool callのidごとの結果
+        lock: tool_resultsとsavedを守るロック
+        on_result: tool_resultsと、完了した呼び出しが作業ツリーを変更しうるかを受け取る
+    """
+
+    def __init__(
+        self,
+        tool_results: dict[str, str],
+        lock: threading.Lock,
+        on_result: Callable[[dict[str, str], bool], None],
+    ):
+        self.tool_results = tool_results
+        self.lock = lock
+        self.on_result = on_result
+        self.saved = False
+        # 実行したtool callのid。runnerの位置と対応する
+        self.dispatched: list[str] = []
+        # 小さいモデルの応答は捨てるかもしれないので、作業ツリーを変更する呼び出しは
+        # 応答を受け取り終えるまで実行しない
+        self.deferred: list[tuple[str, str, str]] = []
+        self.runner = ToolCallRunner(on_result=self._record)
+
+    def dispatch(self, call_id: str, name: str, arguments: str):
+        self.dispatched.append(call_id)
+        self.runner.submit(name, json.loads(arguments))
+
+    def dispatch_routine(self, call_id: str, name: str, arguments: str):
+        if self.deferred or not is_parallel_safe(name, json.loads(arguments)):
+            self.deferred.append((call_id, name, arguments))
+        else:
+            self.dispatch(call_id, name, arguments)
+
+    def dispatch_deferred(self):
+        for call_id, name, arguments in self.deferred:
+            self.dispatch(call_id, name, arguments)
+        self.deferred.clear()
+
+    def discard(self):
+        """
+        応答を捨てて呼び直す時に、先に実行した読み取りだけの呼び出しの結果を捨てる
+        """
+        self.runner.finish()
+        self.runner = ToolCallRunner(on_result=self._record)
+        self.dispatched.clear()
+        self.deferred.clear()
+        with self.lock:
+            self.tool_results.clear()
+
+    def mutated(self) -> bool:
+        """
+        作業ツリーを変更しうる呼び出しが、すでに完了しているか
+        """
+        return any(
+            not is_parallel_safe(*self.runner.calls[index])
+            for index, call_id in enumerate(self.dispatched)
+            if call_id in self.tool_results
+        )
+
+    def _record(self, index: int, content: str):
+        with self.lock:
+            self.tool_results[self.dispatched[index]] = content
+            if self.saved:
+                self.on_result(
+                    self.tool_results, not is_parallel_safe(*self.runner.calls[index])
+                )
+
+
+def run_tool_calls(
+    tool_calls,
+    max_workers: int = 8,
+    on_result: Callable[[int, str], None] | None = None,
+) -> tuple[list[str], dict]:
+    """
+    1ターン分のtool callをまとめて実行する
+    params:
+        tool_calls: アシスタントのメッセージのtool_calls
+        max_workers: 並列に実行する呼び出しの最大数
+        on_result: 呼び出しが1つ終わるごとに、その位置と結果を渡して呼ぶ関数
+    returns:
+        tool_callsと同じ順序の実行結果と、ターン内の時間の内訳
+    """
+    calls = [
+        (tool.function.name, json.loads(tool.function.arguments)) for tool in tool_calls
+    ]
+    runner = ToolCallRunner(max_workers, on_result)
+    for name, arguments in calls:
+        runner.submit(name, arguments)
+    return runner.finish()
+
+
+def create_with_retries(
+    create: Callable[[], object],
+    limiter,
+    tokens: int,
+    max_attempts: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+) -> tuple[object, str | None, dict]:
+    """
+    レート制限の枠を取ってからモデルを呼ぶ。429と一時的なエラーは、
+    Retry-Afterを守りつつジッター付きの指数バックオフで再試行する
+    params:
+        create: chat.completions.createを呼ぶ関数
+        limiter: RateLimiterかBrokerClient。Noneなら制限しない
+        tokens: このリクエストで使うトークン数の見積もり
+    returns:
+        createの戻り値、応答を受け取り終えたらlimiter.releaseに渡すlease、待ち時間の内訳
+    """
+    stats = {"attempts": 0, "rate_limited": 0, "queued_seconds": 0.0}
+    for attempt in range(max_attempts):
+        stats["attempts"] += 1
+        start = time.perf_counter()
+        lease = limiter.acquire(tokens) if limiter is not None else None
+        stats["queued_seconds"] += time.perf_counter() - start
+        try:
+            return create(), lease, stats
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            status_code = getattr(e, "status_code", None)
+            retryable = status_code is None or status_code in RETRY_STATUSES
+            headers = (
+                e.response.headers if isinstance(e, openai.APIStatusError) else None
+            )
+            retry_after = ratelimit.retry_after_seconds(headers)
+            if limiter is not None:
+                limiter.release(
+                    lease,
+                    status="rate_limited" if status_code == 429 else "error",
+                    retry_after=retry_after,
+                )
+            if status_code == 429:
+                stats["rate_limited"] += 1
+            if not retryable or attempt == max_attempts - 1:
+                raise
+            delay = ratelimit.backoff_delay(attempt, retry_after, base_delay, max_delay)
+            print(f"model call failed ({e}), retrying in {delay:.1f}s", flush=True)
+            time.sleep(delay)
+            stats["queued_seconds"] += delay
+    raise AssertionError("unreachable")
+
+
+# ツールの出力のうち、失敗を表すもの
+TOOL_FAILURE_PATTERN = re.compile(
+    r"^\[(exit code (?!0\b)-?\d+|timed out)[,;]"
+    r"|^Error (executing command|patching|creating PR)"
+    r"|^patch not applied"
+    r"|^Pull request not created",
+    re.MULTILINE,
+)
+
+
+def tool_failed(content: str) -> bool:
+    """
+    ツールの出力が、コマンドの失敗・タイムアウト・パッチの失敗・PRの作成の失敗を表しているか
+    """
+    return TOOL_FAILURE_PATTERN.search(content) is not None
+
+
+def last_tool_outputs(messages: list) -> list[str]:
+    """
+    最後のアシスタントのメッセージより後にある、ツールの出力
+    """
+    outputs = []
+    for message in reversed(messages):
+        role = message["role"] if isinstance(message, dict) else message.role
+        if role != "tool":
+            break
+        outputs.append(message["content"])
+    return outputs[::-1]
 
-    issue_str = str(args.issue_str)
 
-    tools = [
+@dataclass
+class Route:
+    tier: Literal["small", "large"]
+    model: str
+    # このモデルを選んだ理由。トレースに記録する
+    reason: str
+
+
+@dataclass
+class RoutingPolicy:
+    """
+    ステップごとに使うモデルを決める。
+    計画（最初のステップ）・失敗したツールの出力の分析には大きいモデルを、それ以外には小さいモデルを使う。
+    小さいモデルがパッチなどescalate_toolsを呼ぼうとしたら、その応答は捨てて大きいモデルで呼び直す
+    """
+
+    large_model: str = OPENAI_MODEL
+    # Noneなら常に大きいモデルを使う
+    small_model: str | None = OPENAI_SMALL_MODEL
+    # 最初の何ステップを計画として大きいモデルに任せるか
+    planning_steps: int = 1
+    # 直前のターンにツールの失敗があれば大きいモデルを使う
+    escalate_on_failure: bool = True
+    # 小さいモデルには書かせないツール
+    escalate_tools: tuple[str, ...] = (
+        "patch_file",
+        "apply_patch",
+        "create_pull_request",
+    )
+
+    @classmethod
+    def from_json(cls, text: str | None) -> "RoutingPolicy":
+        """
+        params:
+            text: 既定値を上書きするフィールドのJSON。空なら既定値
+        raises:
+            ValueError: 知らないフィールドがある
+        """
+        overrides = json.loads(text) if text else {}
+        unknown = set(overrides) - set(cls.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"unknown routing fields: {', '.join(sorted(unknown))}")
+        if "escalate_tools" in overrides:
+            overrides["escalate_tools"] = tuple(overrides["escalate_tools"])
+        return cls(**overrides)
+
+    def choose(self, step: int, messages: list) -> Route:
+        """
+        params:
+            step: これから行うモデル呼び出しが何回目か
+            messages: これまでの会話
+        """
+        if not self.small_model:
+            return Route("large", self.large_model, "single")
+        if step <= self.planning_steps:
+            return Route("large", self.large_model, "planning")
+        if self.escalate_on_failure and any(
+            tool_failed(content) for content in last_tool_outputs(messages)
+        ):
+            return Route("large", self.large_model, "failure")
+        return Route("small", self.small_model, "routine")
+
+    def escalation(self, route: Route, tool_names: list[str]) -> Route | None:
+        """
+        小さいモデルの応答を捨てて、大きいモデルで呼び直すべきか
+        returns:
+            呼び直すときのRoute。そのまま使うならNone
+        """
+        if route.tier != "small":
+            return None
+        if any(name in self.escalate_tools for name in tool_names):
+            return Route("large", self.large_model, "escalated")
+        return None
+
+
+def arguments_complete(arguments: str) -> bool:
+    # JSONのオブジェクトが閉じた時点で、その呼び出しの引数は揃っている
+    if not arguments.rstrip().endswith("}"):
+        return False
+    try:
+        json.loads(arguments)
+    except json.JSONDecodeError:
+        return False
+    return True
+
+
+def consume_stream(
+    chunks,
+    on_tool_call: Callable[[str, str, str], None] | None = None,
+    on_content: Callable[[str], None] | None = None,
+) -> tuple[openai.types.chat.ChatCompletion, dict]:
+    """
+    ストリーミングの応答を組み立てる。
+    tool callは引数のJSONが揃った（か次の呼び出しが始まった）ものから順にon_tool_callに渡す
+    params:
+        chunks: stream=Trueのchat.completions.createの戻り値
+        on_tool_call: tool callのid・名前・引数の文字列を受け取る関数
+        on_content: 本文の差分を受け取る関数
+    returns:
+        ストリーミングしない場合と同じ形の応答と、最初のチャンクまでの時間などの内訳
+    """
+    start = time.perf_counter()
+    first_chunk = None
+    completion = {"id": "", "created": 0, "model": ""}
+    content: list[str] = []
+    calls: list[dict] = []
+    dispatched = 0
+    finish_reason = None
+    usage = None
+
+    def dispatch(ready: int):
+        nonlocal dispatched
+        while dispatched < ready:
+            call = calls[dispatched]
+            dispatched += 1
+            if on_tool_call is not None:
+                on_tool_call(call["id"], call["name"], call["arguments"])
+
+    for chunk in chunks:
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start
+        completion = {"id": chunk.id, "created": chunk.created, "model": chunk.model}
+        if chunk.usage is not None:
+            usage = chunk.usage
+        for choice in chunk.choices:
+            delta = choice.delta
+            if delta.content:
+                content.append(delta.content)
+                if on_content is not None:
+                    on_content(delta.content)
+            for tool_delta in delta.tool_calls or []:
+                while len(calls) <= tool_delta.index:
+                    calls.append({"id": "", "name": "", "arguments": ""})
+                call = calls[tool_delta.index]
+                call["id"] = tool_delta.id or call["id"]
+                if tool_delta.function is not None:
+                    call["name"] += tool_delta.function.name or ""
+                    call["arguments"] += tool_delta.function.arguments or ""
+                # 新しい呼び出しが始まったら、それより前の呼び出しは揃っている
+                ready = tool_delta.index
+                if arguments_complete(call["arguments"]):
+                    ready = tool_delta.index + 1
+                dispatch(max(ready, dispatched))
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+    dispatch(len(calls))
+    stream_seconds = time.perf_counter() - start
+
+    message = {"role": "assistant", "content": "".join(content) or None}
+    if calls:
+        message["tool_calls"] = [
+            {
+                "id": call["id"],
+                "type": "function",
+                "function": {"name": call["name"], "arguments": call["arguments"]},
+            }
+            for call in calls
+        ]
+    response = openai.types.chat.ChatCompletion.model_validate(
         {
-            "type": "function",
-            "function": {
-                "name": "fetch_issue",
-                "description": "fetch the issue from the given url",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "repository_type": {
-                            "type": "string",
-                            "description": "the type of the repository",
-                            "enum": ["github", "forgejo"],
-                        },
-                        "origin": {
-                            "type": "string",
-                            "description": "the origin of the Issue URL. e.g. https://github.com, https://host.docker.internal:3000",
-                        },
-                        "repository_name": {
-                            "type": "string",
-                            "description": "the repository name. e.g. owner/repo",
-                        },
-                        "issue_id": {
-                            "type": "string",
-                            "description": "the issue id",
-                        },
-                    },
-                    "required": [
-                        "repository_type",
-                        "origin",
-                        "repository_name",
-                        "issue_id",
+            **completion,
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": finish_reason or "stop",
+                }
+            ],
+            "usage": usage.model_dump() if usage is not None else None,
+        }
+    )
+    timing = {
+        "ttfb_seconds": round(
+            first_chunk if first_chunk is not None else stream_seconds, 3
+        ),
+        "stream_seconds": round(stream_seconds, 3),
+    }
+    return response, timing
+
+
+# 事前取得するissueの数と、1件のコメントに含める最大文字数
+PREFETCH_MAX_ISSUES = 3
+PREFETCH_COMMENT_CHARS = 2000
+
+
+def prefetch_issue_context(issue_str: str) -> tuple[str, dict]:
+    """
+    issue_strに含まれるForgejoのissueについて、issue本体・コメント・関連PR・
+    リポジトリの情報・トップレベルのファイル一覧を並列に取得して、最初のメッセージ用にまとめる
+    params:
+        issue_str: ユーザーの指示
+    returns:
+        メッセージに追加するテキスト（issueがなければ空文字）と、取得にかかった時間の内訳
+    """
+    issues = forgejo.find_issue_urls(issue_str)[:PREFETCH_MAX_ISSUES]
+    if not issues:
+        return "", {}
+
+    urls = {}
+    for origin, repository, issue_id in issues:
+        api = f"{origin}/api/v1/repos/{repository}"
+        issue_api = f"{api}/issues/{issue_id}"
+        urls[(origin, repository, issue_id)] = {
+            "issue": issue_api,
+            "comments": f"{issue_api}/comments",
+            "timeline": f"{issue_api}/timeline",
+            "repository": api,
+            "contents": f"{api}/contents",
+        }
+
+    def timed_get(url: str) -> tuple[dict | list | None, float]:
+        start = time.perf_counter()
+        try:
+            response = forgejo.get_client().get(url)
+            data = json.loads(response.text) if response.status_code == 200 else None
+        except (requests.RequestException, json.JSONDecodeError):
+            data = None
+        return data, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {
+            (key, name): executor.submit(timed_get, url)
+            for key, named_urls in urls.items()
+            for name, url in named_urls.items()
+        }
+        results = {key: future.result() for key, future in futures.items()}
+    wall_seconds = time.perf_counter() - start
+
+    sections = [
+        _format_issue_context(key, {name: results[(key, name)][0] for name in names})
+        for key, names in urls.items()
+    ]
+    sequential_seconds = sum(duration for _, duration in results.values())
+    metrics = {
+        "issues": len(issues),
+        "requests": len(results),
+        "failed_requests": sum(1 for data, _ in results.values() if data is None),
+        "wall_seconds": round(wall_seconds, 3),
+        "sequential_seconds": round(sequential_seconds, 3),
+        "saved_seconds": round(sequential_seconds - wall_seconds, 3),
+    }
+    return "\n\n".join(sections), metrics
+
+
+def _format_issue_context(key: tuple[str, str, str], data: dict) -> str:
+    origin, repository, issue_id = key
+    lines = [f"### {origin}/{repository}/issues/{issue_id}"]
+
+    issue = data["issue"]
+    if issue is None:
+        lines.append("- issueを取得できませんでした")
+    else:
+        labels = ", ".join(label["name"] for label in issue.get("labels") or [])
+        lines += [
+            f"- title: {issue.get('title')}",
+            f"- state: {issue.get('state')}",
+            f"- labels: {labels or '(なし)'}",
+        ]
+
+    repo = data["repository"]
+    if repo is not None:
+        lines += [
+            f"- default branch: {repo.get('default_branch')}",
+            f"- clone url: {repo.get('clone_url')}",
+        ]
+
+    contents = data["contents"]
+    if isinstance(contents, list):
+        entries = [
+            entry["name"] + ("/" if entry.get("type") == "dir" else "")
+            for entry in contents
+        ]
+        lines.append(f"- top-level files: {', '.join(entries)}")
+
+    pulls = {}
+    for event in data["timeline"] or []:
+        ref = event.get("ref_issue")
+        if ref and ref.get("pull_request") is not None:
+            pulls[ref["number"]] = (
+                f"#{ref['number']} {ref.get('title')} ({ref.get('state')})"
+            )
+    if pulls:
+        lines.append(f"- linked pull requests: {'; '.join(pulls.values())}")
+
+    if issue is not None:
+        lines += ["", "本文:", issue.get("body") or "(なし)"]
+
+    comments = data["comments"] or []
+    if comments:
+        lines += ["", "コメント:"]
+        for comment in comments:
+            author = (comment.get("user") or {}).get("login")
+            body = (comment.get("body") or "")[:PREFETCH_COMMENT_CHARS]
+            lines.append(f"- {author} ({comment.get('created_at')}): {body}")
+    return "\n".join(lines)
+
+
+# ホストのミラーキャッシュが読み取り専用でマウントされる場所
+MIRROR_ROOT = Path(os.getenv("HOSTSELF_MIRROR_ROOT", "/mirrors"))
+
+
+def clone_from_mirrors(issue_str: str, workspace: Path = base_dir) -> tuple[str, list]:
+    """
+    issueのリポジトリのミラーがマウントされていれば、そこからネットワークを使わずにcloneし、
+    originを本来のURLに向けて、FORGEJO_TOKENで認証するように設定しておく
+    params:
+        issue_str: ユーザーの指示
+        workspace: cloneする先のディレクトリ
+    returns:
+        メッセージに追加するテキスト（cloneしたものがなければ空文字）と、リポジトリごとの準備時間
+    """
+    lines = []
+    stats = []
+    repositories = []
+    for origin, repository, _ in forgejo.find_issue_urls(issue_str):
+        if (origin, repository) not in repositories:
+            repositories.append((origin, repository))
+
+    for origin, repository in repositories:
+        mirror = MIRROR_ROOT / forgejo.mirror_key(origin, repository)
+        if not (mirror / "HEAD").exists():
+            continue
+
+        start = time.perf_counter()
+        destination = workspace / repository.split("/")[1]
+        status = "exists"
+        if not destination.exists():
+            # --sharedでミラーのオブジェクトを参照するので、オブジェクトのコピーも発生しない
+            subprocess.run(
+                ["git", "clone", "--shared", "--quiet", str(mirror), str(destination)],
+                check=True,
+                capture_output=True,
+            )
+            subprocess.run(
+                [
+                    "git",
+                    "-C",
+                    str(destination),
+                    "remote",
+                    "set-url",
+                    "origin",
+                    f"{origin}/{repository}.git",
+                ],
+                check=True,
+                capture_output=True,
+            )
+            token = os.getenv("FORGEJO_TOKEN")
+            if token:
+                # モデルがトークン入りのURLを使わなくてもpushできるように、
+                # originへのリクエストにだけ認証ヘッダーを付ける（stdinがないので入力は求められない）
+                subprocess.run(
+                    [
+                        "git",
+                        "-C",
+                        str(destination),
+                        "config",
+                        f"http.{origin}/.extraHeader",
+                        f"Authorization: token {token}",
                     ],
+                    check=True,
+                    capture_output=True,
+                )
+            status = "cloned"
+
+        lines.append(f"- {origin}/{repository}.git: {destination}")
+        stats.append(
+            {
+                "repository": repository,
+                "status": status,
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+        )
+    return "\n".join(lines), stats
+
+
+def wait_for_job(job_dir: str, poll_interval: float = 0.1) -> str:
+    """
+    warm pool用。importなどの初期化を済ませた状態でジョブが置かれるのを待つ
+    params:
+        job_dir: ホストがjob.jsonを置くディレクトリ
+        poll_interval: job.jsonの有無を確認する間隔（秒）
+    returns:
+        ジョブのissue_str
+    """
+    job_path = Path(job_dir) / "job.json"
+    (Path(job_dir) / "ready").touch()
+    while not job_path.exists():
+        time.sleep(poll_interval)
+
+    job = json.loads(job_path.read_text())
+    job_path.unlink()
+    return job["issue_str"]
+
+
+# systemメッセージとツールの定義は全ての実行で同じバイト列にして、
+# プロバイダーのプロンプトキャッシュが効くようにする。issueごとに変わる内容はユーザーメッセージに入れる
+SYSTEM_PROMPT = """\
+You are a helpful assistant.
+
+ユーザーメッセージの指示を遂行してください。
+遂行にあたっては現在の状態と指示の内容をまず確認し、その差分を埋めるように順番に作業してください。
+作業が終わったら、本当に作業が終わっているかを確認してください。作業が終わっているかの確認とは最低でも以下の2点が担保されていることを指します。状況に応じて他に確認すべきことがあればそれも併せて実行してください。
+    * 改めて指示文の内容を読んで、現在の状態と指示の内容の間の差分がないか振り返ること
+    * 修正の量が最小限であるかを見直すこと
+    * unittestがある場合はそれを実行して全てパスすること
+本当に終わってたら終了の通知を出してください
+
+* execute_commandのコマンドはdocker上で動いているpythonのsubprocess.run()で実行されます。そのため、cdは使わないでください
+    * cdや環境変数を次のコマンドに引き継ぎたい場合はexecute_in_sessionを使ってください
+* ファイルの閲覧や検索には、catやgrepの代わりにread_file・search_code・find_symbolを使ってください
+* Pythonのテストはexecute_commandの代わりにrun_testsで実行してください。変更の影響を受けるテストだけが実行されます
+* urlが与えられた場合はまずそのurlを開いてください
+    * 事前に取得したissueの情報がある場合は、それを開いた結果として使ってください
+* issueに対応するためのブランチが必要な場合、新しく作ってください
+* コミットする際は[AI]というプレフィックスをつけ、その後にconventional commitの形式でコミットメッセージを書いてください
+    * 例: [AI] feat: add new feature
+"""
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_issue",
+            "description": "fetch the issue from the given url",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "repository_type": {
+                        "type": "string",
+                        "description": "the type of the repository",
+                        "enum": ["github", "forgejo"],
+                    },
+                    "origin": {
+                        "type": "string",
+                        "description": "the origin of the Issue URL. e.g. https://github.com, https://host.docker.internal:3000",
+                    },
+                    "repository_name": {
+                        "type": "string",
+                        "description": "the repository name. e.g. owner/repo",
+                    },
+                    "issue_id": {
+                        "type": "string",
+                        "description": "the issue id",
+                    },
                 },
+                "required": [
+                    "repository_type",
+                    "origin",
+                    "repository_name",
+                    "issue_id",
+                ],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "patch_file",
-                "description": "patch the file with the given unified diff patch. returns the patched file content",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "file_path": {
-                            "type": "string",
-                            "description": "the path to the file to patch",
-                        },
-                        "patch": {
-                            "type": "string",
-                            "description": "the patch to apply. unified diff format",
-                        },
-                    },
-                    "required": ["file_path", "patch"],
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "patch_file",
+            "description": "patch the file with the given unified diff patch. returns a per-hunk report",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "file_path": {
+                        "type": "string",
+                        "description": "the path to the file to patch",
+                    },
+                    "patch": {
+                        "type": "string",
+                        "description": "the patch to apply. unified diff format",
+                    },
                 },
+                "required": ["file_path", "patch"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "execute_command",
-                "description": """
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "apply_patch",
+            "description": """
+apply a unified diff that may touch several files, in one call.
+* paths in the ---/+++ headers are relative to cwd. a/ and b/ prefixes are stripped.
+* use /dev/null as the old path to create a file, and as the new path to delete one.
+* hunks are relocated by their context if line numbers are off.
+* either every hunk is applied or no file is changed. returns a per-hunk report.
+""".strip(),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "patch": {
+                        "type": "string",
+                        "description": "the patch to apply. unified diff format",
+                    },
+                    "cwd": {
+                        "type": "string",
+                        "description": "the directory the paths in the patch are relative to",
+                    },
+                },
+                "required": ["patch"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_command",
+            "description": """
 execute a command in a shell.
 * Don't do sudo, since it will be executed inside docker container.
 * use cwd parameter instead of cd command, since it will be executed in a new shell.
+* long outputs are truncated to their head and tail, and commands are killed after the timeout.
 * ${GH_TOKEN}, ${FORGEJO_TOKEN}, ${GITLAB_TOKEN} will be replaced with the actual token.
-    * they are corresponding to GitHub, ForgeJo, and GitLab tokens.
-    * so, when you want to push to GitHub, you can use https url with ${GH_TOKEN}
-    """.strip(),
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "command": {
-                            "type": "string",
-                            "description": "the command to execute",
-                        },
-                        "cwd": {
-                            "type": "string",
-                            "description": "the working directory",
-                        },
-                    },
-                    "required": ["command"],
+* they are corresponding to GitHub, ForgeJo, and GitLab tokens.
+* so, when you want to push to GitHub, you can use https url with ${GH_TOKEN}
+""".strip(),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "description": "the command to execute",
+                    },
+                    "cwd": {
+                        "type": "string",
+                        "description": "the working directory",
+                    },
+                    "timeout": {
+                        "type": "number",
+                        "description": "timeout in seconds. the default is reported if a command times out",
+                    },
                 },
+                "required": ["command"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "create_pull_request",
-                "description": "create a pull request",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "repository_type": {
-                            "type": "string",
-                            "description": "the type of the repository",
-                            "enum": ["github", "forgejo"],
-                        },
-                        "origin": {
-                            "type": "string",
-                            "description": "the origin of the Issue URL. e.g. https://github.com, https://host.docker.internal:3000",
-                        },
-                        "repository_name": {
-                            "type": "string",
-                            "description": "the repository name. e.g. owner/repo",
-                        },
-                        "branch_name": {
-                            "type": "string",
-                            "description": "the branch name",
-                        },
-                        "title": {
-                            "type": "string",
-                            "description": "the title of the pull request",
-                        },
-                        "body": {
-                            "type": "string",
-                            "description": "the body of the pull request",
-                        },
-                    },
-                    "required": [
-                        "repository_type",
-                        "origin",
-                        "repository_name",
-                        "branch_name",
-                        "title",
-                        "body",
-                    ],
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_in_session",
+            "description": """
+execute a command in a persistent bash session.
+* cd, environment variables and activated virtualenvs persist between calls.
+* stdin is not available. long outputs are truncated to their head and tail.
+* ${GH_TOKEN}, ${FORGEJO_TOKEN}, ${GITLAB_TOKEN} will be replaced with the actual token.
+""".strip(),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "description": "the command to execute",
+                    },
+                    "cwd": {
+                        "type": "string",
+                        "description": "change to this directory before the command. it persists for later calls",
+                    },
+                    "timeout": {
+                        "type": "number",
+                        "description": "timeout in seconds. the session is restarted on timeout. the default is reported if a command times out",
+                    },
                 },
+                "required": ["command"],
             },
         },
-    ]
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "read_file",
+            "description": "read a range of lines from a file, with line numbers. at most 400 lines are returned per call",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "file_path": {
+                        "type": "string",
+                        "description": "the path to the file",
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "the first line to read (1-based). default 1",
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "the last line to read (inclusive). default the end of the file",
+                    },
+                },
+                "required": ["file_path"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_code",
+            "description": "search the text of all files under a repository checkout using an index. returns path:line: text for each match (at most 50)",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "root": {
+                        "type": "string",
+                        "description": "the root directory of the checkout",
+                    },
+                    "query": {
+                        "type": "string",
+                        "description": "the text to search for",
+                    },
+                    "regex": {
+                        "type": "boolean",
+                        "description": "treat query as a Python regular expression. default false",
+                    },
+                    "ignore_case": {
+                        "type": "boolean",
+                        "description": "case-insensitive search. default false",
+                    },
+                    "path_glob": {
+                        "type": "string",
+                        "description": "only search paths (relative to root) matching this glob. e.g. src/*.py",
+                    },
+                },
+                "required": ["root", "query"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_symbol",
+            "description": "find where a function, class, type or variable is defined, or where it is referenced, in a repository checkout",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "root": {
+                        "type": "string",
+                        "description": "the root directory of the checkout",
+                    },
+                    "name": {
+                        "type": "string",
+                        "description": "the symbol name",
+                    },
+                    "kind": {
+                        "type": "string",
+                        "description": "what to look for. default definitions",
+                        "enum": ["definitions", "references"],
+                    },
+                },
+                "required": ["root", "name"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "run_tests",
+            "description": "run the Python tests of a repository checkout, one process per test file. Test files whose imported files have not changed since they last passed are not run again, and before anything has passed only the tests importing files changed from upstream are run",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "root": {
+                        "type": "string",
+                        "description": "the root directory of the checkout",
+                    },
+                    "paths": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "test files or directories to limit the run to, relative to root",
+                    },
+                    "full": {
+                        "type": "boolean",
+                        "description": "run every test file without using previous results. default false",
+                    },
+                    "framework": {
+                        "type": "string",
+                        "description": "the test runner. default auto (pytest if configured, otherwise unittest)",
+                        "enum": ["auto", "unittest", "pytest"],
+                    },
+                    "workers": {
+                        "type": "integer",
+                        "description": "number of test files to run in parallel",
+                    },
+                },
+                "required": ["root"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "create_pull_request",
+            "description": "create a pull request",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "repository_type": {
+                        "type": "string",
+                        "description": "the type of the repository",
+                        "enum": ["github", "forgejo"],
+                    },
+                    "origin": {
+                        "type": "string",
+                        "description": "the origin of the Issue URL. e.g. https://github.com, https://host.docker.internal:3000",
+                    },
+                    "repository_name": {
+                        "type": "string",
+                        "description": "the repository name. e.g. owner/repo",
+                    },
+                    "branch_name": {
+                        "type": "string",
+                        "description": "the branch name",
+                    },
+                    "title": {
+                        "type": "string",
+                        "description": "the title of the pull request",
+                    },
+                    "body": {
+                        "type": "string",
+                        "description": "the body of the pull request",
+                    },
+                    "allow_failing_tests": {
+                        "type": "boolean",
+                        "description": "create the pull request even if the full test suite, which is run first, fails. only for failures that also happen without your changes",
+                    },
+                },
+                "required": [
+                    "repository_type",
+                    "origin",
+                    "repository_name",
+                    "branch_name",
+                    "title",
+                    "body",
+                ],
+            },
+        },
+    },
+]
 
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {
-            "role": "user",
-            "content": f"""
-以下の指示を遂行してください。
-遂行にあたっては現在の状態と指示の内容をまず確認し、その差分を埋めるように順番に作業してください。
-作業が終わったら、本当に作業が終わっているかを確認してください。作業が終わっているかの確認とは最低でも以下の2点が担保されていることを指します。状況に応じて他に確認すべきことがあればそれも併せて実行してください。
-    * 改めて指示文の内容を読んで、現在の状態と指示の内容の間の差分がないか振り返ること
-    * 修正の量が最小限であるかを見直すこと
-    * unittestがある場合はそれを実行して全てパスすること
-本当に終わってたら終了の通知を出してください
 
-* 全てのコマンドはdocker上で動いているpythonのsubprocess.run()で実行されます。そのため、cdは使わないでください
-* urlが与えられた場合はまずそのurlを開いてください
-* issueに対応するためのブランチが必要な場合、新しく作ってください
-* コミットする際は[AI]というプレフィックスをつけ、その後にconventional commitの形式でコミットメッセージを書いてください
-    * 例: [AI] feat: add new feature
+def prompt_prefix_hash() -> str:
+    """
+    キャッシュされるプロンプトの先頭（ツールの定義とsystemメッセージ）のハッシュ。
+    実行ごとに記録して、先頭が変わっていないかを確かめる
+    """
+    data = json.dumps({"tools": TOOLS, "system": SYSTEM_PROMPT}, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
 
-#### 指示
-{issue_str}
-    """,
-        },
-    ]
 
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("issue_str", type=str, nargs="?")
+    argparser.add_argument(
+        "--wait-job", help="Wait for a job file in this directory (warm pool mode)"
+    )
+    argparser.add_argument(
+        "--token-budget",
+        type=int,
+        default=60000,
+        help="Estimated token budget for the messages sent on each call",
+    )
+    argparser.add_argument(
+        "--tool-output-dir",
+        help="Directory to keep the full text of compacted tool outputs "
+        "(default: tool_outputs, or inside the checkpoint when checkpointing)",
+    )
+    argparser.add_argument(
+        "--trace-dir",
+        default=os.getenv("HOSTSELF_TRACE_DIR"),
+        help="Directory to write a JSONL trace of model and tool calls",
+    )
+    argparser.add_argument(
+        "--checkpoint-dir",
+        default=os.getenv("HOSTSELF_CHECKPOINT_DIR"),
+        help="Directory to save a checkpoint of the run after every step",
+    )
+    argparser.add_argument("--run-id", help="ID of this run (default: generated)")
+    argparser.add_argument(
+        "--routing",
+        default=os.getenv("HOSTSELF_ROUTING"),
+        help="JSON overriding the RoutingPolicy fields, "
+        'e.g. {"small_model": null} to always use the large model',
+    )
+    argparser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the run given by --run-id from its last checkpoint",
+    )
+    args = argparser.parse_args()
+    try:
+        routing_policy = RoutingPolicy.from_json(args.routing)
+    except ValueError as e:
+        argparser.error(f"--routing: {e}")
+
+    state = None
+    if args.resume:
+        if not (args.run_id and args.checkpoint_dir):
+            argparser.error("--resume requires --run-id and --checkpoint-dir")
+        state = checkpoint.load_checkpoint(Path(args.checkpoint_dir) / args.run_id)
+        issue_str = state["issue_str"]
+    elif args.wait_job:
+        issue_str = wait_for_job(args.wait_job)
+    elif args.issue_str is not None:
+        issue_str = str(args.issue_str)
+    else:
+        argparser.error("issue_str or --wait-job is required")
+
+    tracer = tracing.Tracer(
+        Path(args.trace_dir) if args.trace_dir else None, run_id=args.run_id
+    )
+    run_start = time.perf_counter()
+    tracer.event(
+        "run_resume" if state else "run_start",
+        model=routing_policy.large_model,
+        small_model=routing_policy.small_model,
+        issue_str=issue_str,
+        prompt_prefix=prompt_prefix_hash(),
+    )
+    # 設定されていれば、モデル呼び出しをリプレイ用に記録する
+    llm_recorder = None
+    if os.getenv("HOSTSELF_LLM_RECORD_DIR"):
+        llm_recorder = cassette.CassetteRecorder(
+            Path(os.environ["HOSTSELF_LLM_RECORD_DIR"]) / f"{tracer.run_id}.jsonl"
+        )
+
+    checkpointer = None
+    tool_output_dir = Path(args.tool_output_dir or base_dir / "tool_outputs")
+    if args.checkpoint_dir:
+        checkpoint_dir = Path(args.checkpoint_dir) / tracer.run_id
+        checkpointer = checkpoint.Checkpointer(
+            checkpoint_dir, base_dir, tree_fingerprint
+        )
+        # 縮めたツール出力の全文も、再開後に読めるようにチェックポイントに置く
+        if not args.tool_output_dir:
+            tool_output_dir = checkpoint_dir / "tool_outputs"
+        print(f"checkpoint: {checkpoint_dir} (run id {tracer.run_id})", flush=True)
+
+    prefetched = ""
+    if state is None:
+        issue_context, prefetch_metrics = prefetch_issue_context(issue_str)
+        if issue_context:
+            prefetched = f"\n#### 事前に取得したissueの情報\n{issue_context}"
+        if prefetch_metrics:
+            print(f"prefetch: {json.dumps(prefetch_metrics)}", flush=True)
+            tracer.event("prefetch", **prefetch_metrics)
+
+    cloned, clone_stats = clone_from_mirrors(issue_str)
+    if cloned:
+        prefetched += (
+            f"\n#### clone済みのリポジトリ（originとpushの認証も設定済み）\n{cloned}"
+        )
+        print(f"repository clone: {json.dumps(clone_stats)}", flush=True)
+        tracer.event("clone", repositories=clone_stats)
+
+    # 再開時に、途中で止まったターンの残りのtool callを実行するためのメッセージ
+    pending = None
+    tool_results: dict[str, str] = {}
+    if state is not None:
+        restore_stats = checkpoint.restore_workspace(checkpoint_dir, base_dir, state)
+        print(f"workspace restore: {json.dumps(restore_stats)}", flush=True)
+        tracer.event("restore", step=state["step"], repositories=restore_stats)
+        code_index.mark_all_dirty()
+        context = ConversationContext(
+            state["messages"],
+            args.token_budget,
+            tool_output_dir,
+            compacted=state["compacted"],
+        )
+        step = state["step"]
+        tool_results = state["tool_results"]
+        last = context.messages[-1]
+        if last["role"] == "assistant" and last.get("tool_calls"):
+            pending = openai.types.chat.ChatCompletionMessage.model_validate(last)
+    else:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"#### 指示\n{issue_str}\n{prefetched}"},
+        ]
+
+        context = ConversationContext(messages, args.token_budget, tool_output_dir)
+        step = 0
+
+    def save_checkpoint(tool_results: dict[str, str], snapshot: bool = True):
+        if checkpointer is None:
+            return
+        seconds = checkpointer.save(
+            issue_str,
+            step,
+            context.messages,
+            context.compacted,
+            tool_results,
+            snapshot=snapshot,
+        )
+        tracer.event(
+            "checkpoint", step=step, seconds=round(seconds, 3), snapshot=snapshot
+        )
+
+    def save_tool_result(tool_results: dict[str, str], mutated: bool):
+        # 作業ツリーを変更しうる呼び出しの後だけ、作業ツリーのスナップショットを取り直す
+        if mutated:
+            save_checkpoint(tool_results)
+        elif checkpointer is not None:
+            checkpointer.save_tool_results(step, tool_results)
+
+    results_lock = threading.Lock()
     is_finished = False
     while True:
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            tools=tools,
-        )
-        print(response)
+        turn = ToolTurn(tool_results, results_lock, save_tool_result)
+        stream_end = None
+        if pending is None:
+            step += 1
+            if command_memo is not None:
+                command_memo.step = step
+            route = routing_policy.choose(step, context.messages)
+            tokens_before, tokens_after = context.compact()
+            turn.tool_results.clear()
+            while True:
+                request = {
+                    "model": route.model,
+                    "messages": context.messages,
+                    "tools": TOOLS,
+                }
+                llm_start = time.perf_counter()
+                chunks, lease, retry_stats = create_with_retries(
+                    functools.partial(
+                        openai_client.chat.completions.create,
+                        **request,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    ),
+                    rate_limiter,
+                    tokens_after + COMPLETION_TOKENS_ESTIMATE,
+                )
+                if is_finished:
+                    on_tool_call = None
+                elif route.tier == "small":
+                    on_tool_call = turn.dispatch_routine
+                else:
+                    on_tool_call = turn.dispatch
+                # 応答を待たずに、引数が揃ったtool callから実行を始める
+                try:
+                    response, stream_timing = consume_stream(
+                        chunks,
+                        on_tool_call=on_tool_call,
+                        on_content=lambda text: print(text, end="", flush=True),
+                    )
+                except Exception:
+                    if rate_limiter is not None:
+                        rate_limiter.release(lease, status="error")
+                    raise
+                stream_end = time.perf_counter()
+                usage = tracing.usage_fields(response.usage)
+                if rate_limiter is not None:
+                    rate_limiter.release(
+                        lease, usage["prompt_tokens"] + usage["completion_tokens"]
+                    )
+                llm_latency = stream_end - llm_start
+                if llm_recorder is not None:
+                    llm_recorder.record(request, response, llm_latency)
+                escalation = routing_policy.escalation(
+                    route,
+                    [
+                        tool.function.name
+                        for tool in response.choices[0].message.tool_calls or []
+                    ],
+                )
+                tracer.llm_call(
+                    step,
+                    route.model,
+                    llm_latency,
+                    response,
+                    tier=route.tier,
+                    route=route.reason,
+                    escalated=escalation is not None,
+                    ttfb_seconds=stream_timing["ttfb_seconds"],
+                    attempts=retry_stats["attempts"],
+                    rate_limited=retry_stats["rate_limited"],
+                    queued_seconds=round(retry_stats["queued_seconds"], 3),
+                    estimated_tokens_before=tokens_before,
+                    estimated_tokens_after=tokens_after,
+                )
+                print(
+                    f"\nstep {step} ({route.model}, {route.reason}): "
+                    f"{llm_latency:.2f}s "
+                    f"(first chunk {stream_timing['ttfb_seconds']:.2f}s), "
+                    f"context tokens: estimated {tokens_before} -> {tokens_after}, "
+                    f"prompt_tokens={usage['prompt_tokens']} "
+                    f"(cached {usage['cached_tokens']}), "
+                    f"completion_tokens={usage['completion_tokens']}",
+                    flush=True,
+                )
+                if escalation is None:
+                    break
+                turn.discard()
+                route = escalation
+            turn.dispatch_deferred()
 
-        if is_finished:
-            break
+            if is_finished:
+                turn.runner.finish()
+                break
 
-        message = response.choices[0].message
-        messages.append(message)
+            message = response.choices[0].message
+            finish_reason = response.choices[0].finish_reason
+            context.append(message)
+            with results_lock:
+                # 生成中に作業ツリーを変更する呼び出しが終わっていなければ、作業ツリーは前回のまま
+                save_checkpoint(turn.tool_results, snapshot=turn.mutated())
+                turn.saved = True
+        else:
+            # 止まる前に終わっていたtool callは実行し直さない
+            message, finish_reason = pending, "tool_calls"
+            pending = None
+            route = None
+            with results_lock:
+                turn.saved = True
+            for tool in message.tool_calls:
+                if tool.id not in turn.tool_results:
+                    turn.dispatch(tool.id, tool.function.name, tool.function.arguments)
 
         if message.tool_calls is not None:
             for tool in message.tool_calls:
                 print(tool, flush=True)
 
-                name = tool.function.name
-                match name:
-                    case "fetch_issue":
-                        arguments = json.loads(tool.function.arguments)
-                        content = fetch_issue(
-                            arguments["repository_type"],
-                            arguments["origin"],
-                            arguments["repository_name"],
-                            arguments["issue_id"],
-                        )
-                    case "patch_file":
-                        arguments = json.loads(tool.function.arguments)
-                        content = patch_file(
-                            arguments["file_path"],
-                            arguments["patch"],
-                        )
-                    case "execute_command":
-                        arguments = json.loads(tool.function.arguments)
-                        content = execute_command(
-                            arguments["command"],
-                            {
-                                "GH_TOKEN": os.environ["GH_TOKEN"],
-                                "FORGEJO_TOKEN": os.environ["FORGEJO_TOKEN"],
-                            },
-                            arguments.get("cwd"),
-                        )
-                    case "create_pull_request":
-                        arguments = json.loads(tool.function.arguments)
-                        content = create_pull_request(
-                            arguments["repository_type"],
-                            arguments["origin"],
-                            arguments["repository_name"],
-                            arguments["branch_name"],
-                            arguments["title"],
-                            arguments["body"],
-                        )
-                    case "notify_finished":
-                        arguments = json.loads(tool.function.arguments)
-                        content = arguments["message"]
-                        is_finished = True
-                    case _:
-                        raise ValueError(f"Unknown tool {name}")
-
-                messages.append(
-                    {"role": "tool", "tool_call_id": tool.id, "content": content}
-                )
+            contents, timing = turn.runner.finish(stream_end)
+            for tool in message.tool_calls:
+                if tool.function.name == "notify_finished":
+                    is_finished = True
+                content = turn.tool_results[tool.id]
+                context.add_tool_output(tool.id, content)
                 print(content, flush=True)
+            print(f"tool timing: {json.dumps(timing)}", flush=True)
+            executed = [
+                next(tool for tool in message.tool_calls if tool.id == call_id)
+                for call_id in turn.dispatched
+            ]
+            failed = [tool_failed(content) for content in contents]
+            tracer.tool_calls(
+                step,
+                executed,
+                contents,
+                timing,
+                failed=failed,
+                tier=route.tier if route is not None else None,
+                failed_tools=sum(failed),
+            )
+            tool_results = {}
+            save_checkpoint(tool_results)
         else:
-            print(message.content, flush=True)
+            turn.runner.finish()
 
-        if response.choices[0].finish_reason == "stop":
+        if finish_reason == "stop":
             break
+
+    tracer.event(
+        "run_end", steps=step, wall_seconds=round(time.perf_counter() - run_start, 3)
+    )
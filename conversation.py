@@ -0,0 +1,117 @@
+from pathlib import Path
+
+# 省略した出力に残す先頭と末尾の文字数
+EXCERPT_HEAD_CHARS = 400
+EXCERPT_TAIL_CHARS = 400
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算。英数字は約4バイトで1トークン、日本語は1文字1トークン程度になる
+    """
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def message_text(message) -> str:
+    # dictのメッセージとopenaiのChatCompletionMessageの両方を扱う
+    if isinstance(message, dict):
+        content = message.get("content") or ""
+        tool_calls = message.get("tool_calls") or []
+        arguments = [call["function"]["arguments"] for call in tool_calls]
+    else:
+        content = message.content or ""
+        tool_calls = message.tool_calls or []
+        arguments = [call.function.arguments for call in tool_calls]
+    return content + "".join(arguments)
+
+
+def excerpt(text: str, path: Path) -> str:
+    omitted = len(text) - EXCERPT_HEAD_CHARS - EXCERPT_TAIL_CHARS
+    return (
+        f"{text[:EXCERPT_HEAD_CHARS]}\n"
+        f"...[{omitted}文字省略。全文は {path} にあります]...\n"
+        f"{text[-EXCERPT_TAIL_CHARS:]}"
+    )
+
+
+class ConversationContext:
+    """
+    トークン予算内にメッセージを収める。
+    最初のアシスタントの発言より前（systemと指示）と直近keep_recent件はそのまま残し、
+    それ以外の古いツール出力を先頭と末尾だけに縮める。全文はoutput_dirに保存しておく
+    """
+
+    def __init__(
+        self,
+        messages: list,
+        token_budget: int,
+        output_dir: Path,
+        keep_recent: int = 6,
+        compacted: list[int] | None = None,
+    ):
+        self.messages = messages
+        self.token_budget = token_budget
+        self.output_dir = output_dir
+        self.keep_recent = keep_recent
+        # チェックポイントから再開するときは、縮めたメッセージの位置も引き継ぐ
+        self._compacted: set[int] = set(compacted or [])
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def compacted(self) -> list[int]:
+        return sorted(self._compacted)
+
+    def append(self, message):
+        self.messages.append(message)
+
+    def add_tool_output(self, tool_call_id: str, content: str):
+        (self.output_dir / f"{tool_call_id}.txt").write_text(content)
+        self.append({"role": "tool", "tool_call_id": tool_call_id, "content": content})
+
+    def token_count(self) -> int:
+        return sum(estimate_tokens(message_text(message)) for message in self.messages)
+
+    def compact(self) -> tuple[int, int]:
+        """
+        予算を超えていれば、古いツール出力から順に縮める
+        returns:
+            縮める前と後の推定トークン数
+        """
+        before = self.token_count()
+        total = before
+        if total <= self.token_budget:
+            return before, total
+
+        for index in self._compactable_indices():
+            message = self.messages[index]
+            content = message["content"]
+            if len(content) <= EXCERPT_HEAD_CHARS + EXCERPT_TAIL_CHARS:
+                continue
+            path = self.output_dir / f"{message['tool_call_id']}.txt"
+            shortened = excerpt(content, path)
+            total += estimate_tokens(shortened) - estimate_tokens(content)
+            self.messages[index] = {**message, "content": shortened}
+            self._compacted.add(index)
+            if total <= self.token_budget:
+                break
+        return before, total
+
+    def _compactable_indices(self) -> list[int]:
+        first_assistant = next(
+            (
+                index
+                for index, message in enumerate(self.messages)
+                if _role(message) == "assistant"
+            ),
+            len(self.messages),
+        )
+        end = max(first_assistant, len(self.messages) - self.keep_recent)
+        return [
+            index
+            for index in range(first_assistant, end)
+            if _role(self.messages[index]) == "tool" and index not in self._compacted
+        ]
+
+
+def _role(message) -> str:
+    return message["role"] if isinstance(message, dict) else message.role
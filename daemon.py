@@ -0,0 +1,347 @@
+import hashlib
+import hmac
+import json
+import sqlite3
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tracing import percentile
+
+# 処理対象にするissueイベントのaction
+DEFAULT_ACTIONS = frozenset({"opened", "reopened"})
+# メトリクスのスループットとレイテンシを集計する期間（秒）
+METRICS_WINDOW = 3600
+# ジョブの失敗として扱う、runnerが送出する例外（dockerの失敗・コンテナを起動できないプールなど）
+RUNNER_ERRORS = (OSError, RuntimeError, ValueError, subprocess.SubprocessError)
+
+
+class InvalidEvent(Exception):
+    """
+    webhookのイベントに、ジョブを作るのに必要な項目がない
+    """
+
+
+@dataclass
+class Job:
+    id: int
+    repository: str
+    issue_id: str
+    issue_str: str
+    enqueued_at: float
+
+
+class JobQueue:
+    """
+    sqliteに保存する永続ジョブキュー。
+    同じリポジトリ・issueのジョブが待機中か実行中の間は、新しいイベントを重複として捨てる
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    repository TEXT NOT NULL,
+                    issue_id TEXT NOT NULL,
+                    issue_str TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    exit_code INTEGER
+                )
+                """
+            )
+            # 前回のプロセスが実行中のまま落ちたジョブはやり直す
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'"
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def enqueue(self, repository: str, issue_id: str, issue_str: str) -> int | None:
+        """
+        returns:
+            追加したジョブのid。重複で捨てた場合はNone
+        """
+        with self._lock, self._conn:
+            duplicate = self._conn.execute(
+                """
+                SELECT id FROM jobs
+                WHERE repository = ? AND issue_id = ? AND status IN ('queued', 'running')
+                """,
+                (repository, issue_id),
+            ).fetchone()
+            if duplicate is not None:
+                return None
+            cursor = self._conn.execute(
+                """
+                INSERT INTO jobs (repository, issue_id, issue_str, status, enqueued_at)
+                VALUES (?, ?, ?, 'queued', ?)
+                """,
+                (repository, issue_id, issue_str, time.time()),
+            )
+            return cursor.lastrowid
+
+    def claim(self, per_repo_limit: int) -> Job | None:
+        """
+        実行中のジョブがper_repo_limit未満のリポジトリから、最も古いジョブを取り出す
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                """
+                SELECT id, repository, issue_id, issue_str, enqueued_at FROM jobs
+                WHERE status = 'queued' AND repository NOT IN (
+                    SELECT repository FROM jobs WHERE status = 'running'
+                    GROUP BY repository HAVING COUNT(*) >= ?
+                )
+                ORDER BY id LIMIT 1
+                """,
+                (per_repo_limit,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                (time.time(), row[0]),
+            )
+            return Job(*row)
+
+    def finish(self, job_id: int, exit_code: int):
+        status = "done" if exit_code == 0 else "failed"
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, exit_code = ? WHERE id = ?",
+                (status, time.time(), exit_code, job_id),
+            )
+
+    def metrics(self, window: float = METRICS_WINDOW) -> dict:
+        since = time.time() - window
+        with self._lock:
+            counts = dict(
+                self._conn.execute(
+                    "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+                ).fetchall()
+            )
+            finished = self._conn.execute(
+                """
+                SELECT enqueued_at, started_at, finished_at FROM jobs
+                WHERE finished_at IS NOT NULL AND finished_at >= ?
+                """,
+                (since,),
+            ).fetchall()
+
+        waits = [started - enqueued for enqueued, started, _ in finished]
+        latencies = [done - enqueued for enqueued, _, done in finished]
+        return {
+            "queue_depth": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "throughput_per_hour": len(finished) * 3600 / window,
+            "wait_seconds": {
+                "p50": percentile(waits, 50),
+                "p95": percentile(waits, 95),
+            },
+            "latency_seconds": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+            },
+        }
+
+
+class Dispatcher:
+    """
+    最大max_workers個のジョブを並列に実行する。
+    同じリポジトリのジョブは同時にper_repo_limit個までしか実行しない。
+    on_start・on_finishを渡すと、ジョブの開始時と終了時（終了コードと共に）に呼ぶ
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        runner: Callable[[str], int],
+        max_workers: int,
+        per_repo_limit: int = 1,
+        poll_interval: float = 1.0,
+        on_start: Callable[[Job], None] | None = None,
+        on_finish: Callable[[Job, int], None] | None = None,
+    ):
+        self.job_queue = job_queue
+        self.runner = runner
+        self.max_workers = max_workers
+        self.per_repo_limit = per_repo_limit
+        self.poll_interval = poll_interval
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        for _ in range(self.max_workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        self.notify()
+        for thread in self._threads:
+            thread.join()
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _work(self):
+        while not self._stopped.is_set():
+            job = self.job_queue.claim(self.per_repo_limit)
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            if self.on_start is not None:
+                self.on_start(job)
+            # 想定外の例外でも、ジョブを実行中のまま残さない
+            exit_code = -1
+            try:
+                exit_code = self.runner(job.issue_str)
+            except RUNNER_ERRORS as e:
+                print(f"ジョブ{job.id}でエラーが発生しました: {e}", flush=True)
+            finally:
+                self.job_queue.finish(job.id, exit_code)
+            if self.on_finish is not None:
+                self.on_finish(job, exit_code)
+            # リポジトリの枠が空いたので、待っているワーカーを起こす
+            self.notify()
+
+
+def parse_issue_event(
+    event: str, payload: dict, actions: frozenset[str] = DEFAULT_ACTIONS
+) -> tuple[str, str, str] | None:
+    """
+    Forgejoのwebhookからジョブの内容を取り出す
+    returns:
+        (リポジトリ名, issue番号, container.pyに渡すissue_str)。対象外のイベントならNone
+    raises:
+        InvalidEvent: 対象のイベントだが、必要な項目が欠けているか型が違う
+    """
+    if not isinstance(payload, dict):
+        raise InvalidEvent("payload is not an object")
+    if event != "issues" or payload.get("action") not in actions:
+        return None
+    issue = payload.get("issue")
+    repository = payload.get("repository")
+    if not isinstance(issue, dict) or not isinstance(repository, dict):
+        raise InvalidEvent("issue and repository are required")
+    full_name = repository.get("full_name")
+    number = issue.get("number")
+    html_url = issue.get("html_url")
+    if not isinstance(full_name, str) or not isinstance(html_url, str):
+        raise InvalidEvent("repository.full_name and issue.html_url must be strings")
+    if not isinstance(number, int) or isinstance(number, bool):
+        raise InvalidEvent("issue.number must be an integer")
+    return full_name, str(number), html_url
+
+
+def verify_signature(secret: str, body: bytes, signature: str | None) -> bool:
+    if not secret:
+        return True
+    if signature is None:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def make_server(
+    address: tuple[str, int],
+    job_queue: JobQueue,
+    dispatcher: Dispatcher,
+    secret: str = "",
+) -> ThreadingHTTPServer:
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            signature = self.headers.get("X-Forgejo-Signature") or self.headers.get(
+                "X-Gitea-Signature"
+            )
+            if not verify_signature(secret, body, signature):
+                self._reply(401, {"error": "invalid signature"})
+                return
+
+            try:
+                payload = json.loads(body)
+            except json.JSONDecodeError:
+                self._reply(400, {"error": "invalid json"})
+                return
+
+            event = self.headers.get("X-Forgejo-Event") or self.headers.get(
+                "X-Gitea-Event", ""
+            )
+            try:
+                parsed = parse_issue_event(event, payload)
+            except InvalidEvent as e:
+                self._reply(400, {"error": f"invalid issue event: {e}"})
+                return
+            if parsed is None:
+                self._reply(200, {"status": "ignored"})
+                return
+
+            job_id = job_queue.enqueue(*parsed)
+            if job_id is None:
+                self._reply(200, {"status": "duplicate"})
+                return
+            dispatcher.notify()
+            self._reply(202, {"status": "queued", "job_id": job_id})
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(200, job_queue.metrics())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            print(f"webhook: {format % args}", flush=True)
+
+    return ThreadingHTTPServer(address, WebhookHandler)
+
+
+def serve(
+    address: tuple[str, int],
+    queue_path: str,
+    runner: Callable[[str], int],
+    max_workers: int,
+    per_repo_limit: int = 1,
+    secret: str = "",
+):
+    job_queue = JobQueue(queue_path)
+    dispatcher = Dispatcher(job_queue, runner, max_workers, per_repo_limit)
+    server = make_server(address, job_queue, dispatcher, secret)
+    dispatcher.start()
+    print(f"webhookを待ち受けています: http://{address[0]}:{address[1]}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        dispatcher.stop()
+        job_queue.close()
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# GETで再試行するステータス。POSTは処理されていないことが確実なものだけ再試行する
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POST_RETRY_STATUSES = {429, 503}
+# 指示から拾うissueのURL。例: http://host:3000/owner/repo/issues/12
+ISSUE_URL_PATTERN = re.compile(
+    r"(?P<origin>https?://[^/\s]+)/(?P<repository>[\w.-]+/[\w.-]+)/issues/(?P<issue_id>\d+)"
+)
+
+
+def find_issue_urls(text: str) -> list[tuple[str, str, str]]:
+    """
+    テキストに含まれるForgejoのissueのURLを重複なしで出現順に返す
+    returns:
+        (origin, リポジトリ名, issue番号) のリスト
+    """
+    issues = []
+    for match in ISSUE_URL_PATTERN.finditer(text):
+        key = (match["origin"], match["repository"], match["issue_id"])
+        # GitHubは未対応
+        if "github.com" not in match["origin"] and key not in issues:
+            issues.append(key)
+    return issues
+
+
+def mirror_key(origin: str, repository: str) -> str:
+    """
+    ホストのミラーキャッシュ内でのリポジトリの相対パス。例: host_3000/owner/repo.git
+    """
+    netloc = origin.split("://", 1)[1].replace(":", "_")
+    return f"{netloc}/{repository}.git"
+
+
+@dataclass
+class ForgejoResponse:
+    status_code: int
+    text: str
+    from_cache: bool = False
+
+
+class ForgejoClient:
+    """
+    Forgejo APIのクライアント。
+    接続をプールして使い回し、タイムアウトと指数バックオフ付きの再試行を行う。
+    GETの結果はETagと一緒にcache_dirへ保存し、次回からは条件付きGETで取得する
+    """
+
+    def __init__(
+        self,
+        token: str,
+        cache_dir: Path | None = None,
+        timeout: tuple[float, float] = (5, 30),
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        max_cache_entries: int = 256,
+    ):
+        self.token = token
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_cache_entries = max_cache_entries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = f"token {token}"
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, url: str) -> ForgejoResponse:
+        cached = self._read_cache(url)
+        headers = {"If-None-Match": cached["etag"]} if cached else {}
+
+        response = self._request("GET", url, RETRY_STATUSES, headers=headers)
+        if response.status_code == 304 and cached:
+            return ForgejoResponse(200, cached["text"], from_cache=True)
+        if response.status_code == 200 and response.headers.get("ETag"):
+            self._write_cache(url, response.headers["ETag"], response.text)
+        return ForgejoResponse(response.status_code, response.text)
+
+    def post(self, url: str, payload: dict) -> ForgejoResponse:
+        response = self._request("POST", url, POST_RETRY_STATUSES, json=payload)
+        return ForgejoResponse(response.status_code, response.text)
+
+    def close(self):
+        self.session.close()
+
+    def _request(
+        self, method: str, url: str, retry_statuses: set[int], **kwargs
+    ) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                # POSTは送信後に切れた可能性があるので再試行しない
+                if method != "GET" or last_attempt:
+                    raise
+                time.sleep(self._delay(attempt, None))
+                continue
+
+            if response.status_code not in retry_statuses or last_attempt:
+                return response
+            time.sleep(self._delay(attempt, response.headers.get("Retry-After")))
+        raise AssertionError("unreachable")
+
+    def _delay(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _cache_path(self, url: str) -> Path:
+        assert self.cache_dir is not None
+        # トークンごとに見える内容が違うかもしれないので、キーにトークンも含める
+        key = hashlib.sha256(f"{self.token}\0{url}".encode()).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def _read_cache(self, url: str) -> dict | None:
+        if self.cache_dir is None:
+            return None
+        try:
+            return json.loads(self._cache_path(url).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_cache(self, url: str, etag: str, text: str):
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(url)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"etag": etag, "text": text}))
+        tmp_path.replace(path)
+
+        # 古いものから消して、エントリ数を上限以下に保つ
+        entries = sorted(self.cache_dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for stale in entries[: max(0, len(entries) - self.max_cache_entries)]:
+            stale.unlink(missing_ok=True)
+
+
+_clients: dict[str, ForgejoClient] = {}
+
+
+def get_client() -> ForgejoClient:
+    """
+    環境変数のFORGEJO_TOKENとHOSTSELF_HTTP_CACHEから、プロセス内で共有するクライアントを返す
+    """
+    token = os.environ["FORGEJO_TOKEN"]
+    if token not in _clients:
+        cache_dir = os.getenv("HOSTSELF_HTTP_CACHE")
+        _clients[token] = ForgejoClient(
+            token, cache_dir=Path(cache_dir) if cache_dir else None
+        )
+    return _clients[token]
@@ -0,0 +1,335 @@
+import ast
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import platform
+import shlex
+import subprocess
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from checkpoint import git, write_atomic
+from code_index import SKIP_DIRS
+
+TEST_FILE_PATTERNS = ["test_*.py", "*_test.py"]
+# テストの結果を左右する設定ファイル。あれば全てのテストの依存に含める
+CONFIG_FILES = ["pyproject.toml", "setup.cfg", "setup.py", "pytest.ini", "tox.ini"]
+# パッケージがsrc/以下に置かれる構成でもimportを解決できるようにする
+SOURCE_ROOTS = ["", "src"]
+
+
+def is_test_file(relative: str) -> bool:
+    name = relative.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name, pattern) for pattern in TEST_FILE_PATTERNS)
+
+
+def imported_modules(source: str) -> list[tuple[str, int]]:
+    """
+    ソースコードがimportするモジュール
+    returns:
+        モジュール名と相対importの深さ（絶対importなら0）の組。
+        from a import bのbがモジュールかもしれないので、a.bも含める
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules += [(alias.name, 0) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ""
+            modules.append((base, node.level))
+            for alias in node.names:
+                if alias.name != "*":
+                    modules.append((f"{base}.{alias.name}".strip("."), node.level))
+    return modules
+
+
+@dataclass
+class _FileState:
+    stat: tuple[int, int]
+    digest: str
+    # digestの内容からimported_modulesで取り出したimport。内容が変わった時だけ解析し直す
+    modules: list[tuple[str, int]] = field(default_factory=list)
+    dependencies: list[str] = field(default_factory=list)
+
+
+class ImportGraph:
+    """
+    リポジトリのPythonファイルのimport関係と内容のハッシュを保持する。
+    呼ぶたびにmtimeとサイズが変わったファイルだけを読み直し、内容が変わったファイルだけを解析し直す
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.files: dict[str, _FileState] = {}
+        # 前回依存関係を解決した時のファイルの集合
+        self._names: set[str] = set()
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            seen = set()
+            reparsed = []
+            for relative in self._walk():
+                seen.add(relative)
+                path = self.root / relative
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                key = (stat.st_mtime_ns, stat.st_size)
+                state = self.files.get(relative)
+                if state is not None and state.stat == key:
+                    continue
+                data = path.read_bytes()
+                digest = hashlib.sha256(data).hexdigest()
+                if state is not None and state.digest == digest:
+                    state.stat = key
+                    continue
+                modules = (
+                    imported_modules(data.decode(errors="replace"))
+                    if relative.endswith(".py")
+                    else []
+                )
+                self.files[relative] = _FileState(key, digest, modules)
+                reparsed.append(relative)
+            for relative in set(self.files) - seen:
+                del self.files[relative]
+            # 解決先はファイルの集合で変わるので、集合が変わった時だけ全ファイル分を解決し直す
+            names = set(self.files)
+            if names != self._names:
+                reparsed = list(self.files)
+                self._names = names
+            for relative in reparsed:
+                state = self.files[relative]
+                if relative.endswith(".py"):
+                    state.dependencies = self._resolve_all(
+                        relative, state.modules, names
+                    )
+
+    def test_files(self) -> list[str]:
+        return sorted(path for path in self.files if is_test_file(path))
+
+    def closure(self, test: str) -> set[str]:
+        """
+        テストファイルが（間接的に）依存するファイル。conftest.pyと設定ファイルも含む
+        """
+        pending = [test]
+        parts = test.split("/")[:-1]
+        for depth in range(len(parts) + 1):
+            conftest = "/".join([*parts[:depth], "conftest.py"])
+            pending.append(conftest)
+        pending += CONFIG_FILES
+        seen = set()
+        while pending:
+            relative = pending.pop()
+            if relative in seen or relative not in self.files:
+                continue
+            seen.add(relative)
+            pending += self.files[relative].dependencies
+        return seen
+
+    def hashes(self, paths) -> dict[str, str]:
+        return {path: self.files[path].digest for path in sorted(paths)}
+
+    def _walk(self):
+        for directory, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+            relative_dir = Path(directory).relative_to(self.root).as_posix()
+            for filename in filenames:
+                relative = (
+                    filename if relative_dir == "." else f"{relative_dir}/{filename}"
+                )
+                if filename.endswith(".py") or relative in CONFIG_FILES:
+                    yield relative
+
+    def _resolve_all(
+        self, importer: str, modules: list[tuple[str, int]], names: set[str]
+    ) -> list[str]:
+        dependencies = set()
+        for module, level in modules:
+            dependencies.update(self._resolve(module, level, importer, names))
+        dependencies.discard(importer)
+        return sorted(dependencies)
+
+    def _resolve(
+        self, module: str, level: int, importer: str, names: set[str]
+    ) -> list[str]:
+        importer_dir = importer.split("/")[:-1]
+        if level:
+            if level - 1 > len(importer_dir):
+                return []
+            bases = ["/".join(importer_dir[: len(importer_dir) - (level - 1)])]
+        else:
+            # テストのディレクトリもsys.pathに入るので、同じディレクトリのモジュールも探す
+            bases = [*SOURCE_ROOTS, "/".join(importer_dir)]
+        parts = [part for part in module.split(".") if part]
+        for base in bases:
+            prefix = [base] if base else []
+            found = []
+            # importすると親のパッケージの__init__.pyも実行される
+            for depth in range(1, len(parts) + 1):
+                package = "/".join([*prefix, *parts[:depth]])
+                if f"{package}/__init__.py" in names:
+                    found.append(f"{package}/__init__.py")
+                elif depth == len(parts) and f"{package}.py" in names:
+                    found.append(f"{package}.py")
+            if level and not parts:
+                init = "/".join([*prefix, "__init__.py"])
+                if init in names:
+                    found.append(init)
+            if found:
+                return found
+        return []
+
+
+def result_key(hashes: dict[str, str], command: str) -> str:
+    """
+    テストの結果を決める入力（依存するファイルの内容・実行するコマンド・Pythonのバージョン）のハッシュ
+    """
+    data = json.dumps(
+        {"files": hashes, "command": command, "python": platform.python_version()},
+        sort_keys=True,
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    成功したテストファイルを、依存するファイルのハッシュとともに覚えておく。
+    pathを指定するとJSONに保存して、コンテナをまたいで使う
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            self.entries = self._load()
+
+    def get(self, root: Path, test: str) -> dict | None:
+        return self.entries.get(f"{root.name}:{test}")
+
+    def record(
+        self, root: Path, test: str, key: str, hashes: dict[str, str], seconds: float
+    ):
+        name = f"{root.name}:{test}"
+        entry = {"key": key, "hashes": hashes, "seconds": round(seconds, 3)}
+        with self._lock:
+            self.entries[name] = entry
+            if self.path is None:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # 同じファイルを使う他のコンテナの結果を消さないように、ロックを取って読み直してから書く
+            with self.path.with_name(f".{self.path.name}.lock").open("a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.entries = {**self._load(), name: entry}
+                write_atomic(self.path, json.dumps(self.entries).encode())
+
+    def _load(self) -> dict[str, dict]:
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+
+def detect_framework(root: Path) -> str:
+    """
+    pytestの設定があればpytest、なければunittestを使う
+    """
+    if (root / "pytest.ini").exists() or (root / "conftest.py").exists():
+        return "pytest"
+    for name in ("pyproject.toml", "setup.cfg", "tox.ini"):
+        path = root / name
+        if path.exists() and "pytest" in path.read_text(errors="replace"):
+            return "pytest"
+    return "unittest"
+
+
+def command_for(framework: str, test: str) -> str:
+    """
+    テストファイル1つを実行するコマンド。リポジトリのルートで実行する
+    """
+    if framework == "pytest":
+        return f"python -m pytest -q {shlex.quote(test)}"
+    directory, _, name = test.rpartition("/")
+    return (
+        f"python -m unittest discover -s {shlex.quote(directory or '.')}"
+        f" -p {shlex.quote(name)}"
+    )
+
+
+def changed_files(root: Path) -> set[str]:
+    """
+    upstream（なければHEAD）から変わったファイルと、未追跡のファイル
+    """
+    try:
+        try:
+            base = git(root, "merge-base", "HEAD", "origin/HEAD")
+        except subprocess.CalledProcessError:
+            base = "HEAD"
+        changed = git(root, "diff", "--name-only", base).splitlines()
+        changed += git(root, "ls-files", "--others", "--exclude-standard").splitlines()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return set()
+    return {path for path in changed if path}
+
+
+@dataclass
+class Selection:
+    test: str
+    key: str
+    hashes: dict[str, str]
+    # runかcachedかunaffected
+    action: str
+    # 前回成功した時から変わった依存ファイル
+    changed: list[str]
+
+
+def select_tests(
+    graph: ImportGraph,
+    cache: ResultCache,
+    framework: str,
+    tests: list[str],
+    full: bool = False,
+) -> list[Selection]:
+    """
+    実行するテストファイルを選ぶ。
+    前回成功した時と依存するファイルが同じならキャッシュの結果を使う。
+    一度も成功していないテストは、upstreamから変わったファイルに依存していれば実行する。
+    変わったファイルがなければ（作業前の確認）全て実行する
+    params:
+        full: キャッシュを使わずに全て実行する
+    """
+    changed = None
+    selections = []
+    for test in tests:
+        hashes = graph.hashes(graph.closure(test))
+        key = result_key(hashes, command_for(framework, test))
+        entry = cache.get(graph.root, test)
+        if entry is not None:
+            differs = sorted(
+                path
+                for path in set(hashes) | set(entry["hashes"])
+                if hashes.get(path) != entry["hashes"].get(path)
+            )
+        else:
+            if changed is None:
+                changed = changed_files(graph.root)
+            differs = sorted(set(hashes) & changed)
+        if full:
+            action = "run"
+        elif entry is not None and entry["key"] == key:
+            action = "cached"
+        elif entry is None and changed and not differs:
+            action = "unaffected"
+        else:
+            action = "run"
+        selections.append(Selection(test, key, hashes, action, differs))
+    return selections
@@ -1,67 +1,589 @@
 import argparse
+import functools
+import hashlib
+import json
+import secrets
 import subprocess
+import threading
+import time
 import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from dotenv import dotenv_values
 
+import cassette
+import checkpoint
+import daemon
+import forgejo
+import ratelimit
+import tracing
+from mirror import MirrorCache
+from pool import ContainerPool
+
 base_dir = Path(__file__).parent
 env = dotenv_values(base_dir / ".env")
-LOCAL_HOST_ALIAS = env["LOCAL_HOST_ALIAS"]
 
+IMAGE_NAME = "hostself"
+# Dockerfileのステージ。slimが既定で、fullは以前と同じ構成の比較用
+IMAGE_TARGETS = ["slim", "full"]
+# イメージの中身を決める入力。これらとビルド引数が変わらない限り再ビルドしない
+IMAGE_BUILD_INPUTS = [
+    "Dockerfile",
+    ".dockerignore",
+    "container.py",
+    "cassette.py",
+    "checkpoint.py",
+    "code_index.py",
+    "conversation.py",
+    "forgejo.py",
+    "impact.py",
+    "patcher.py",
+    "ratelimit.py",
+    "tracing.py",
+    "pyproject.toml",
+    "uv.lock",
+]
 
-def main():
-    parser = argparse.ArgumentParser(description="AI-assisted code modification tool")
-    parser.add_argument("issue_str", help="Issue text (for local mode)")
-    parser.add_argument(
-        "--log-dir", help="Directory to store Docker execution logs", default="logs"
+
+def image_build_args() -> dict[str, str]:
+    return {
+        "GIT_USER_EMAIL": env["GIT_USER_EMAIL"],
+        "GIT_USER_NAME": env["GIT_USER_NAME"],
+    }
+
+
+def compute_image_tag(build_args: dict[str, str], target: str = "slim") -> str:
+    """
+    ビルド入力のハッシュからイメージタグを作る
+    params:
+        build_args: docker buildに渡すビルド引数
+        target: Dockerfileのステージ
+    returns:
+        hostself:<hash> 形式のタグ
+    """
+    digest = hashlib.sha256()
+    for name in IMAGE_BUILD_INPUTS:
+        path = base_dir / name
+        digest.update(name.encode() + b"\0")
+        # 存在しないファイルも「無い」という状態としてハッシュに含める
+        digest.update(path.read_bytes() if path.exists() else b"<missing>")
+        digest.update(b"\0")
+    for key in sorted(build_args):
+        digest.update(f"{key}={build_args[key]}\0".encode())
+    digest.update(f"target={target}\0".encode())
+    return f"{IMAGE_NAME}:{digest.hexdigest()[:16]}"
+
+
+def image_exists(image: str) -> bool:
+    result = subprocess.run(
+        ["docker", "image", "inspect", image],
+        check=False,
+        capture_output=True,
+        text=True,
     )
-    args = parser.parse_args()
+    return result.returncode == 0
+
+
+def prepare_image(target: str = "slim") -> str:
+    """
+    ビルド入力のハッシュでタグ付けしたイメージを用意する。
+    同じタグのイメージが既にあればdocker buildは実行しない
+    params:
+        target: Dockerfileのステージ
+    returns:
+        コンテナの起動に使うイメージ名
+    """
+    start = time.perf_counter()
+    build_args = image_build_args()
+    image = compute_image_tag(build_args, target)
+
+    if image_exists(image):
+        status = "cached"
+    else:
+        command = [
+            "docker",
+            "build",
+            "--target",
+            target,
+            "-t",
+            image,
+            "-t",
+            f"{IMAGE_NAME}:{target}",
+            str(base_dir),
+        ]
+        for key, value in build_args.items():
+            command += ["--build-arg", f"{key}={value}"]
+        subprocess.run(command, check=True)
+        status = "built"
 
-    issue_str = args.issue_str
+    elapsed = time.perf_counter() - start
+    print(f"イメージ準備: {image} ({status}, {elapsed:.2f}s)", flush=True)
+    return image
 
+
+# コンテナをまたいで使うForgejo APIのレスポンスキャッシュ
+HTTP_CACHE_DIR = base_dir / ".cache" / "http"
+# 成功したテストの結果。内容のハッシュをキーにするので、コンテナをまたいで使える
+TEST_CACHE_DIR = base_dir / ".cache" / "tests"
+# リポジトリのbareミラー。コンテナには読み取り専用でマウントする
+MIRROR_DIR = base_dir / ".cache" / "mirrors"
+
+
+def docker_run_args(
+    log_dir: Path, extra_env: dict[str, str] | None = None
+) -> list[str]:
+    # 全コンテナ共通のdocker runオプション
+    HTTP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    TEST_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    MIRROR_DIR.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    env_args = []
+    for key, value in (extra_env or {}).items():
+        env_args += ["--env", f"{key}={value}"]
+    return [
+        "--env-file",
+        str(base_dir / ".env"),  # .envファイルの内容を環境変数として渡す
+        "--volume",
+        f"{HTTP_CACHE_DIR}:/cache/http",
+        "--env",
+        "HOSTSELF_HTTP_CACHE=/cache/http",
+        "--volume",
+        f"{TEST_CACHE_DIR}:/cache/tests",
+        "--env",
+        "HOSTSELF_TEST_CACHE=/cache/tests",
+        "--volume",
+        f"{MIRROR_DIR}:/mirrors:ro",
+        # コンテナはモデル呼び出しとtool callのトレースをここに書き出す
+        "--volume",
+        f"{log_dir.resolve()}:/logs",
+        "--env",
+        "HOSTSELF_TRACE_DIR=/logs",
+        "--env",
+        "HOSTSELF_CHECKPOINT_DIR=/logs/checkpoints",
+        *env_args,
+        "--add-host",
+        f"{env['LOCAL_HOST_ALIAS']}:host-gateway",
+    ]
+
+
+def run_container(
+    image: str, run_args: list[str], issue_str: str, resume: str | None = None
+) -> int:
     # ユニークなコンテナ名を生成
     container_name = f"hostself-container-{uuid.uuid4().hex[:8]}"
+    # 再開するときは同じrun idのチェックポイントから続ける
+    run_id = resume or tracing.new_run_id()
 
     try:
-        subprocess.run(
-            [
-                "docker",
-                "build",
-                "-t",
-                "hostself",
-                str(base_dir),
-                "--build-arg",
-                f"GIT_USER_EMAIL={env['GIT_USER_EMAIL']}",
-                "--build-arg",
-                f"GIT_USER_NAME={env['GIT_USER_NAME']}",
-            ]
-        )
-
         # コンテナを作成して起動する（1コマンドで実行）
         # --rmオプションを追加してコンテナ終了時に自動削除するようにする
-        # .envファイルの内容を環境変数として渡す
         subprocess.run(
             [
                 "docker",
                 "run",
                 "--rm",  # コンテナ終了時に自動削除
-                "--env-file",
-                str(base_dir / ".env"),  # .envファイルの内容を環境変数として渡す
                 "--name",
                 container_name,
-                "--add-host",
-                f"{LOCAL_HOST_ALIAS}:host-gateway",
-                "hostself",  # イメージ名
+                *run_args,
+                image,  # イメージ名
                 "python",
                 "container.py",
                 issue_str,
+                "--run-id",
+                run_id,
+                *(["--resume"] if resume else []),
             ],
             check=True,
         )
     except subprocess.CalledProcessError as e:
         print(f"エラーが発生しました: {e}")
+        print(f"続きから再開するには: python main.py --resume {run_id}", flush=True)
         subprocess.run(["docker", "rm", "-f", container_name], check=True)
+        return e.returncode
+    return 0
+
+
+def with_mirrors(runner: Callable[[str], int]) -> Callable[[str], int]:
+    """
+    コンテナを起動する前に、issueのリポジトリのミラーを更新するようにする
+    """
+    mirrors = MirrorCache(
+        MIRROR_DIR,
+        token=env.get("FORGEJO_TOKEN"),
+        # コンテナ内でのホストの別名は、ホストから見るとlocalhost
+        host_aliases={env["LOCAL_HOST_ALIAS"]: "localhost"},
+    )
+
+    def run(issue_str: str) -> int:
+        mirrors.prepare(issue_str)
+        return runner(issue_str)
+
+    return run
+
+
+def run_with_pool(
+    image: str, run_args: list[str], issue_strs: list[str], size: int, max_uses: int
+):
+    container_pool = ContainerPool(image, size, run_args, max_uses=max_uses)
+    container_pool.start()
+    try:
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            exit_codes = list(
+                executor.map(with_mirrors(container_pool.run), issue_strs)
+            )
+    finally:
+        container_pool.shutdown()
+
+    for issue_str, exit_code in zip(issue_strs, exit_codes):
+        if exit_code != 0:
+            print(f"エラーが発生しました (exit {exit_code}): {issue_str}")
+    print(json.dumps(container_pool.stats.summary(), indent=2), flush=True)
+
+
+def run_daemon(image: str, run_args: list[str], args: argparse.Namespace):
+    host, port = args.listen.rsplit(":", 1)
+    container_pool = None
+    if args.pool_size > 0:
+        container_pool = ContainerPool(
+            image,
+            args.pool_size,
+            run_args,
+            max_uses=args.pool_max_uses,
+        )
+        container_pool.start()
+        runner = container_pool.run
+    else:
+        runner = functools.partial(run_container, image, run_args)
+
+    try:
+        daemon.serve(
+            (host, int(port)),
+            args.queue_db,
+            with_mirrors(runner),
+            args.max_workers,
+            per_repo_limit=args.per_repo_limit,
+            secret=env.get("WEBHOOK_SECRET") or "",
+        )
+    finally:
+        if container_pool is not None:
+            container_pool.shutdown()
+
+
+def read_batch(path: Path) -> list[str]:
+    """
+    1行に1件のissue（URLかテキスト）を書いたファイルを読む。空行と#で始まる行は飛ばす
+    """
+    return [
+        line.strip()
+        for line in path.read_text().splitlines()
+        if line.strip() and not line.strip().startswith("#")
+    ]
+
+
+def batch_job_key(issue_str: str, line: int) -> tuple[str, str]:
+    """
+    ジョブのリポジトリとissue番号。URLを含まないissueは行ごとに別のリポジトリとして扱う
+    """
+    issues = forgejo.find_issue_urls(issue_str)
+    if issues:
+        _, repository, issue_id = issues[0]
+        return repository, issue_id
+    return f"(line {line})", str(line)
+
+
+def batch_report(
+    metrics: dict, pull_request_seconds: list[float], elapsed: float
+) -> dict:
+    return {
+        "jobs": metrics["done"] + metrics["failed"],
+        "done": metrics["done"],
+        "failed": metrics["failed"],
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_hour": round(metrics["throughput_per_hour"], 2),
+        "pull_requests": len(pull_request_seconds),
+        "time_to_pr_seconds": {
+            "p50": tracing.percentile(pull_request_seconds, 50),
+            "p95": tracing.percentile(pull_request_seconds, 95),
+        },
+        "latency_seconds": metrics["latency_seconds"],
+        "wait_seconds": metrics["wait_seconds"],
+    }
+
+
+def run_batch(
+    runner: Callable[[str], int],
+    issue_strs: list[str],
+    log_dir: Path,
+    max_workers: int,
+    per_repo_limit: int = 1,
+    poll_interval: float = 1.0,
+) -> dict:
+    """
+    issueをまとめてキューに積み、最大max_workers個のコンテナで並列に実行する。
+    同じリポジトリのissueは同時にper_repo_limit個までしか実行しない
+    returns:
+        スループットとPRまでの時間のレポート
+    """
+    job_queue = daemon.JobQueue(":memory:")
+    total = 0
+    for line, issue_str in enumerate(issue_strs, 1):
+        repository, issue_id = batch_job_key(issue_str, line)
+        if job_queue.enqueue(repository, issue_id, issue_str) is None:
+            print(f"[batch] 重複したissueを飛ばします: {issue_str}", flush=True)
+            continue
+        total += 1
+
+    # ジョブのidごとのissue_strと開始時刻。同じ内容の行があってもジョブごとに分ける
+    starts: dict[int, tuple[str, float]] = {}
+    finished = 0
+    lock = threading.Lock()
+
+    def on_start(job: daemon.Job):
+        starts[job.id] = (job.issue_str, time.time())
+        print(f"[batch] 開始 #{job.id} {job.repository}#{job.issue_id}", flush=True)
+
+    def on_finish(job: daemon.Job, exit_code: int):
+        nonlocal finished
+        with lock:
+            finished += 1
+            progress = f"{finished}/{total}"
+        status = "完了" if exit_code == 0 else f"失敗 (exit {exit_code})"
+        seconds = time.time() - starts[job.id][1]
+        print(
+            f"[batch] {status} #{job.id} {job.repository}#{job.issue_id} "
+            f"{seconds:.1f}s ({progress})",
+            flush=True,
+        )
+
+    started = time.time()
+    dispatcher = daemon.Dispatcher(
+        job_queue,
+        runner,
+        max_workers,
+        per_repo_limit,
+        poll_interval=poll_interval,
+        on_start=on_start,
+        on_finish=on_finish,
+    )
+    dispatcher.start()
+    try:
+        while True:
+            metrics = job_queue.metrics()
+            if metrics["queue_depth"] == 0 and metrics["running"] == 0:
+                break
+            time.sleep(poll_interval)
+    finally:
+        dispatcher.stop()
+    elapsed = time.time() - started
+
+    metrics = job_queue.metrics(window=max(elapsed, 1e-9))
+    job_queue.close()
+    times = tracing.pull_request_times(tracing.load_events(log_dir), starts)
+    return batch_report(metrics, list(times.values()), elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI-assisted code modification tool")
+    parser.add_argument("issue_str", nargs="*", help="Issue text (for local mode)")
+    parser.add_argument(
+        "--log-dir",
+        help="Directory to store JSONL traces of model and tool calls",
+        default="logs",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print p50/p95 latency and cost aggregated over the traces in --log-dir",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=0,
+        help="Number of pre-started containers (0 disables the warm pool)",
+    )
+    parser.add_argument(
+        "--pool-max-uses",
+        type=int,
+        default=1,
+        help="Jobs per pooled container before it is replaced (1 = always fresh)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Receive Forgejo issue webhooks and process them as queued jobs",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Run the issues (URLs or texts, one per line) in FILE as parallel jobs",
+    )
+    parser.add_argument(
+        "--listen",
+        help="Webhook listen address (daemon mode)",
+        default="127.0.0.1:8080",
+    )
+    parser.add_argument(
+        "--queue-db",
+        help="SQLite file for the persistent job queue (daemon mode)",
+        default=str(base_dir / "queue.sqlite3"),
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=2,
+        help="Maximum number of concurrently running containers (daemon/batch mode)",
+    )
+    parser.add_argument(
+        "--per-repo-limit",
+        type=int,
+        default=1,
+        help="Maximum number of concurrent jobs per repository (daemon/batch mode)",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        help="OpenAI requests per minute shared by all containers (default: unlimited)",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        help="OpenAI tokens per minute shared by all containers (default: unlimited)",
+    )
+    parser.add_argument(
+        "--llm-concurrency",
+        type=int,
+        default=8,
+        help="Maximum concurrent model calls across containers (lowered on 429)",
+    )
+    parser.add_argument(
+        "--image-target",
+        choices=IMAGE_TARGETS,
+        default="slim",
+        help="Dockerfile stage to run the agent in",
+    )
+    parser.add_argument(
+        "--routing",
+        metavar="JSON_FILE",
+        help="JSON file overriding the model routing policy of the containers",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="RUN_ID",
+        help="Continue an interrupted run from its last checkpoint in --log-dir",
+    )
+    parser.add_argument(
+        "--record-llm",
+        action="store_true",
+        help="Record model requests/responses under <log-dir>/cassettes for replay",
+    )
+    parser.add_argument(
+        "--replay-llm",
+        help="Serve model responses from this recorded cassette instead of OpenAI",
+    )
+    args = parser.parse_args()
+    if args.summary:
+        summary = tracing.summarize(tracing.load_events(Path(args.log_dir)))
+        print(json.dumps(summary, indent=2))
+        return
+    if args.resume:
+        try:
+            state = checkpoint.load_checkpoint(
+                Path(args.log_dir) / "checkpoints" / args.resume
+            )
+        except FileNotFoundError:
+            parser.error(f"no checkpoint for run {args.resume} in {args.log_dir}")
+        if args.daemon or args.batch or args.pool_size > 0:
+            parser.error(
+                "--resume cannot be combined with --daemon, --batch or --pool-size"
+            )
+        args.issue_str = [state["issue_str"]]
+    if args.batch:
+        if args.daemon or args.issue_str:
+            parser.error("--batch cannot be combined with --daemon or issue_str")
+        try:
+            batch = read_batch(Path(args.batch))
+        except OSError as e:
+            parser.error(f"--batch: {e}")
+    elif not args.daemon and not args.issue_str:
+        parser.error("issue_str is required unless --daemon or --batch is given")
+
+    image = prepare_image(args.image_target)
+
+    extra_env = {}
+    if args.routing:
+        try:
+            routing = json.loads(Path(args.routing).read_text())
+        except (OSError, json.JSONDecodeError) as e:
+            parser.error(f"--routing: {e}")
+        extra_env["HOSTSELF_ROUTING"] = json.dumps(routing)
+    if args.record_llm:
+        extra_env["HOSTSELF_LLM_RECORD_DIR"] = "/logs/cassettes"
+    # コンテナからはホストの別名で届くように全てのアドレスで待ち受けるので、
+    # ホストのサーバーはコンテナにだけ渡すトークンを持たないリクエストを断る
+    host_token = secrets.token_urlsafe(32)
+    replay_server = None
+    if args.replay_llm:
+        replay_server = cassette.start_replay_server(
+            ("0.0.0.0", 0),
+            cassette.load_cassette(Path(args.replay_llm)),
+            token=host_token,
+        )
+        port = replay_server.server_address[1]
+        extra_env["OPENAI_BASE_URL"] = f"http://{env['LOCAL_HOST_ALIAS']}:{port}/v1"
+        # APIキーとして送られるので、本物のキーの代わりにトークンを渡す
+        extra_env["OPENAI_API_KEY"] = host_token
+    # 全コンテナのモデル呼び出しを、ホストのブローカーでまとめてレート制限する
+    limiter = ratelimit.RateLimiter(args.rpm, args.tpm, args.llm_concurrency)
+    broker = ratelimit.start_broker(("0.0.0.0", 0), limiter, token=host_token)
+    broker_port = broker.server_address[1]
+    extra_env["HOSTSELF_RATE_LIMIT_URL"] = (
+        f"http://{env['LOCAL_HOST_ALIAS']}:{broker_port}"
+    )
+    extra_env["HOSTSELF_RATE_LIMIT_TOKEN"] = host_token
+    run_args = docker_run_args(Path(args.log_dir), extra_env)
+
+    try:
+        if args.daemon:
+            run_daemon(image, run_args, args)
+        elif args.batch:
+            container_pool = None
+            if args.pool_size > 0:
+                container_pool = ContainerPool(
+                    image, args.pool_size, run_args, max_uses=args.pool_max_uses
+                )
+                container_pool.start()
+                runner = container_pool.run
+            else:
+                runner = functools.partial(run_container, image, run_args)
+            try:
+                report = run_batch(
+                    with_mirrors(runner),
+                    batch,
+                    Path(args.log_dir),
+                    args.max_workers,
+                    args.per_repo_limit,
+                )
+            finally:
+                if container_pool is not None:
+                    container_pool.shutdown()
+            print(json.dumps(report, indent=2), flush=True)
+        elif args.pool_size > 0:
+            run_with_pool(
+                image, run_args, args.issue_str, args.pool_size, args.pool_max_uses
+            )
+        else:
+            runner = with_mirrors(
+                functools.partial(run_container, image, run_args, resume=args.resume)
+            )
+            for issue_str in args.issue_str:
+                runner(issue_str)
+    finally:
+        if replay_server is not None:
+            replay_server.shutdown()
+        broker.shutdown()
+        print(f"rate limit: {json.dumps(limiter.snapshot())}", flush=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from forgejo import find_issue_urls, mirror_key
+
+
+def directory_size(path: Path) -> int:
+    if not path.exists():
+        return 0
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+class MirrorCache:
+    """
+    リポジトリごとのbareミラーをホストに保持し、実行のたびに差分だけfetchする。
+    コンテナには読み取り専用でマウントされ、container.pyがここからcloneする
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        token: str | None = None,
+        host_aliases: dict[str, str] | None = None,
+    ):
+        self.root = root
+        self.token = token
+        # コンテナ内でのホスト名 -> ホストから見たホスト名
+        self.host_aliases = host_aliases or {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def prepare(self, issue_str: str) -> list[dict]:
+        """
+        issue_strに含まれるissueのリポジトリのミラーを用意する
+        returns:
+            リポジトリごとの準備時間と、ネットワークから受け取ったバイト数（ミラーの増分）
+        """
+        repositories = []
+        for origin, repository, _ in find_issue_urls(issue_str):
+            if (origin, repository) not in repositories:
+                repositories.append((origin, repository))
+        return [self.refresh(origin, repository) for origin, repository in repositories]
+
+    def refresh(self, origin: str, repository: str) -> dict:
+        key = mirror_key(origin, repository)
+        path = self.root / key
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # 同じミラーへの同時fetchは待ち合わせる
+        with lock:
+            start = time.perf_counter()
+            size_before = directory_size(path)
+            if (path / "HEAD").exists():
+                command = ["git", "-C", str(path), "remote", "update", "--prune"]
+                status = "updated"
+            else:
+                url = f"{self._fetch_origin(origin)}/{repository}.git"
+                command = ["git", "clone", "--mirror", url, str(path)]
+                status = "cloned"
+
+            try:
+                subprocess.run(
+                    self._git_auth() + command[1:],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+            except subprocess.CalledProcessError as e:
+                print(f"ミラーの更新に失敗しました ({key}): {e.stderr}", flush=True)
+                status = "failed"
+
+            stats = {
+                "repository": key,
+                "status": status,
+                "seconds": round(time.perf_counter() - start, 3),
+                "network_bytes": max(0, directory_size(path) - size_before),
+            }
+        print(f"リポジトリ準備: {stats}", flush=True)
+        return stats
+
+    def _git_auth(self) -> list[str]:
+        # トークンをミラーの設定ファイルに残さないように、コマンドごとにヘッダーで渡す
+        if not self.token:
+            return ["git"]
+        return ["git", "-c", f"http.extraHeader=Authorization: token {self.token}"]
+
+    def _fetch_origin(self, origin: str) -> str:
+        scheme, netloc = origin.split("://", 1)
+        host, _, port = netloc.partition(":")
+        host = self.host_aliases.get(host, host)
+        return f"{scheme}://{host}:{port}" if port else f"{scheme}://{host}"
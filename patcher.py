@@ -0,0 +1,362 @@
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+# ヘッダーに行番号がない（"@@ @@"のような）hunkも受け付ける
+LOOSE_HUNK_HEADER = re.compile(r"^@@.*@@")
+
+
+class PatchError(Exception):
+    pass
+
+
+@dataclass
+class Hunk:
+    old_start: int | None
+    lines: list[str] = field(default_factory=list)
+    # ヘッダーの元の行数。0なら、old_start行目の後ろに挿入するだけのhunk
+    old_count: int | None = None
+    # "\ No newline at end of file" が付いていたか
+    old_no_newline: bool = False
+    new_no_newline: bool = False
+
+    @property
+    def old_lines(self) -> list[str]:
+        return [line[1:] for line in self.lines if line[0] in " -"]
+
+    @property
+    def new_lines(self) -> list[str]:
+        return [line[1:] for line in self.lines if line[0] in " +"]
+
+
+@dataclass
+class FilePatch:
+    old_path: str | None
+    new_path: str | None
+    hunks: list[Hunk] = field(default_factory=list)
+
+
+@dataclass
+class PatchResult:
+    applied: bool
+    changed_files: list[Path]
+    report: str
+
+
+def _strip_path(raw: str) -> str | None:
+    # タイムスタンプを落とし、a/ b/ のプレフィックスを外す（patch -p1 相当）
+    path = raw.split("\t", 1)[0].strip()
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        path = path[2:]
+    return path
+
+
+def parse_patch(text: str) -> list[FilePatch]:
+    """
+    unified diffを解析する。複数ファイル分のdiffを含んでいてもよい。
+    モデルが書いたdiffはhunkの行数が合っていないことが多いので、行数は信用せず、
+    次のhunkかファイルのヘッダーが来るまでを1つのhunkとみなす
+    """
+    # 改行はLFだけで区切る。CRLFのdiffでも行末の\rは行の内容に含めない
+    lines = [line.removesuffix("\r") for line in text.split("\n")]
+    patches: list[FilePatch] = []
+    current: FilePatch | None = None
+    hunk: Hunk | None = None
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if (
+            line.startswith("--- ")
+            and i + 1 < len(lines)
+            and lines[i + 1].startswith("+++ ")
+        ):
+            current = FilePatch(_strip_path(line[4:]), _strip_path(lines[i + 1][4:]))
+            patches.append(current)
+            hunk = None
+            i += 2
+            continue
+        if line.startswith("@@"):
+            if current is None:
+                # ヘッダーなしのdiff。対象ファイルは呼び出し側が決める
+                current = FilePatch(None, None)
+                patches.append(current)
+            match = HUNK_HEADER.match(line)
+            if match is None and LOOSE_HUNK_HEADER.match(line) is None:
+                raise PatchError(f"invalid hunk header: {line}")
+            hunk = Hunk(
+                old_start=int(match[1]) if match else None,
+                old_count=int(match[2]) if match and match[2] is not None else None,
+            )
+            current.hunks.append(hunk)
+        elif hunk is not None:
+            if line.startswith("\\"):
+                if hunk.lines:
+                    prefix = hunk.lines[-1][0]
+                    hunk.old_no_newline |= prefix in " -"
+                    hunk.new_no_newline |= prefix in " +"
+            elif line.startswith(("diff ", "index ")):
+                hunk = None
+            elif line == "":
+                # 空行のコンテキストは先頭の空白が落ちていることが多い
+                hunk.lines.append(" ")
+            elif line[0] in " -+":
+                hunk.lines.append(line)
+            else:
+                hunk = None
+        i += 1
+
+    for file_patch in patches:
+        for each in file_patch.hunks:
+            # diffの末尾の空行はコンテキストではない
+            while each.lines and each.lines[-1] == " ":
+                each.lines.pop()
+    return patches
+
+
+def _find(
+    lines: list[str], old: list[str], expected: int, normalize: bool
+) -> int | None:
+    if not old:
+        return max(0, min(expected, len(lines)))
+    # ファイルの行はCRLFの\rを含むので、改行の違いは無視して比べる
+    key = (lambda s: s.rstrip()) if normalize else (lambda s: s.removesuffix("\r"))
+    target = [key(line) for line in old]
+    first = target[0]
+    candidates = [
+        position
+        for position in range(len(lines) - len(old) + 1)
+        if key(lines[position]) == first
+    ]
+    # 期待した位置に近いものから試す
+    for position in sorted(candidates, key=lambda p: abs(p - expected)):
+        if [key(line) for line in lines[position : position + len(old)]] == target:
+            return position
+    return None
+
+
+def _apply_hunk(
+    lines: list[str], hunk: Hunk, expected: int, max_fuzz: int, eol: str = ""
+) -> tuple[int, int, str] | None:
+    """
+    params:
+        eol: 追加する行の末尾に付ける文字（CRLFのファイルなら\r）
+    returns:
+        (適用した位置, 行数の増減, 補足) 。見つからなければNone
+    """
+    body = hunk.lines
+    leading = next((i for i, line in enumerate(body) if line[0] != " "), len(body))
+    trailing = next(
+        (i for i, line in enumerate(reversed(body)) if line[0] != " "), len(body)
+    )
+
+    for fuzz in range(max_fuzz + 1):
+        top = min(fuzz, leading)
+        bottom = min(fuzz, trailing)
+        if fuzz and top == 0 and bottom == 0:
+            break
+        trimmed = body[top : len(body) - bottom]
+        old = [line[1:] for line in trimmed if line[0] in " -"]
+        new = [line[1:] for line in trimmed if line[0] in " +"]
+        if fuzz and not old:
+            break
+        for normalize in (False, True):
+            position = _find(lines, old, expected + top, normalize)
+            if position is None:
+                continue
+            # コンテキスト行はファイル側の内容（行末の空白など）をそのまま残す
+            original = iter(lines[position : position + len(old)])
+            replaced = []
+            for line in trimmed:
+                if line[0] == " ":
+                    replaced.append(next(original))
+                elif line[0] == "-":
+                    next(original)
+                else:
+                    replaced.append(line[1:] + eol)
+            lines[position : position + len(old)] = replaced
+            notes = []
+            if fuzz:
+                notes.append(f"fuzz {fuzz}")
+            if normalize:
+                notes.append("ignoring trailing whitespace")
+            return position - top, len(new) - len(old), ", ".join(notes)
+    return None
+
+
+def _split(text: str) -> tuple[list[str], bool]:
+    """
+    LFだけで行に分ける。CRLFの\rや、改ページなどのLF以外の区切り文字は行の内容として残す
+    returns:
+        行のリストと、最後が改行で終わっているか
+    """
+    if text == "":
+        return [], True
+    lines = text.split("\n")
+    ends_with_newline = lines[-1] == ""
+    if ends_with_newline:
+        lines.pop()
+    return lines, ends_with_newline
+
+
+def _decode(data: bytes) -> str:
+    # UTF-8として読めないバイトもそのまま書き戻せるようにする
+    return data.decode("utf-8", errors="surrogateescape")
+
+
+def _encode(text: str) -> bytes:
+    return text.encode("utf-8", errors="surrogateescape")
+
+
+def _read(path: Path) -> tuple[list[str], bool]:
+    return _split(_decode(path.read_bytes()))
+
+
+def apply_patch(
+    patch: str,
+    cwd: str | Path | None = None,
+    file_path: str | None = None,
+    max_fuzz: int = 2,
+) -> PatchResult:
+    """
+    複数ファイルのunified diffを全て適用するか、1つも適用しない
+    params:
+        patch: unified diff
+        cwd: diff内のパスの基準になるディレクトリ
+        file_path: 指定した場合、1ファイル分のdiffをこのファイルに適用する（patch <file> 相当）
+        max_fuzz: コンテキストが一致しない時に、hunkの前後から無視してよいコンテキストの行数
+    returns:
+        適用結果と、hunkごとの結果をまとめたレポート
+    """
+    base = Path(cwd) if cwd else Path.cwd()
+    try:
+        file_patches = parse_patch(patch)
+    except PatchError as e:
+        return PatchResult(False, [], f"patch not applied: {e}")
+    if not file_patches:
+        return PatchResult(False, [], "patch not applied: no hunks found")
+    if file_path is not None:
+        if len(file_patches) != 1:
+            return PatchResult(
+                False,
+                [],
+                "patch not applied: file_path given but the diff has several files",
+            )
+        file_patches[0].old_path = file_patches[0].old_path and file_path
+        file_patches[0].new_path = file_patches[0].new_path and file_path
+        if file_patches[0].old_path is None and file_patches[0].new_path is None:
+            file_patches[0].old_path = file_patches[0].new_path = file_path
+
+    report: list[str] = []
+    failed = False
+    # 書き込む内容（Noneは削除）
+    writes: dict[Path, str | None] = {}
+
+    for file_patch in file_patches:
+        name = file_patch.new_path or file_patch.old_path
+        if name is None:
+            report.append("(unknown file): no target path")
+            failed = True
+            continue
+
+        if file_patch.old_path is None:
+            lines, ends_with_newline = [], True
+        else:
+            source = base / file_patch.old_path
+            if source in writes and writes[source] is not None:
+                lines, ends_with_newline = _split(writes[source])
+            elif source.exists():
+                lines, ends_with_newline = _read(source)
+            else:
+                report.append(f"{file_patch.old_path}: file does not exist")
+                failed = True
+                continue
+
+        # 行の多くがCRLFなら、追加する行もCRLFにする
+        eol = (
+            "\r" if 2 * sum(line.endswith("\r") for line in lines) > len(lines) else ""
+        )
+        delta = 0
+        for number, hunk in enumerate(file_patch.hunks, 1):
+            label = f"{name}: hunk {number}/{len(file_patch.hunks)}"
+            if hunk.old_start is None:
+                expected = 0
+            elif hunk.old_count == 0 and not hunk.old_lines:
+                # diff -U0の挿入は、old_start行目の後ろ（0なら先頭）に入れる
+                expected = hunk.old_start + delta
+            else:
+                expected = max(0, hunk.old_start - 1) + delta
+            result = _apply_hunk(lines, hunk, expected, max_fuzz, eol)
+            if result is None:
+                hint = next(iter(hunk.old_lines), "")
+                report.append(
+                    f"{label} FAILED: context not found near line {expected + 1}"
+                    f" (first expected line: {hint!r})"
+                )
+                failed = True
+                continue
+            position, change, notes = result
+            delta += change
+            offset = position - expected
+            detail = f"applied at line {position + 1}"
+            if hunk.old_start is not None and offset:
+                detail += f" (offset {offset:+d})"
+            if notes:
+                detail += f" ({notes})"
+            report.append(f"{label} {detail}")
+            if position + len(hunk.new_lines) >= len(lines):
+                if hunk.new_no_newline:
+                    ends_with_newline = False
+                elif hunk.old_no_newline:
+                    ends_with_newline = True
+
+        if file_patch.new_path is None:
+            writes[base / file_patch.old_path] = None
+            report.append(f"{file_patch.old_path}: deleted")
+            continue
+        content = "\n".join(lines)
+        if lines and ends_with_newline:
+            content += "\n"
+        writes[base / file_patch.new_path] = content
+        if file_patch.old_path and file_patch.old_path != file_patch.new_path:
+            writes.setdefault(base / file_patch.old_path, None)
+            report.append(f"{file_patch.old_path}: renamed to {file_patch.new_path}")
+
+    if failed:
+        report.append("patch not applied: no files were changed")
+        return PatchResult(False, [], "\n".join(report))
+
+    _write_all(writes)
+    return PatchResult(True, list(writes), "\n".join(report))
+
+
+def _write_all(writes: dict[Path, str | None]):
+    # 途中で失敗したら、それまでに書いたファイルを元に戻す
+    originals: dict[Path, bytes | None] = {
+        path: path.read_bytes() if path.exists() else None for path in writes
+    }
+    done: list[Path] = []
+    try:
+        for path, content in writes.items():
+            if content is None:
+                path.unlink(missing_ok=True)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+                tmp_path.write_bytes(_encode(content))
+                if path.exists():
+                    os.chmod(tmp_path, path.stat().st_mode)
+                os.replace(tmp_path, path)
+            done.append(path)
+    except OSError:
+        for path in done:
+            original = originals[path]
+            if original is None:
+                path.unlink(missing_ok=True)
+            else:
+                path.write_bytes(original)
+        raise
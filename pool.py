@@ -0,0 +1,292 @@
+import json
+import queue
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+# コンテナ内でジョブの受け渡しに使うディレクトリ。tmpfsなので再起動で空になる
+JOB_DIR = "/run/hostself"
+# コンテナの作業ディレクトリ（DockerfileのWORKDIR）。リポジトリはここにcloneされる
+WORKSPACE = "/app"
+# 待機中のコンテナを待つ間に、プールにコンテナが残っているかを確認する間隔（秒）
+ACQUIRE_POLL_SECONDS = 1.0
+
+
+@dataclass
+class WarmContainer:
+    name: str
+    spawned_at: float
+    uses: int = 0
+    # 起動直後の作業ディレクトリの中身。再起動して使い回す前に、これ以外を消す
+    baseline: list[str] = field(default_factory=list)
+
+
+@dataclass
+class PoolStats:
+    startup_seconds: list[float] = field(default_factory=list)
+    queue_wait_seconds: list[float] = field(default_factory=list)
+    job_seconds: list[float] = field(default_factory=list)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        result = {}
+        for name in ["startup_seconds", "queue_wait_seconds", "job_seconds"]:
+            values = getattr(self, name)
+            if not values:
+                continue
+            result[name] = {
+                "count": len(values),
+                "mean": statistics.fmean(values),
+                "max": max(values),
+            }
+        return result
+
+
+class ContainerPool:
+    """
+    起動済みのhostselfコンテナをsize個待機させておき、issueを空いているコンテナに渡す。
+    各コンテナはmax_uses回使ったら破棄して新しいものに置き換え、それ未満なら
+    作業ディレクトリを起動直後の状態に戻してから再起動して使い回す。
+    起動に失敗したコンテナはspawn_attempts回まで新しいものに置き換える
+    """
+
+    def __init__(
+        self,
+        image: str,
+        size: int,
+        run_args: list[str],
+        max_uses: int = 1,
+        ready_timeout: float = 60.0,
+        spawn_attempts: int = 3,
+    ):
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        if max_uses < 1:
+            raise ValueError("max_uses must be at least 1")
+        self.image = image
+        self.size = size
+        self.run_args = run_args
+        self.max_uses = max_uses
+        self.ready_timeout = ready_timeout
+        self.spawn_attempts = spawn_attempts
+        self.stats = PoolStats()
+        self._idle: queue.Queue[WarmContainer] = queue.Queue()
+        self._containers: dict[str, WarmContainer] = {}
+        self._lock = threading.Lock()
+        self._recyclers: list[threading.Thread] = []
+        # 起動中・待機中・使用中のコンテナの数。起動に失敗し続けた分だけ減る
+        self._slots = size
+
+    def start(self):
+        """
+        全コンテナを並列に起動して、起動待ちの時間を重ねる。
+        1つも起動できなかった場合はRuntimeErrorを送出する
+        """
+        threads = [threading.Thread(target=self._fill) for _ in range(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._idle.qsize() == 0:
+            self.shutdown()
+            raise RuntimeError("no container in the pool became ready")
+
+    def shutdown(self):
+        # 再起動・置き換え中のコンテナが後から残らないように待ってから消す
+        for thread in self._recyclers:
+            thread.join()
+        with self._lock:
+            names = list(self._containers)
+            self._containers.clear()
+        for name in names:
+            self._remove(name)
+
+    def run(self, issue_str: str) -> int:
+        """
+        issueを待機中のコンテナに渡して実行する
+        params:
+            issue_str: コンテナに渡すissueのテキスト
+        returns:
+            container.pyの終了コード
+        """
+        container = self._acquire()
+        start = time.perf_counter()
+        since = f"{time.time():.3f}"
+        try:
+            self._hand_job(container.name, issue_str)
+            self._stream_logs(container.name, since)
+            exit_code = self._wait_exit(container.name)
+        finally:
+            self.stats.job_seconds.append(time.perf_counter() - start)
+            recycler = threading.Thread(target=self._recycle, args=(container,))
+            recycler.start()
+            self._recyclers.append(recycler)
+        return exit_code
+
+    def _acquire(self) -> WarmContainer:
+        start = time.perf_counter()
+        while True:
+            try:
+                container = self._idle.get(timeout=ACQUIRE_POLL_SECONDS)
+                break
+            except queue.Empty:
+                # 全てのコンテナが起動に失敗していたら、いつまで待っても空かない
+                with self._lock:
+                    if self._slots == 0:
+                        raise RuntimeError(
+                            "no container in the pool could be started"
+                        ) from None
+        self.stats.queue_wait_seconds.append(time.perf_counter() - start)
+        return container
+
+    def _fill(self):
+        """
+        新しいコンテナを起動して待機させる。spawn_attempts回失敗したら枠を減らす
+        """
+        for attempt in range(1, self.spawn_attempts + 1):
+            container = WarmContainer(
+                name=f"hostself-pool-{uuid.uuid4().hex[:8]}",
+                spawned_at=time.perf_counter(),
+            )
+            with self._lock:
+                self._containers[container.name] = container
+            try:
+                self._start_container(container.name)
+                self._wait_ready(container)
+                container.baseline = self._list_workspace(container.name)
+            except (subprocess.CalledProcessError, TimeoutError, OSError) as e:
+                print(
+                    f"コンテナ{container.name}を起動できませんでした "
+                    f"({attempt}/{self.spawn_attempts}): {e}",
+                    flush=True,
+                )
+                self._discard(container)
+                continue
+            self._idle.put(container)
+            return
+        with self._lock:
+            self._slots -= 1
+
+    def _recycle(self, container: WarmContainer):
+        container.uses += 1
+        if container.uses < self.max_uses:
+            try:
+                self._reuse(container)
+            except (subprocess.CalledProcessError, TimeoutError, OSError) as e:
+                print(
+                    f"コンテナ{container.name}を再利用できないので置き換えます: {e}",
+                    flush=True,
+                )
+            else:
+                self._idle.put(container)
+                return
+        self._discard(container)
+        self._fill()
+
+    def _reuse(self, container: WarmContainer):
+        container.spawned_at = time.perf_counter()
+        self._restart(container.name)
+        self._wait_ready(container)
+        # 前のジョブのcloneやtool_outputsを次のissueに引き継がないように、
+        # 起動直後にはなかったものを消す
+        leftovers = [
+            entry
+            for entry in self._list_workspace(container.name)
+            if entry not in container.baseline
+        ]
+        if leftovers:
+            self._clear_workspace(container.name, leftovers)
+
+    def _discard(self, container: WarmContainer):
+        with self._lock:
+            self._containers.pop(container.name, None)
+        self._remove(container.name)
+
+    def _wait_ready(self, container: WarmContainer):
+        deadline = time.perf_counter() + self.ready_timeout
+        while not self._is_ready(container.name):
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"container {container.name} did not become ready")
+            time.sleep(0.1)
+        self.stats.startup_seconds.append(time.perf_counter() - container.spawned_at)
+
+    # 以下はdockerを直接操作する部分
+
+    def _start_container(self, name: str):
+        subprocess.run(
+            [
+                "docker",
+                "run",
+                "-d",
+                "--name",
+                name,
+                "--tmpfs",
+                JOB_DIR,
+                *self.run_args,
+                self.image,
+                "python",
+                "container.py",
+                "--wait-job",
+                JOB_DIR,
+            ],
+            check=True,
+            capture_output=True,
+        )
+
+    def _is_ready(self, name: str) -> bool:
+        result = subprocess.run(
+            ["docker", "exec", name, "test", "-f", f"{JOB_DIR}/ready"],
+            check=False,
+            capture_output=True,
+        )
+        return result.returncode == 0
+
+    def _hand_job(self, name: str, issue_str: str):
+        # 書きかけのファイルを読まれないように、一時ファイルに書いてからmvする
+        subprocess.run(
+            [
+                "docker",
+                "exec",
+                "-i",
+                name,
+                "sh",
+                "-c",
+                f"cat > {JOB_DIR}/job.json.tmp && mv {JOB_DIR}/job.json.tmp {JOB_DIR}/job.json",
+            ],
+            input=json.dumps({"issue_str": issue_str}),
+            text=True,
+            check=True,
+        )
+
+    def _stream_logs(self, name: str, since: str):
+        subprocess.run(["docker", "logs", "-f", "--since", since, name], check=False)
+
+    def _wait_exit(self, name: str) -> int:
+        result = subprocess.run(
+            ["docker", "wait", name], capture_output=True, text=True, check=True
+        )
+        return int(result.stdout.strip())
+
+    def _restart(self, name: str):
+        subprocess.run(["docker", "restart", name], check=True, capture_output=True)
+
+    def _list_workspace(self, name: str) -> list[str]:
+        result = subprocess.run(
+            ["docker", "exec", name, "ls", "-A", WORKSPACE],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        return result.stdout.splitlines()
+
+    def _clear_workspace(self, name: str, entries: list[str]):
+        subprocess.run(
+            ["docker", "exec", "-w", WORKSPACE, name, "rm", "-rf", "--", *entries],
+            check=True,
+            capture_output=True,
+        )
+
+    def _remove(self, name: str):
+        subprocess.run(["docker", "rm", "-f", name], check=False, capture_output=True)
@@ -0,0 +1,336 @@
+import email.utils
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# 返却されないまま（コンテナが落ちたなど）この秒数が過ぎた枠は回収する
+LEASE_TIMEOUT = 600
+
+
+class TokenBucket:
+    """
+    1分あたりの上限を、毎秒少しずつ補充されるバケツで表す
+    """
+
+    def __init__(self, per_minute: float, now: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = now
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # 上限より大きい要求は、満杯になれば通す
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    """
+    リクエスト数・トークン数の1分あたりの上限と、同時実行数を管理する。
+    同時実行数は429を受けたら半分に、成功するごとに少しずつ増やす（AIMD）。
+    429でRetry-Afterが返ってきたら、その間は全員の新しいリクエストを止める
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_concurrency: int = 8,
+        clock=time.monotonic,
+    ):
+        self.clock = clock
+        now = clock()
+        self.requests = (
+            TokenBucket(requests_per_minute, now) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute, now) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.paused_until = 0.0
+        self.leases: dict[str, tuple[float, float]] = {}
+        self.stats = {
+            "granted": 0,
+            "rate_limited": 0,
+            "errors": 0,
+            "expired": 0,
+            "wait_seconds": 0.0,
+        }
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens: float = 0) -> str:
+        """
+        リクエストを送ってよくなるまで待つ
+        params:
+            tokens: このリクエストで使うトークン数の見積もり
+        returns:
+            releaseに渡すlease
+        """
+        start = self.clock()
+        with self._cond:
+            while True:
+                now = self.clock()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    break
+                # 枠が空くかバケツが補充されるまで待つ。releaseでも起こされる
+                self._cond.wait(timeout=None if wait == float("inf") else wait)
+
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= tokens
+            lease = uuid.uuid4().hex
+            self.leases[lease] = (now, tokens)
+            self.stats["granted"] += 1
+            self.stats["wait_seconds"] += now - start
+            return lease
+
+    def release(
+        self,
+        lease: str,
+        used_tokens: float | None = None,
+        status: str = "ok",
+        retry_after: float | None = None,
+    ):
+        """
+        リクエストが終わったことを伝える
+        params:
+            lease: acquireの戻り値
+            used_tokens: 実際に使ったトークン数。見積もりとの差をバケツに戻す
+            status: ok・rate_limited・errorのいずれか
+            retry_after: 429のRetry-After（秒）
+        """
+        with self._cond:
+            now = self.clock()
+            _, reserved = self.leases.pop(lease, (now, 0))
+            if self.tokens is not None and used_tokens is not None:
+                self.tokens.refill(now)
+                self.tokens.level = min(
+                    self.tokens.capacity, self.tokens.level + reserved - used_tokens
+                )
+            if status == "rate_limited":
+                self.stats["rate_limited"] += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.paused_until = max(
+                    self.paused_until, now + (retry_after if retry_after else 1.0)
+                )
+            elif status == "ok":
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+            else:
+                self.stats["errors"] += 1
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            now = self.clock()
+            return {
+                **self.stats,
+                "wait_seconds": round(self.stats["wait_seconds"], 3),
+                "in_flight": len(self.leases),
+                "concurrency": round(self.concurrency, 2),
+                "paused_seconds": round(max(0.0, self.paused_until - now), 3),
+            }
+
+    def _expire(self, now: float):
+        for lease, (granted, _) in list(self.leases.items()):
+            if now - granted > LEASE_TIMEOUT:
+                del self.leases[lease]
+                self.stats["expired"] += 1
+
+    def _wait_time(self, now: float, tokens: float) -> float:
+        waits = [self.paused_until - now]
+        if len(self.leases) >= int(self.concurrency):
+            waits.append(float("inf"))
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                waits.append(bucket.wait_time(amount))
+        return max(waits)
+
+
+def bearer_token_matches(headers, token: str | None) -> bool:
+    """
+    リクエストのAuthorizationヘッダーが、共有のトークンと一致するかを返す
+    params:
+        headers: リクエストのヘッダー
+        token: 共有のトークン。Noneなら検証しない
+    """
+    if token is None:
+        return True
+    expected = f"Bearer {token}".encode()
+    return hmac.compare_digest(headers.get("Authorization", "").encode(), expected)
+
+
+def make_broker_server(
+    address: tuple[str, int], limiter: RateLimiter, token: str | None = None
+) -> ThreadingHTTPServer:
+    """
+    複数のコンテナで1つのRateLimiterを共有するためのHTTPサーバーを作る
+    params:
+        address: 待ち受けるアドレス
+        limiter: 共有するRateLimiter
+        token: 指定すると、Authorizationヘッダーにこのトークンがないリクエストを401で断る
+    """
+
+    class BrokerHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not bearer_token_matches(self.headers, token):
+                self._reply(401, {"error": "unauthorized"})
+                return
+            body = json.loads(
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            )
+            if self.path == "/acquire":
+                # 送ってよくなるまでレスポンスを返さない
+                self._reply(200, {"lease": limiter.acquire(body.get("tokens", 0))})
+            elif self.path == "/release":
+                limiter.release(
+                    body["lease"],
+                    body.get("used_tokens"),
+                    body.get("status", "ok"),
+                    body.get("retry_after"),
+                )
+                self._reply(200, {"status": "released"})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_GET(self):
+            if not bearer_token_matches(self.headers, token):
+                self._reply(401, {"error": "unauthorized"})
+            elif self.path == "/stats":
+                self._reply(200, limiter.snapshot())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer(address, BrokerHandler)
+
+
+def start_broker(
+    address: tuple[str, int], limiter: RateLimiter, token: str | None = None
+) -> ThreadingHTTPServer:
+    """
+    ブローカーをバックグラウンドのスレッドで起動する。止めるときはshutdown()を呼ぶ
+    """
+    server = make_broker_server(address, limiter, token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class BrokerClient:
+    """
+    ホストのブローカーを通してRateLimiterを使う。
+    ブローカーに繋がらないときは、制限せずに続ける
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0, token: str | None = None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+        if token is not None:
+            self._session.headers["Authorization"] = f"Bearer {token}"
+
+    def acquire(self, tokens: float = 0) -> str | None:
+        try:
+            response = self._session.post(
+                f"{self.url}/acquire",
+                json={"tokens": tokens},
+                # 待たされるのは正常なので、読み取りのタイムアウトは設けない
+                timeout=(self.timeout, None),
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"rate limit broker unavailable: {e}", flush=True)
+            return None
+        return response.json()["lease"]
+
+    def release(
+        self,
+        lease: str | None,
+        used_tokens: float | None = None,
+        status: str = "ok",
+        retry_after: float | None = None,
+    ):
+        if lease is None:
+            return
+        try:
+            self._session.post(
+                f"{self.url}/release",
+                json={
+                    "lease": lease,
+                    "used_tokens": used_tokens,
+                    "status": status,
+                    "retry_after": retry_after,
+                },
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            print(f"rate limit broker unavailable: {e}", flush=True)
+
+
+def retry_after_seconds(headers) -> float | None:
+    """
+    retry-after-ms・retry-afterヘッダーから待つべき秒数を求める
+    """
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(
+    attempt: int,
+    retry_after: float | None = None,
+    base: float = 1.0,
+    cap: float = 60.0,
+) -> float:
+    """
+    再試行までの待ち時間。指数バックオフにジッターを入れて、コンテナ同士で再試行が揃わないようにする
+    params:
+        attempt: 何回目の失敗か（0から）
+        retry_after: サーバーが指定した待ち時間。これより短くはしない
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,134 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import main
+import tracing
+
+
+def write_run(log_dir: Path, issue_str: str, pull_request_after: float | None):
+    tracer = tracing.Tracer(log_dir)
+    tracer.event("run_start", issue_str=issue_str)
+    if pull_request_after is not None:
+        time.sleep(pull_request_after)
+        tracer.event("tool_call", name="create_pull_request", ok=True)
+    tracer.event("run_end", steps=1)
+
+
+class TestBatchHelpers(unittest.TestCase):
+    def test_read_batch_skips_blank_lines_and_comments(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "issues.txt"
+            path.write_text(
+                "# 今週のissue\n"
+                "http://forgejo.local/a/repo/issues/1\n"
+                "\n"
+                "  関数Xのバグを修正してください  \n"
+            )
+            self.assertEqual(
+                main.read_batch(path),
+                [
+                    "http://forgejo.local/a/repo/issues/1",
+                    "関数Xのバグを修正してください",
+                ],
+            )
+
+    def test_batch_job_key(self):
+        self.assertEqual(
+            main.batch_job_key("直して http://forgejo.local/a/repo/issues/7", 1),
+            ("a/repo", "7"),
+        )
+        self.assertEqual(main.batch_job_key("関数Xを直す", 3), ("(line 3)", "3"))
+
+    def test_pull_request_times(self):
+        def run_start(run_id, ts, issue_str):
+            return {
+                "type": "run_start",
+                "run_id": run_id,
+                "ts": ts,
+                "issue_str": issue_str,
+            }
+
+        def tool_call(run_id, ts, name="create_pull_request", ok=True):
+            return {
+                "type": "tool_call",
+                "run_id": run_id,
+                "ts": ts,
+                "name": name,
+                "ok": ok,
+            }
+
+        events = [
+            run_start("old", 5.0, "a"),
+            tool_call("old", 6.0),
+            run_start("r1", 11.0, "a"),
+            tool_call("r1", 12.0, name="run_tests"),
+            # テストが失敗してPRを作れなかった呼び出し
+            tool_call("r1", 13.0, ok=False),
+            tool_call("r1", 14.0),
+            tool_call("r1", 15.0),
+            run_start("r2", 11.0, "b"),
+            # 同じ内容の2つのジョブは、先に始まったジョブから実行に割り当てる
+            run_start("r3", 10.5, "same"),
+            run_start("r4", 11.5, "same"),
+            tool_call("r4", 13.0),
+        ]
+        starts = {1: ("a", 10.0), 2: ("b", 10.0), 3: ("same", 10.0), 4: ("same", 11.0)}
+        # 開始より前の実行と、PRを作れなかった実行は数えない
+        self.assertEqual(tracing.pull_request_times(events, starts), {1: 4.0, 4: 2.0})
+
+
+class TestRunBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_runs_jobs_in_parallel_and_serializes_per_repo(self):
+        running: dict[str | int, int] = {}
+        overlap = {"max": 0, "same_repo": 0}
+        lock = threading.Lock()
+
+        def runner(issue_str: str) -> int:
+            # URLを含まない行は行ごとに別のリポジトリなので、同時に実行されてよい
+            repository = (
+                main.batch_job_key(issue_str, 0)[0]
+                if "http" in issue_str
+                else threading.get_ident()
+            )
+            with lock:
+                running[repository] = running.get(repository, 0) + 1
+                overlap["max"] = max(overlap["max"], sum(running.values()))
+                overlap["same_repo"] = max(overlap["same_repo"], running[repository])
+            write_run(self.log_dir, issue_str, None if "fail" in issue_str else 0.05)
+            with lock:
+                running[repository] -= 1
+            return 1 if "fail" in issue_str else 0
+
+        issue_strs = [
+            "http://forgejo.local/a/repo/issues/1",
+            "http://forgejo.local/a/repo/issues/2",
+            "http://forgejo.local/b/repo/issues/1",
+            "http://forgejo.local/b/repo/issues/1",
+            "fail",
+            "関数Xを直す",
+            "関数Xを直す",
+        ]
+        report = main.run_batch(
+            runner, issue_strs, self.log_dir, max_workers=3, poll_interval=0.01
+        )
+
+        # 重複した行は1件として数える
+        # URLを含まない同じ内容の行は、別のジョブとして数える
+        self.assertEqual(report["jobs"], 6)
+        self.assertEqual(report["done"], 5)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["pull_requests"], 5)
+        self.assertGreaterEqual(report["time_to_pr_seconds"]["p50"], 0.05)
+        self.assertGreater(report["throughput_per_hour"], 0)
+        self.assertGreater(overlap["max"], 1)
+        self.assertEqual(overlap["same_repo"], 1)
@@ -0,0 +1,122 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import openai
+
+from cassette import (
+    CassetteRecorder,
+    Replayer,
+    load_cassette,
+    request_key,
+    start_replay_server,
+)
+
+
+def completion(content: str) -> dict:
+    return {
+        "id": f"chatcmpl-{content}",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4o-2024-11-20",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+    }
+
+
+def request(text: str) -> dict:
+    return {
+        "model": "gpt-4o-2024-11-20",
+        "messages": [{"role": "user", "content": text}],
+    }
+
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "cassettes" / "run.jsonl"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def record(self, *texts: str):
+        recorder = CassetteRecorder(self.path)
+        for text in texts:
+            response = openai.types.chat.ChatCompletion.model_validate(
+                completion(f"reply to {text}")
+            )
+            recorder.record(request(text), response, 0.5)
+
+    def test_record_and_replay_through_openai_client(self):
+        self.record("first", "second")
+        entries = load_cassette(self.path)
+        self.assertEqual(entries[0]["key"], request_key(request("first")))
+        self.assertEqual(entries[0]["latency_seconds"], 0.5)
+
+        server = start_replay_server(("127.0.0.1", 0), entries)
+        try:
+            client = openai.Client(
+                api_key="dummy",
+                base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                max_retries=0,
+            )
+            response = client.chat.completions.create(**request("first"))
+            self.assertEqual(response.choices[0].message.content, "reply to first")
+            self.assertEqual(response.usage.prompt_tokens, 10)
+            client.chat.completions.create(**request("second"))
+
+            # 記録を使い切ったら再試行されないエラーで止まる
+            with self.assertRaises(openai.BadRequestError):
+                client.chat.completions.create(**request("third"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_replay_server_requires_the_token_as_api_key(self):
+        self.record("first")
+        server = start_replay_server(
+            ("127.0.0.1", 0), load_cassette(self.path), token="secret"
+        )
+        try:
+            base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+            client = openai.Client(api_key="wrong", base_url=base_url, max_retries=0)
+            with self.assertRaises(openai.AuthenticationError):
+                client.chat.completions.create(**request("first"))
+
+            # 断ったリクエストは記録を消費しない
+            client = openai.Client(api_key="secret", base_url=base_url, max_retries=0)
+            response = client.chat.completions.create(**request("first"))
+            self.assertEqual(response.choices[0].message.content, "reply to first")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_replayer_matches_by_request_then_falls_back_to_order(self):
+        self.record("first", "second", "third")
+        replayer = Replayer(load_cassette(self.path))
+
+        # 一致するリクエストは順番に関係なくその応答を返す
+        entry = replayer.next(request("second"))
+        self.assertEqual(entry["response"]["id"], "chatcmpl-reply to second")
+        # ずれたリクエストには、まだ返していない最初の応答を返す
+        entry = replayer.next(request("changed"))
+        self.assertEqual(entry["response"]["id"], "chatcmpl-reply to first")
+        self.assertEqual(
+            replayer.stats, {"served": 2, "matched": 1, "drifted": 1, "exhausted": 0}
+        )
+
+    def test_request_key_ignores_unrelated_fields(self):
+        self.assertEqual(
+            request_key({**request("a"), "stream": False}), request_key(request("a"))
+        )
+        self.assertNotEqual(request_key(request("a")), request_key(request("b")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import json
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from checkpoint import (
+    Checkpointer,
+    load_checkpoint,
+    message_param,
+    restore_workspace,
+)
+from container import tree_fingerprint
+
+
+def git(repository: Path, *args: str) -> str:
+    result = subprocess.run(
+        ["git", "-C", str(repository), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.origin = root / "origin.git"
+        self.workspace = root / "workspace"
+        self.restored = root / "restored"
+        self.directory = root / "checkpoints" / "run-1"
+        self.workspace.mkdir()
+        self.restored.mkdir()
+
+        source = root / "source"
+        source.mkdir()
+        git(source, "init", "-q", "-b", "main")
+        git(source, "config", "user.email", "test@example.com")
+        git(source, "config", "user.name", "test")
+        (source / "a.py").write_text("a = 1\n")
+        (source / "b.py").write_text("b = 1\n")
+        git(source, "add", ".")
+        git(source, "commit", "-q", "-m", "initial")
+        git(root, "clone", "-q", "--bare", str(source), str(self.origin))
+
+        self.repository = self.workspace / "repo"
+        git(self.workspace, "clone", "-q", str(self.origin), "repo")
+        git(self.repository, "config", "user.email", "test@example.com")
+        git(self.repository, "config", "user.name", "test")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def save(self, checkpointer: Checkpointer, step: int) -> dict:
+        messages = [{"role": "user", "content": "指示"}]
+        checkpointer.save("issue", step, messages, [], {"call_1": "done"})
+        return load_checkpoint(self.directory)
+
+    def test_restores_commits_and_uncommitted_changes(self):
+        git(self.repository, "checkout", "-q", "-b", "fix")
+        (self.repository / "a.py").write_text("a = 2\n")
+        git(self.repository, "commit", "-q", "-am", "change a")
+        commit = git(self.repository, "rev-parse", "HEAD")
+        # 未コミットの変更・削除・未追跡のファイル
+        (self.repository / "a.py").write_text("a = 3\n")
+        (self.repository / "b.py").unlink()
+        (self.repository / "new.py").write_text("new = 1\n")
+
+        checkpointer = Checkpointer(self.directory, self.workspace, tree_fingerprint)
+        state = self.save(checkpointer, 3)
+        self.assertEqual(state["step"], 3)
+        self.assertEqual(state["tool_results"], {"call_1": "done"})
+
+        # 新しいコンテナでは、originからcloneし直してから戻す
+        restore_workspace(self.directory, self.restored, state)
+        restored = self.restored / "repo"
+        self.assertEqual(git(restored, "symbolic-ref", "--short", "HEAD"), "fix")
+        self.assertEqual(git(restored, "rev-parse", "HEAD"), commit)
+        self.assertEqual((restored / "a.py").read_text(), "a = 3\n")
+        self.assertFalse((restored / "b.py").exists())
+        self.assertEqual((restored / "new.py").read_text(), "new = 1\n")
+        # 未コミットの変更は未コミットのまま戻る
+        self.assertEqual(
+            {
+                line.strip()
+                for line in git(restored, "status", "--porcelain").splitlines()
+            },
+            {"D b.py", "M a.py", "?? new.py"},
+        )
+
+    def test_skips_unchanged_repositories(self):
+        checkpointer = Checkpointer(self.directory, self.workspace, tree_fingerprint)
+        self.save(checkpointer, 1)
+        bundle = self.directory / "repo.bundle"
+        mtime = bundle.stat().st_mtime_ns
+
+        self.save(checkpointer, 2)
+        self.assertEqual(bundle.stat().st_mtime_ns, mtime)
+
+        (self.repository / "a.py").write_text("a = 4\n")
+        self.save(checkpointer, 3)
+        self.assertNotEqual(bundle.stat().st_mtime_ns, mtime)
+
+    def test_tool_results_without_snapshot(self):
+        checkpointer = Checkpointer(self.directory, self.workspace, tree_fingerprint)
+        messages = [{"role": "user", "content": "指示"}]
+        # まだスナップショットがなければ、snapshot=Falseでも取る
+        checkpointer.save("issue", 1, messages, [], {}, snapshot=False)
+        self.assertIn("repo", load_checkpoint(self.directory)["repositories"])
+        bundle = self.directory / "repo.bundle"
+        mtime = bundle.stat().st_mtime_ns
+
+        (self.repository / "a.py").write_text("a = 5\n")
+        checkpointer.save("issue", 2, messages, [], {"call_1": "done"}, snapshot=False)
+        self.assertEqual(bundle.stat().st_mtime_ns, mtime)
+
+        checkpointer.save_tool_results(2, {"call_1": "done", "call_2": "read"})
+        state = load_checkpoint(self.directory)
+        self.assertEqual(state["tool_results"], {"call_1": "done", "call_2": "read"})
+        # 前のステップの結果は読み込まない
+        checkpointer.save_tool_results(1, {"call_0": "old"})
+        self.assertEqual(
+            load_checkpoint(self.directory)["tool_results"], {"call_1": "done"}
+        )
+        # 全体を保存したら、書き足した結果は消える
+        checkpointer.save("issue", 2, messages, [], {})
+        self.assertFalse((self.directory / "tool_results.json").exists())
+        self.assertNotEqual(bundle.stat().st_mtime_ns, mtime)
+
+    def test_message_param(self):
+        message = SimpleNamespace(
+            role="assistant",
+            content=None,
+            refusal=None,
+            tool_calls=[
+                SimpleNamespace(
+                    id="call_1",
+                    function=SimpleNamespace(name="read_file", arguments="{}"),
+                )
+            ],
+        )
+        self.assertEqual(
+            json.loads(json.dumps(message_param(message))),
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": "call_1",
+                        "type": "function",
+                        "function": {"name": "read_file", "arguments": "{}"},
+                    }
+                ],
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from code_index import CodeIndex, read_file
+from patcher import apply_patch
+
+
+class TestCodeIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name).resolve()
+        (self.root / "pkg").mkdir()
+        (self.root / "pkg" / "core.py").write_text(
+            "class Engine:\n    def start(self):\n        return helper()\n\n\n"
+            "def helper():\n    return 'Hello World'\n"
+        )
+        (self.root / "app.py").write_text(
+            "from pkg.core import Engine\n\nEngine().start()\n"
+        )
+        (self.root / ".git").mkdir()
+        (self.root / ".git" / "config").write_text("Engine should be skipped\n")
+        (self.root / "blob.bin").write_bytes(b"\0Engine")
+        self.index = CodeIndex(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_search(self):
+        matches, total = self.index.search("Engine")
+        self.assertEqual(total, 3)
+        self.assertEqual(
+            [(m.path, m.line_number) for m in matches],
+            [("app.py", 1), ("app.py", 3), ("pkg/core.py", 1)],
+        )
+
+    def test_search_options(self):
+        self.assertEqual(self.index.search("hello world", ignore_case=True)[1], 1)
+        self.assertEqual(self.index.search("hello world")[1], 0)
+        self.assertEqual(self.index.search(r"def \w+\(", regex=True)[1], 2)
+        self.assertEqual(self.index.search("Engine", path_glob="pkg/*")[1], 1)
+
+    def test_definitions_and_references(self):
+        [definition] = self.index.definitions("helper")
+        self.assertEqual((definition.path, definition.line_number), ("pkg/core.py", 6))
+        references, total = self.index.references("Engine")
+        self.assertEqual(total, 2)
+        self.assertTrue(all(m.path == "app.py" for m in references))
+
+    def test_incremental_update_from_patch(self):
+        self.index.search("Engine")
+        patch = (
+            "--- a/pkg/core.py\n+++ b/pkg/core.py\n@@ -6,2 +6,2 @@\n"
+            "-def helper():\n+def assist():\n     return 'Hello World'\n"
+        )
+        result = apply_patch(patch, cwd=self.root)
+        self.index.update(result.changed_files)
+        self.assertEqual(self.index.definitions("helper"), [])
+        self.assertEqual(len(self.index.definitions("assist")), 1)
+
+    def test_mark_dirty_rescans(self):
+        self.index.search("Engine")
+        (self.root / "new.py").write_text("Engine\n")
+        os.remove(self.root / "app.py")
+        # dirtyにするまでは前回の索引のまま
+        self.assertEqual(self.index.search("Engine")[1], 3)
+        self.index.mark_dirty()
+        matches, total = self.index.search("Engine")
+        self.assertEqual(total, 2)
+        self.assertIn("new.py", [m.path for m in matches])
+
+    def test_read_file_range(self):
+        output = read_file(str(self.root / "pkg" / "core.py"), 6, 7)
+        self.assertIn("6  def helper():", output)
+        self.assertIn("lines 6-7 of 7", output)
+        self.assertNotIn("class Engine", output)
+
+    def test_read_file_past_the_end(self):
+        output = read_file(str(self.root / "pkg" / "core.py"), 10)
+        self.assertIn("start_line 10 is past the end of the file", output)
+        self.assertIn("has 7 lines", output)
+
+    def test_line_numbers_match_grep(self):
+        # 改ページ・\x1c・U+2028・CRLF・単独の\rでは行を分けない
+        (self.root / "odd.py").write_bytes(
+            "import os\n\x0c\nfoo = 1 \x1c bar\r\nbaz = '\u2028'\rqux\ntarget = 2\n".encode()
+        )
+        self.index.mark_dirty()
+        matches, _ = self.index.search("target")
+        self.assertEqual([(m.path, m.line_number) for m in matches], [("odd.py", 5)])
+        output = read_file(str(self.root / "odd.py"))
+        self.assertIn("5  target = 2", output)
+        self.assertIn("3  foo = 1 \x1c bar\n", output)
+        self.assertIn("lines 1-5 of 5", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
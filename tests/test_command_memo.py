@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import container
+from container import CommandMemo, CommandResult, is_memoizable_command
+
+
+class TestCommandMemo(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        Path(self.root, "a.txt").write_text("a\n")
+        self.memo = CommandMemo()
+        self.calls = 0
+        self.output = "a.txt"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def execute(self) -> CommandResult:
+        self.calls += 1
+        return CommandResult(self.output, 0, False, False, 0.01)
+
+    def test_repeat_is_served_from_memo(self):
+        self.memo.step = 1
+        first = self.memo.run("ls", self.root, self.execute)
+        self.memo.step = 3
+        second = self.memo.run("ls", self.root, self.execute)
+        self.assertIn("a.txt", first)
+        self.assertEqual(
+            second, "[unchanged since step 1: no files have changed since then]"
+        )
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.memo.hits, 1)
+
+    def test_file_change_reruns_command(self):
+        self.memo.run("ls", self.root, self.execute)
+        Path(self.root, "b.txt").write_text("b\n")
+        self.output = "a.txt\nb.txt"
+        result = self.memo.run("ls", self.root, self.execute)
+        self.assertEqual(self.calls, 2)
+        self.assertIn("b.txt", result)
+
+    def test_invalidate_reruns_but_reports_same_output(self):
+        self.memo.step = 2
+        self.memo.run("ls", self.root, self.execute)
+        self.memo.invalidate()
+        self.memo.step = 5
+        result = self.memo.run("ls", self.root, self.execute)
+        self.assertEqual(self.calls, 2)
+        self.assertIn("output unchanged since step 2", result)
+
+    def test_cwd_is_part_of_key(self):
+        other = os.path.join(self.root, "sub")
+        os.mkdir(other)
+        self.memo.run("ls", self.root, self.execute)
+        self.memo.run("ls", other, self.execute)
+        self.assertEqual(self.calls, 2)
+
+    def test_execute_command_uses_memo_and_invalidates_on_write(self):
+        with patch.object(container, "command_memo", self.memo):
+            container.execute_command("cat a.txt", {}, self.root)
+            self.assertIn(
+                "unchanged", container.execute_command("cat a.txt", {}, self.root)
+            )
+            container.execute_command("touch c.txt", {}, self.root)
+            self.assertIn(
+                "output unchanged",
+                container.execute_command("cat a.txt", {}, self.root),
+            )
+
+
+class TestIsMemoizableCommand(unittest.TestCase):
+    def test_is_memoizable_command(self):
+        self.assertTrue(is_memoizable_command("git status"))
+        self.assertTrue(is_memoizable_command("python -m pytest --collect-only -q"))
+        self.assertFalse(is_memoizable_command("pytest"))
+        self.assertFalse(is_memoizable_command("pytest --collect-only; rm -rf x"))
+
+
+if __name__ == "__main__":
+    unittest.main()
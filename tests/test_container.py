@@ -1,7 +1,17 @@
+import json
+import tempfile
+import time
 import unittest
 from pathlib import Path
 
-from container import execute_command
+import container
+from container import (
+    ShellSession,
+    execute_command,
+    run_command,
+    tool_failed,
+    wait_for_job,
+)
 
 
 class TestMain(unittest.TestCase):
@@ -40,3 +50,107 @@ class TestMain(unittest.TestCase):
         cwd = str(base_dir)
         result = execute_command(command, replace_dict, cwd)
         self.assertNotIn("Error", result)
+
+    def test_wait_for_job(self):
+        with tempfile.TemporaryDirectory() as job_dir:
+            (Path(job_dir) / "job.json").write_text(json.dumps({"issue_str": "fix"}))
+            issue_str = wait_for_job(job_dir)
+            self.assertEqual(issue_str, "fix")
+            self.assertTrue((Path(job_dir) / "ready").exists())
+            self.assertFalse((Path(job_dir) / "job.json").exists())
+
+
+class TestPromptPrefix(unittest.TestCase):
+    def test_prefix_is_static(self):
+        # issueごとの内容はユーザーメッセージに入れるので、先頭には含まれない
+        self.assertNotIn("{", container.SYSTEM_PROMPT)
+        self.assertNotIn("#### 指示", container.SYSTEM_PROMPT)
+        self.assertEqual(container.prompt_prefix_hash(), container.prompt_prefix_hash())
+        # 実行時の設定（既定のタイムアウトなど）もツールの説明には入れない
+        tools = json.dumps(container.TOOLS)
+        self.assertNotIn(f"default {container.COMMAND_TIMEOUT:g}", tools)
+
+    def test_prefix_hash_changes_with_tools(self):
+        before = container.prompt_prefix_hash()
+        description = container.TOOLS[0]["function"]["description"]
+        container.TOOLS[0]["function"]["description"] = description + "!"
+        try:
+            self.assertNotEqual(container.prompt_prefix_hash(), before)
+        finally:
+            container.TOOLS[0]["function"]["description"] = description
+
+
+class TestRunCommand(unittest.TestCase):
+    def test_run_command_result(self):
+        result = run_command("echo out; echo err >&2; exit 3", forward_output=False)
+        self.assertEqual(result.exit_code, 3)
+        self.assertIn("out", result.output)
+        self.assertIn("err", result.output)
+        self.assertFalse(result.truncated)
+        self.assertFalse(result.timed_out)
+
+    def test_run_command_truncates_middle(self):
+        result = run_command(
+            "echo START; yes middle | head -n 10000; echo END",
+            output_limit=1000,
+            forward_output=False,
+        )
+        self.assertTrue(result.truncated)
+        self.assertTrue(result.output.startswith("START"))
+        self.assertTrue(result.output.rstrip().endswith("END"))
+        self.assertIn("bytes omitted", result.output)
+        self.assertLess(len(result.output), 1100)
+
+    def test_run_command_timeout_kills_process_group(self):
+        start = time.perf_counter()
+        result = run_command("sleep 30 & sleep 30", timeout=0.5, forward_output=False)
+        self.assertTrue(result.timed_out)
+        self.assertIsNone(result.exit_code)
+        self.assertLess(time.perf_counter() - start, 5)
+        # 既定のタイムアウトはツールの説明ではなく、タイムアウトした結果で伝える
+        rendered = result.render()
+        self.assertTrue(tool_failed(rendered))
+        self.assertIn(
+            f"timeout 0.5s (default {container.COMMAND_TIMEOUT:g}s)", rendered
+        )
+
+    def test_execute_command_reports_status(self):
+        result = execute_command("true", {})
+        self.assertIn("exit code 0", result)
+
+
+class TestShellSession(unittest.TestCase):
+    def setUp(self):
+        self.session = ShellSession(forward_output=False)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_state_persists_between_commands(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.session.run("export GREETING=hello", cwd=tmp)
+            result = self.session.run("echo $GREETING; pwd")
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(result.output.split(), ["hello", str(Path(tmp).resolve())])
+
+    def test_exit_code_and_output_framing(self):
+        result = self.session.run("printf 'no newline'; false")
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(result.output, "no newline")
+
+    def test_unbalanced_quote_does_not_hang(self):
+        result = self.session.run("echo 'oops", timeout=5)
+        self.assertFalse(result.timed_out)
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertEqual(self.session.run("echo ok").output.strip(), "ok")
+
+    def test_recovers_after_exit(self):
+        result = self.session.run("exit 7")
+        self.assertEqual(result.exit_code, 7)
+        self.assertEqual(self.session.run("echo back").output.strip(), "back")
+        self.assertEqual(self.session.restarts, 1)
+
+    def test_recovers_after_timeout(self):
+        result = self.session.run("sleep 30", timeout=0.5)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(self.session.run("echo back").output.strip(), "back")
@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from conversation import ConversationContext, estimate_tokens
+
+
+def assistant(call_id: str):
+    return SimpleNamespace(
+        role="assistant",
+        content=None,
+        tool_calls=[SimpleNamespace(function=SimpleNamespace(arguments="{}"))],
+        id=call_id,
+    )
+
+
+class TestConversationContext(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_dir = Path(self.tmp.name)
+        self.messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "指示" * 100},
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fill(self, context: ConversationContext, count: int):
+        for i in range(count):
+            context.append(assistant(f"call_{i}"))
+            context.add_tool_output(f"call_{i}", f"line {i}\n" * 1000)
+
+    def test_no_compaction_under_budget(self):
+        context = ConversationContext(self.messages, 10**6, self.output_dir)
+        self.fill(context, 3)
+        before, after = context.compact()
+        self.assertEqual(before, after)
+        self.assertEqual(context.messages[3]["content"], "line 0\n" * 1000)
+
+    def test_compacts_old_tool_outputs_first(self):
+        context = ConversationContext(
+            self.messages, 3000, self.output_dir, keep_recent=2
+        )
+        self.fill(context, 4)
+        before, after = context.compact()
+
+        self.assertLess(after, before)
+        self.assertEqual(after, context.token_count())
+        # systemと指示、直近のツール出力はそのまま
+        self.assertEqual(context.messages[1]["content"], "指示" * 100)
+        self.assertEqual(context.messages[-1]["content"], "line 3\n" * 1000)
+        # 古いツール出力は縮められ、全文はディスクに残る
+        path = self.output_dir / "call_0.txt"
+        self.assertIn(str(path), context.messages[3]["content"])
+        self.assertEqual(path.read_text(), "line 0\n" * 1000)
+
+    def test_stops_once_under_budget(self):
+        context = ConversationContext(
+            self.messages, 10**6, self.output_dir, keep_recent=0
+        )
+        self.fill(context, 3)
+        context.token_budget = context.token_count() - 10
+        context.compact()
+        self.assertIn("省略", context.messages[3]["content"])
+        self.assertEqual(context.messages[5]["content"], "line 1\n" * 1000)
+
+    def test_estimate_tokens(self):
+        self.assertGreater(estimate_tokens("a" * 400), estimate_tokens("a" * 40))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,16 +5,17 @@ from unittest.mock import patch
 from dotenv import load_dotenv
 
 from container import create_pull_request
+from forgejo import ForgejoResponse
 
 load_dotenv(Path(__file__).parent.parent / ".env.example")
 
 
 class TestCreatePullRequest(unittest.TestCase):
-    @patch("container.requests.post")
-    def test_create_pull_request_success(self, mock_post):
+    @patch("container.forgejo.get_client")
+    def test_create_pull_request_success(self, mock_get_client):
         # モックの設定
-        mock_post.return_value.status_code = 201
-        mock_post.return_value.text = "Success"
+        mock_post = mock_get_client.return_value.post
+        mock_post.return_value = ForgejoResponse(201, "Success")
 
         # テスト実行
         response = create_pull_request(
@@ -28,12 +29,15 @@ class TestCreatePullRequest(unittest.TestCase):
 
         # 結果確認
         self.assertEqual(response, "Success")
+        url, payload = mock_post.call_args.args
+        self.assertEqual(url, "http://example.com/api/v1/repos/user/repo/pulls")
+        self.assertEqual(payload["head"], "FORGEJO_USER_NAME:test_branch")
 
-    @patch("container.requests.post")
-    def test_create_pull_request_failure(self, mock_post):
+    @patch("container.forgejo.get_client")
+    def test_create_pull_request_failure(self, mock_get_client):
         # モックの設定
-        mock_post.return_value.status_code = 400
-        mock_post.return_value.text = "Error"
+        mock_post = mock_get_client.return_value.post
+        mock_post.return_value = ForgejoResponse(400, "Error")
 
         # テスト実行
         response = create_pull_request(
@@ -0,0 +1,238 @@
+import hashlib
+import hmac
+import json
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from daemon import Dispatcher, JobQueue, make_server, percentile
+
+
+def issue_payload(repository: str, number: int, action: str = "opened") -> dict:
+    return {
+        "action": action,
+        "number": number,
+        "issue": {
+            "number": number,
+            "html_url": f"http://forgejo.local/{repository}/issues/{number}",
+        },
+        "repository": {"full_name": repository},
+    }
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tmp.name) / "queue.sqlite3")
+        self.job_queue = JobQueue(self.path)
+
+    def tearDown(self):
+        self.job_queue.close()
+        self.tmp.cleanup()
+
+    def test_enqueue_deduplicates_active_jobs(self):
+        self.assertIsNotNone(self.job_queue.enqueue("a/repo", "1", "issue 1"))
+        self.assertIsNone(self.job_queue.enqueue("a/repo", "1", "issue 1"))
+
+        job = self.job_queue.claim(per_repo_limit=1)
+        self.assertIsNone(self.job_queue.enqueue("a/repo", "1", "issue 1"))
+
+        # 終わったissueは再度キューに入れられる
+        self.job_queue.finish(job.id, 0)
+        self.assertIsNotNone(self.job_queue.enqueue("a/repo", "1", "issue 1"))
+
+    def test_claim_respects_per_repo_limit(self):
+        self.job_queue.enqueue("a/repo", "1", "a1")
+        self.job_queue.enqueue("a/repo", "2", "a2")
+        self.job_queue.enqueue("b/repo", "1", "b1")
+
+        first = self.job_queue.claim(per_repo_limit=1)
+        second = self.job_queue.claim(per_repo_limit=1)
+        self.assertEqual(first.issue_str, "a1")
+        self.assertEqual(second.issue_str, "b1")
+        self.assertIsNone(self.job_queue.claim(per_repo_limit=1))
+
+        self.job_queue.finish(first.id, 0)
+        self.assertEqual(self.job_queue.claim(per_repo_limit=1).issue_str, "a2")
+
+    def test_running_jobs_are_requeued_after_restart(self):
+        self.job_queue.enqueue("a/repo", "1", "a1")
+        self.job_queue.claim(per_repo_limit=1)
+        self.job_queue.close()
+
+        self.job_queue = JobQueue(self.path)
+        self.assertEqual(self.job_queue.metrics()["queue_depth"], 1)
+
+    def test_metrics(self):
+        self.job_queue.enqueue("a/repo", "1", "a1")
+        self.job_queue.enqueue("a/repo", "2", "a2")
+        job = self.job_queue.claim(per_repo_limit=1)
+        self.job_queue.finish(job.id, 1)
+
+        metrics = self.job_queue.metrics()
+        self.assertEqual(metrics["queue_depth"], 1)
+        self.assertEqual(metrics["failed"], 1)
+        self.assertEqual(metrics["throughput_per_hour"], 1)
+        self.assertIsNotNone(metrics["latency_seconds"]["p50"])
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_callbacks_around_each_job(self):
+        job_queue = JobQueue(":memory:")
+        job_queue.enqueue("a/repo", "1", "ok")
+        job_queue.enqueue("a/repo", "2", "fail")
+        job_queue.enqueue("b/repo", "1", "boom")
+        events = []
+
+        def runner(issue_str: str) -> int:
+            if issue_str == "boom":
+                raise RuntimeError("boom")
+            return 0 if issue_str == "ok" else 1
+
+        dispatcher = Dispatcher(
+            job_queue,
+            runner,
+            max_workers=2,
+            poll_interval=0.05,
+            on_start=lambda job: events.append(("start", job.issue_str)),
+            on_finish=lambda job, code: events.append(("finish", job.issue_str, code)),
+        )
+        dispatcher.start()
+        deadline = time.monotonic() + 5
+        while len(events) < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        dispatcher.stop()
+
+        self.assertCountEqual(
+            events,
+            [
+                ("start", "ok"),
+                ("finish", "ok", 0),
+                ("start", "fail"),
+                ("finish", "fail", 1),
+                ("start", "boom"),
+                ("finish", "boom", -1),
+            ],
+        )
+        # 終了のコールバックは、ジョブの状態を更新した後に呼ぶ
+        self.assertEqual(job_queue.metrics()["failed"], 2)
+        job_queue.close()
+
+
+class TestPercentile(unittest.TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestWebhookServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.job_queue = JobQueue(str(Path(self.tmp.name) / "queue.sqlite3"))
+        self.ran: list[str] = []
+        self.release = threading.Event()
+
+        def runner(issue_str: str) -> int:
+            self.ran.append(issue_str)
+            self.release.wait(5)
+            return 0
+
+        self.dispatcher = Dispatcher(
+            self.job_queue, runner, max_workers=2, poll_interval=0.05
+        )
+        self.server = make_server(
+            ("127.0.0.1", 0), self.job_queue, self.dispatcher, secret="s3cret"
+        )
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dispatcher.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dispatcher.stop()
+        self.job_queue.close()
+        self.tmp.cleanup()
+
+    def send(self, payload: dict | list, secret: str = "s3cret", event: str = "issues"):
+        body = json.dumps(payload).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        request = urllib.request.Request(
+            f"{self.url}/webhook",
+            data=body,
+            headers={"X-Forgejo-Event": event, "X-Forgejo-Signature": signature},
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def metrics(self) -> dict:
+        with urllib.request.urlopen(f"{self.url}/metrics") as response:
+            return json.loads(response.read())
+
+    def wait_for(self, condition, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition was not met in time")
+            time.sleep(0.01)
+
+    def test_webhook_enqueues_and_dispatches(self):
+        self.assertEqual(self.send(issue_payload("a/repo", 1))[0], 202)
+        self.assertEqual(
+            self.send(issue_payload("a/repo", 1))[1]["status"], "duplicate"
+        )
+        self.assertEqual(self.send(issue_payload("a/repo", 2))[0], 202)
+        self.assertEqual(self.send(issue_payload("b/repo", 1))[0], 202)
+
+        # a/repoは1件ずつしか実行されない
+        self.wait_for(lambda: len(self.ran) == 2)
+        self.assertEqual(
+            self.ran,
+            [
+                "http://forgejo.local/a/repo/issues/1",
+                "http://forgejo.local/b/repo/issues/1",
+            ],
+        )
+        self.assertEqual(self.metrics()["queue_depth"], 1)
+
+        self.release.set()
+        self.wait_for(lambda: self.metrics()["done"] == 3)
+        self.assertEqual(len(self.ran), 3)
+
+    def test_webhook_rejects_bad_signature(self):
+        status, _ = self.send(issue_payload("a/repo", 1), secret="wrong")
+        self.assertEqual(status, 401)
+
+    def test_webhook_ignores_other_events(self):
+        status, body = self.send(issue_payload("a/repo", 1, action="closed"))
+        self.assertEqual((status, body["status"]), (200, "ignored"))
+        status, body = self.send(issue_payload("a/repo", 1), event="push")
+        self.assertEqual((status, body["status"]), (200, "ignored"))
+
+    def test_webhook_rejects_malformed_issue_events(self):
+        missing_issue = issue_payload("a/repo", 1)
+        del missing_issue["issue"]
+        missing_repository = issue_payload("a/repo", 1)
+        missing_repository["repository"] = {}
+        bad_number = issue_payload("a/repo", 1)
+        bad_number["issue"]["number"] = "1; rm -rf /"
+        for payload in [missing_issue, missing_repository, bad_number, ["opened"]]:
+            with self.subTest(payload=payload):
+                status, body = self.send(payload)
+                self.assertEqual(status, 400)
+                self.assertIn("invalid issue event", body["error"])
+        self.assertEqual(self.metrics()["queue_depth"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
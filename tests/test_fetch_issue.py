@@ -1,21 +1,22 @@
+import json
 import unittest
 from pathlib import Path
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
 from dotenv import load_dotenv
 
 from container import fetch_issue
+from forgejo import ForgejoResponse
 
 load_dotenv(Path(__file__).parent.parent / ".env.example")
 
 
 class TestFetchIssue(unittest.TestCase):
     def test_fetch_issue_forgejo_success(self):
-        with patch("container.requests.get") as mock_get:
-            mock_response = Mock()
-            mock_response.status_code = 200
-            mock_response.text = '{"id":9,"title":"Example Issue"}'
-            mock_get.return_value = mock_response
+        with patch("container.forgejo.get_client") as mock_get_client:
+            mock_get_client.return_value.get.return_value = ForgejoResponse(
+                200, '{"id":9,"title":"Example Issue"}'
+            )
 
             result = fetch_issue(
                 repository_type="forgejo",
@@ -25,13 +26,15 @@ class TestFetchIssue(unittest.TestCase):
             )
 
             self.assertEqual(json.loads(result), {"id": 9, "title": "Example Issue"})
+            mock_get_client.return_value.get.assert_called_once_with(
+                "http://example.com/api/v1/repos/user/repo/issues/9"
+            )
 
     def test_fetch_issue_forgejo_failure(self):
-        with patch("container.requests.get") as mock_get:
-            mock_response = Mock()
-            mock_response.status_code = 404
-            mock_response.text = "Not Found"
-            mock_get.return_value = mock_response
+        with patch("container.forgejo.get_client") as mock_get_client:
+            mock_get_client.return_value.get.return_value = ForgejoResponse(
+                404, "Not Found"
+            )
 
             result = fetch_issue(
                 repository_type="forgejo",
@@ -0,0 +1,142 @@
+import json
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+from forgejo import ForgejoClient
+
+
+class StubForgejo:
+    """テスト用のForgejoの代わりのサーバー。返すステータスを順番に指定できる"""
+
+    def __init__(self):
+        self.statuses: list[int] = []
+        self.requests: list[dict] = []
+        self.client_ports: set[int] = set()
+        self.delay = 0.0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                stub.requests.append(
+                    {
+                        "method": self.command,
+                        "path": self.path,
+                        "headers": dict(self.headers),
+                        "body": self.rfile.read(length),
+                    }
+                )
+                stub.client_ports.add(self.client_address[1])
+                time.sleep(stub.delay)
+
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                etag = '"v1"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    status = 304
+                body = b"" if status == 304 else json.dumps({"status": status}).encode()
+                self.send_response(status)
+                if status == 200:
+                    self.send_header("ETag", etag)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestForgejoClient(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubForgejo()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.stub.close()
+        self.tmp.cleanup()
+
+    def client(self, **kwargs) -> ForgejoClient:
+        kwargs.setdefault("backoff", 0.01)
+        client = ForgejoClient("token", cache_dir=self.cache_dir, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_sends_token_and_reuses_connection(self):
+        client = self.client()
+        for _ in range(3):
+            self.assertEqual(client.get(f"{self.stub.url}/issues/1").status_code, 200)
+        self.assertEqual(
+            self.stub.requests[0]["headers"]["Authorization"], "token token"
+        )
+        self.assertEqual(len(self.stub.client_ports), 1)
+
+    def test_retries_server_errors(self):
+        self.stub.statuses = [503, 429, 200]
+        response = self.client().get(f"{self.stub.url}/issues/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.stub.statuses = [500] * 10
+        response = self.client(max_retries=2).get(f"{self.stub.url}/issues/1")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_post_is_not_retried_on_server_error(self):
+        self.stub.statuses = [500]
+        response = self.client().post(f"{self.stub.url}/pulls", {"title": "t"})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(json.loads(self.stub.requests[0]["body"]), {"title": "t"})
+
+    def test_conditional_get_across_clients(self):
+        url = f"{self.stub.url}/issues/1"
+        first = self.client().get(url)
+        self.assertFalse(first.from_cache)
+
+        # 別のクライアント（次の実行）でもディスクのキャッシュが使われる
+        second = self.client().get(url)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.text, first.text)
+        self.assertEqual(self.stub.requests[1]["headers"]["If-None-Match"], '"v1"')
+
+    def test_cache_is_bounded(self):
+        client = self.client(max_cache_entries=2)
+        for i in range(4):
+            client.get(f"{self.stub.url}/issues/{i}")
+        self.assertEqual(len(list(self.cache_dir.glob("*.json"))), 2)
+
+    def test_timeout(self):
+        self.stub.delay = 0.5
+        client = self.client(timeout=(1, 0.1), max_retries=1)
+        with self.assertRaises(requests.Timeout):
+            client.get(f"{self.stub.url}/issues/1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+import subprocess
+import tempfile
+import textwrap
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import container
+from container import full_suite_failure, run_tests, tool_failed
+from impact import ImportGraph, ResultCache, command_for, imported_modules, select_tests
+
+FILES = {
+    "pkg/__init__.py": "",
+    "pkg/calc.py": "from .helpers import double\n\ndef add(a, b):\n    return a + b\n",
+    "pkg/helpers.py": "def double(x):\n    return x * 2\n",
+    "other.py": "def greet():\n    return 'hi'\n",
+    "tests/test_calc.py": """
+        import unittest
+
+        from pkg.calc import add
+
+
+        class TestCalc(unittest.TestCase):
+            def test_add(self):
+                self.assertEqual(add(1, 2), 3)
+        """,
+    "tests/test_other.py": """
+        import unittest
+
+        import other
+
+
+        class TestOther(unittest.TestCase):
+            def test_greet(self):
+                self.assertEqual(other.greet(), "hi")
+        """,
+}
+
+
+def git(root: Path, *args: str):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+    )
+
+
+class RepositoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name) / "repo"
+        for name, content in FILES.items():
+            path = self.root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(textwrap.dedent(content).lstrip())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, content: str):
+        (self.root / name).write_text(content)
+
+
+class TestImportGraph(RepositoryTestCase):
+    def test_imported_modules(self):
+        modules = imported_modules("import a.b\nfrom . import c\nfrom ..d import e\n")
+        self.assertIn(("a.b", 0), modules)
+        self.assertIn(("c", 1), modules)
+        self.assertIn(("d.e", 2), modules)
+        self.assertEqual(imported_modules("def broken("), [])
+
+    def test_closure_follows_imports(self):
+        graph = ImportGraph(self.root)
+        graph.refresh()
+        self.assertEqual(
+            graph.test_files(), ["tests/test_calc.py", "tests/test_other.py"]
+        )
+        self.assertEqual(
+            graph.closure("tests/test_calc.py"),
+            {"tests/test_calc.py", "pkg/__init__.py", "pkg/calc.py", "pkg/helpers.py"},
+        )
+        self.assertEqual(
+            graph.closure("tests/test_other.py"), {"tests/test_other.py", "other.py"}
+        )
+
+    def test_refresh_picks_up_new_imports_and_config(self):
+        graph = ImportGraph(self.root)
+        graph.refresh()
+        self.write("other.py", "from pkg import calc\n")
+        self.write("pyproject.toml", "[tool.pytest.ini_options]\n")
+        graph.refresh()
+        closure = graph.closure("tests/test_other.py")
+        self.assertIn("pkg/calc.py", closure)
+        self.assertIn("pyproject.toml", closure)
+
+    def test_refresh_parses_only_changed_files(self):
+        self.write("tests/test_other.py", "import extra\n")
+        graph = ImportGraph(self.root)
+        graph.refresh()
+        self.assertEqual(graph.closure("tests/test_other.py"), {"tests/test_other.py"})
+        with patch("impact.imported_modules", wraps=imported_modules) as parse:
+            graph.refresh()
+            self.assertEqual(parse.call_count, 0)
+
+            self.write("pkg/helpers.py", "def double(x):\n    return x + x\n")
+            graph.refresh()
+            self.assertEqual(parse.call_count, 1)
+
+            # 新しいファイルは、解析し直していないファイルのimportの解決先にもなる
+            self.write("extra.py", "import other\n")
+            graph.refresh()
+            self.assertEqual(parse.call_count, 2)
+        self.assertEqual(
+            graph.closure("tests/test_other.py"),
+            {"tests/test_other.py", "extra.py", "other.py"},
+        )
+
+
+class TestSelection(RepositoryTestCase):
+    def select(self, graph, cache):
+        graph.refresh()
+        tests = graph.test_files()
+        return {
+            selection.test: selection
+            for selection in select_tests(graph, cache, "unittest", tests)
+        }
+
+    def test_skips_tests_whose_files_did_not_change(self):
+        graph, cache = ImportGraph(self.root), ResultCache()
+        selections = self.select(graph, cache)
+        self.assertEqual({s.action for s in selections.values()}, {"run"})
+        for selection in selections.values():
+            cache.record(
+                self.root, selection.test, selection.key, selection.hashes, 0.1
+            )
+
+        self.assertEqual(
+            {s.action for s in self.select(graph, cache).values()}, {"cached"}
+        )
+
+        self.write("pkg/helpers.py", "def double(x):\n    return x + x\n")
+        selections = self.select(graph, cache)
+        self.assertEqual(selections["tests/test_calc.py"].action, "run")
+        self.assertEqual(selections["tests/test_calc.py"].changed, ["pkg/helpers.py"])
+        self.assertEqual(selections["tests/test_other.py"].action, "cached")
+
+        selections = select_tests(
+            graph, cache, "unittest", ["tests/test_other.py"], full=True
+        )
+        self.assertEqual(selections[0].action, "run")
+
+    def test_uses_git_changes_before_anything_passed(self):
+        git(self.root, "init", "-q")
+        git(self.root, "add", ".")
+        git(self.root, "commit", "-q", "-m", "initial")
+        self.write("other.py", "def greet():\n    return 'hello'\n")
+
+        selections = self.select(ImportGraph(self.root), ResultCache())
+        self.assertEqual(selections["tests/test_calc.py"].action, "unaffected")
+        self.assertEqual(selections["tests/test_other.py"].action, "run")
+        self.assertEqual(selections["tests/test_other.py"].changed, ["other.py"])
+
+    def test_cache_is_persisted(self):
+        path = Path(self.tmp.name) / "cache" / "results.json"
+        ResultCache(path).record(self.root, "tests/test_a.py", "k", {"a.py": "h"}, 1.0)
+        entry = ResultCache(path).get(self.root, "tests/test_a.py")
+        self.assertEqual(entry["key"], "k")
+
+    def test_caches_sharing_a_file_keep_each_others_results(self):
+        path = Path(self.tmp.name) / "cache" / "results.json"
+        first, second = ResultCache(path), ResultCache(path)
+        first.record(self.root, "tests/test_a.py", "a", {}, 1.0)
+        second.record(self.root, "tests/test_b.py", "b", {}, 1.0)
+        first.record(self.root, "tests/test_c.py", "c", {}, 1.0)
+        saved = ResultCache(path)
+        for test in ("tests/test_a.py", "tests/test_b.py", "tests/test_c.py"):
+            self.assertIsNotNone(saved.get(self.root, test), test)
+        # 読み直した時に他のコンテナの結果も見えるようになる
+        self.assertEqual(first.get(self.root, "tests/test_b.py")["key"], "b")
+
+    def test_command_for(self):
+        self.assertEqual(
+            command_for("unittest", "tests/test_a.py"),
+            "python -m unittest discover -s tests -p test_a.py",
+        )
+        self.assertEqual(
+            command_for("pytest", "tests/test_a.py"),
+            "python -m pytest -q tests/test_a.py",
+        )
+        self.assertEqual(
+            command_for("pytest", "my tests/test_$(x).py"),
+            "python -m pytest -q 'my tests/test_$(x).py'",
+        )
+
+
+class TestRunTests(RepositoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patchers = [
+            patch.object(container, "test_results", ResultCache()),
+            patch.object(container, "_import_graphs", {}),
+            patch.object(container, "_full_suite_passed", {}),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        super().tearDown()
+
+    def test_runs_only_affected_test_files(self):
+        report = run_tests(str(self.root))
+        self.assertIn("PASS tests/test_calc.py", report)
+        self.assertIn("PASS tests/test_other.py", report)
+
+        report = run_tests(str(self.root))
+        self.assertIn("0 run", report)
+        self.assertIn("CACHED tests/test_calc.py", report)
+
+        self.write("pkg/calc.py", "def add(a, b):\n    return a - b\n")
+        report = run_tests(str(self.root), workers=2)
+        self.assertIn("FAIL tests/test_calc.py", report)
+        self.assertIn("changed: pkg/calc.py", report)
+        self.assertIn("CACHED tests/test_other.py", report)
+        self.assertIn("1 of 1 test files failed", report)
+        self.assertTrue(tool_failed(report))
+
+        # 失敗したテストは、直すまで毎回実行する
+        report = run_tests(str(self.root), paths=["tests/test_calc.py"])
+        self.assertIn("FAIL tests/test_calc.py", report)
+        self.assertNotIn("test_other", report)
+
+    def test_full_suite_runs_once_before_pull_request(self):
+        self.assertIsNone(full_suite_failure(self.root))
+        with patch.object(container, "run_command") as run_command:
+            self.assertIsNone(full_suite_failure(self.root))
+        run_command.assert_not_called()
+
+        self.write("other.py", "def greet():\n    return 'bye'\n")
+        report = full_suite_failure(self.root)
+        self.assertIn("FAIL tests/test_other.py", report)
+        # 全て実行するので、キャッシュされた結果は使わない
+        self.assertIn("PASS tests/test_calc.py", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
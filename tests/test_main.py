@@ -0,0 +1,79 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import main
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        (self.dir / "Dockerfile").write_text("FROM python:3.12\n")
+        (self.dir / "container.py").write_text("print('hello')\n")
+        self.patcher = patch.object(main, "base_dir", self.dir)
+        self.patcher.start()
+        self.build_args = {"GIT_USER_EMAIL": "a@example.com", "GIT_USER_NAME": "a"}
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmp.cleanup()
+
+    def test_compute_image_tag_is_stable(self):
+        tag1 = main.compute_image_tag(self.build_args)
+        tag2 = main.compute_image_tag(dict(reversed(self.build_args.items())))
+        self.assertEqual(tag1, tag2)
+        self.assertTrue(tag1.startswith("hostself:"))
+
+    def test_compute_image_tag_changes_with_inputs(self):
+        tag1 = main.compute_image_tag(self.build_args)
+        (self.dir / "container.py").write_text("print('changed')\n")
+        tag2 = main.compute_image_tag(self.build_args)
+        tag3 = main.compute_image_tag({**self.build_args, "GIT_USER_NAME": "b"})
+        self.assertNotEqual(tag1, tag2)
+        self.assertNotEqual(tag2, tag3)
+        self.assertNotEqual(tag3, main.compute_image_tag(self.build_args, "full"))
+
+    def test_prepare_image_skips_build_when_cached(self):
+        with (
+            patch.object(main, "env", self.build_args),
+            patch("main.subprocess.run") as mock_run,
+        ):
+            mock_run.return_value = Mock(returncode=0)
+            image = main.prepare_image()
+
+        self.assertEqual(image, main.compute_image_tag(self.build_args))
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_run.call_args.args[0][:3], ["docker", "image", "inspect"])
+
+    def test_prepare_image_builds_when_missing(self):
+        with (
+            patch.object(main, "env", self.build_args),
+            patch("main.subprocess.run") as mock_run,
+        ):
+            mock_run.return_value = Mock(returncode=1)
+            image = main.prepare_image()
+
+        build_command = mock_run.call_args.args[0]
+        self.assertEqual(build_command[:2], ["docker", "build"])
+        self.assertIn(image, build_command)
+        self.assertIn("GIT_USER_NAME=a", build_command)
+        self.assertEqual(build_command[build_command.index("--target") + 1], "slim")
+
+    def test_prepare_image_builds_the_requested_target(self):
+        with (
+            patch.object(main, "env", self.build_args),
+            patch("main.subprocess.run") as mock_run,
+        ):
+            mock_run.return_value = Mock(returncode=1)
+            image = main.prepare_image("full")
+
+        build_command = mock_run.call_args.args[0]
+        self.assertEqual(image, main.compute_image_tag(self.build_args, "full"))
+        self.assertEqual(build_command[build_command.index("--target") + 1], "full")
+        self.assertIn("hostself:full", build_command)
+
+
+if __name__ == "__main__":
+    unittest.main()
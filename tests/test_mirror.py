@@ -0,0 +1,119 @@
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from container import clone_from_mirrors
+from mirror import MirrorCache
+
+ISSUE = "http://forgejo.local:3000/owner/repo/issues/1 を直して"
+
+
+def git(*args: str, cwd: Path | None = None):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+class LocalMirrorCache(MirrorCache):
+    """Forgejoの代わりにローカルのbareリポジトリから取得する"""
+
+    def __init__(self, remotes: Path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.remotes = remotes
+
+    def _fetch_origin(self, origin):
+        return f"file://{self.remotes}"
+
+
+class TestMirrorCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.remotes = root / "remotes"
+        self.work = root / "work"
+        self.mirrors = root / "mirrors"
+
+        git("init", "--bare", "-b", "main", str(self.remotes / "owner" / "repo.git"))
+        git("clone", str(self.remotes / "owner" / "repo.git"), str(self.work))
+        self.commit("README.md", "hello\n")
+
+        self.cache = LocalMirrorCache(self.remotes, self.mirrors)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def commit(self, name: str, content: str):
+        (self.work / name).write_text(content)
+        git("add", name, cwd=self.work)
+        git("commit", "-m", f"add {name}", cwd=self.work)
+        git("push", "origin", "HEAD:main", cwd=self.work)
+
+    def test_prepare_clones_then_updates(self):
+        [first] = self.cache.prepare(ISSUE)
+        self.assertEqual(first["status"], "cloned")
+        self.assertEqual(first["repository"], "forgejo.local_3000/owner/repo.git")
+        self.assertGreater(first["network_bytes"], 0)
+
+        self.commit("main.py", "print('hi')\n")
+        [second] = self.cache.prepare(ISSUE)
+        self.assertEqual(second["status"], "updated")
+        log = subprocess.run(
+            ["git", "-C", str(self.mirrors / first["repository"]), "log", "--oneline"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(len(log.stdout.splitlines()), 2)
+
+    def test_container_clones_from_mirror(self):
+        self.cache.prepare(ISSUE)
+        workspace = Path(self.tmp.name) / "app"
+        workspace.mkdir()
+
+        with (
+            patch("container.MIRROR_ROOT", self.mirrors),
+            patch.dict("os.environ", {"FORGEJO_TOKEN": "secret"}),
+        ):
+            text, stats = clone_from_mirrors(ISSUE, workspace)
+
+        self.assertEqual(stats[0]["status"], "cloned")
+        self.assertIn(str(workspace / "repo"), text)
+        self.assertEqual((workspace / "repo" / "README.md").read_text(), "hello\n")
+        origin = subprocess.run(
+            ["git", "-C", str(workspace / "repo"), "remote", "get-url", "origin"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(
+            origin.stdout.strip(), "http://forgejo.local:3000/owner/repo.git"
+        )
+        # pushはoriginへのリクエストにだけ付く認証ヘッダーで認証する
+        header = subprocess.run(
+            [
+                "git",
+                "-C",
+                str(workspace / "repo"),
+                "config",
+                "--get-urlmatch",
+                "http.extraHeader",
+                "http://forgejo.local:3000/owner/repo.git",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(header.stdout.strip(), "Authorization: token secret")
+
+    def test_container_skips_missing_mirror(self):
+        with patch("container.MIRROR_ROOT", self.mirrors):
+            self.assertEqual(clone_from_mirrors(ISSUE, Path(self.tmp.name)), ("", []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from patcher import apply_patch, parse_patch
+
+ORIGINAL = "".join(f"line {i}\n" for i in range(1, 21))
+
+
+class TestApplyPatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        (self.dir / "a.txt").write_text(ORIGINAL)
+        (self.dir / "b.txt").write_text("alpha\nbeta\ngamma\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_multi_file_patch(self):
+        patch = """\
+--- a/a.txt
++++ b/a.txt
+@@ -2,3 +2,3 @@
+ line 2
+-line 3
++LINE 3
+ line 4
+--- a/b.txt
++++ b/b.txt
+@@ -1,3 +1,4 @@
+ alpha
++alpha2
+ beta
+ gamma
+--- /dev/null
++++ b/new/c.txt
+@@ -0,0 +1,2 @@
++hello
++world
+"""
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertIn("line 2\nLINE 3\nline 4\n", (self.dir / "a.txt").read_text())
+        self.assertEqual(
+            (self.dir / "b.txt").read_text(), "alpha\nalpha2\nbeta\ngamma\n"
+        )
+        self.assertEqual((self.dir / "new/c.txt").read_text(), "hello\nworld\n")
+        self.assertEqual(len(result.changed_files), 3)
+
+    def test_relocates_drifted_hunk(self):
+        patch = """\
+--- a/a.txt
++++ b/a.txt
+@@ -5,3 +5,3 @@
+ line 12
+-line 13
++changed
+ line 14
+"""
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied)
+        self.assertIn("applied at line 12 (offset +7)", result.report)
+        self.assertIn("line 12\nchanged\nline 14\n", (self.dir / "a.txt").read_text())
+
+    def test_fuzz_ignores_stale_context(self):
+        patch = """\
+--- a/a.txt
++++ b/a.txt
+@@ -9,4 +9,4 @@
+ line 9 (stale)
+ line 10
+-line 11
++eleven
+ line 12
+"""
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertIn("fuzz 1", result.report)
+        self.assertIn("line 10\neleven\nline 12\n", (self.dir / "a.txt").read_text())
+
+    def test_failure_is_atomic(self):
+        patch = """\
+--- a/b.txt
++++ b/b.txt
+@@ -1,1 +1,1 @@
+-alpha
++ALPHA
+--- a/a.txt
++++ b/a.txt
+@@ -1,3 +1,3 @@
+ nothing
+-like
++this
+ here
+"""
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertFalse(result.applied)
+        self.assertIn("a.txt: hunk 1/1 FAILED", result.report)
+        self.assertIn("b.txt: hunk 1/1 applied", result.report)
+        self.assertEqual((self.dir / "b.txt").read_text(), "alpha\nbeta\ngamma\n")
+
+    def test_file_path_without_headers(self):
+        patch = "@@ -2,1 +2,1 @@\n-beta\n+BETA\n"
+        result = apply_patch(patch, file_path=str(self.dir / "b.txt"))
+        self.assertTrue(result.applied)
+        self.assertEqual((self.dir / "b.txt").read_text(), "alpha\nBETA\ngamma\n")
+
+    def test_zero_context_insertion(self):
+        patch = "--- a/b.txt\n+++ b/b.txt\n@@ -1,0 +2 @@\n+ins\n"
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertEqual((self.dir / "b.txt").read_text(), "alpha\nins\nbeta\ngamma\n")
+
+        patch = "--- a/b.txt\n+++ b/b.txt\n@@ -0,0 +1 @@\n+top\n"
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertEqual(
+            (self.dir / "b.txt").read_text(), "top\nalpha\nins\nbeta\ngamma\n"
+        )
+
+    def test_delete_file(self):
+        patch = "--- a/b.txt\n+++ /dev/null\n@@ -1,3 +0,0 @@\n-alpha\n-beta\n-gamma\n"
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied)
+        self.assertFalse((self.dir / "b.txt").exists())
+
+    def test_no_newline_at_end_of_file(self):
+        patch = (
+            "--- a/b.txt\n+++ b/b.txt\n@@ -3,1 +3,1 @@\n-gamma\n+delta\n"
+            "\\ No newline at end of file\n"
+        )
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied)
+        self.assertEqual((self.dir / "b.txt").read_text(), "alpha\nbeta\ndelta")
+
+    def test_preserves_crlf_line_endings(self):
+        (self.dir / "crlf.txt").write_bytes(b"a\r\nb\r\nc\r\n")
+        patch = "--- a/crlf.txt\n+++ b/crlf.txt\n@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n"
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertEqual((self.dir / "crlf.txt").read_bytes(), b"a\r\nB\r\nc\r\n")
+
+    def test_preserves_form_feed_lines(self):
+        (self.dir / "ff.py").write_bytes(b"import os\n\x0c\ndef f():\n    pass\n")
+        patch = (
+            "--- a/ff.py\n+++ b/ff.py\n@@ -3,2 +3,2 @@\n"
+            " def f():\n-    pass\n+    return 1\n"
+        )
+        result = apply_patch(patch, cwd=self.dir)
+        self.assertTrue(result.applied, result.report)
+        self.assertIn("applied at line 3\n", result.report + "\n")
+        self.assertEqual(
+            (self.dir / "ff.py").read_bytes(),
+            b"import os\n\x0c\ndef f():\n    return 1\n",
+        )
+
+
+class TestParsePatch(unittest.TestCase):
+    def test_blank_context_and_removed_dashes(self):
+        patch = "--- a/x\n+++ b/x\n@@ -1,3 +1,2 @@\n a\n\n--- not a header\n"
+        [file_patch] = parse_patch(patch)
+        self.assertEqual(file_patch.hunks[0].lines, [" a", " ", "--- not a header"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import subprocess
+import unittest
+
+from pool import ContainerPool
+
+
+class FakeContainerPool(ContainerPool):
+    """dockerを呼ばずに、呼び出しだけを記録するプール"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started: list[str] = []
+        self.removed: list[str] = []
+        self.restarted: list[str] = []
+        self.cleared: list[tuple[str, list[str]]] = []
+        self.jobs: list[tuple[str, str]] = []
+        # コンテナごとの作業ディレクトリの中身
+        self.workspaces: dict[str, list[str]] = {}
+
+    def _start_container(self, name):
+        self.started.append(name)
+        self.workspaces[name] = ["container.py"]
+
+    def _is_ready(self, name):
+        return True
+
+    def _hand_job(self, name, issue_str):
+        self.jobs.append((name, issue_str))
+        self.workspaces[name] += ["repo", "tool_outputs"]
+
+    def _stream_logs(self, name, since):
+        pass
+
+    def _wait_exit(self, name):
+        return 0
+
+    def _restart(self, name):
+        self.restarted.append(name)
+
+    def _list_workspace(self, name):
+        return list(self.workspaces[name])
+
+    def _clear_workspace(self, name, entries):
+        self.cleared.append((name, entries))
+        self.workspaces[name] = [
+            entry for entry in self.workspaces[name] if entry not in entries
+        ]
+
+    def _remove(self, name):
+        self.removed.append(name)
+
+
+class TestContainerPool(unittest.TestCase):
+    def test_start_prewarms_all_containers(self):
+        pool = FakeContainerPool("hostself:test", 3, [])
+        pool.start()
+        self.assertEqual(len(pool.started), 3)
+        self.assertEqual(len(pool.stats.startup_seconds), 3)
+        pool.shutdown()
+        self.assertCountEqual(pool.removed, pool.started)
+
+    def test_run_replaces_container_after_max_uses(self):
+        pool = FakeContainerPool("hostself:test", 1, [], max_uses=1)
+        pool.start()
+        self.assertEqual(pool.run("issue 1"), 0)
+        self.assertEqual(pool.run("issue 2"), 0)
+        pool.shutdown()
+
+        self.assertEqual([issue for _, issue in pool.jobs], ["issue 1", "issue 2"])
+        self.assertNotEqual(pool.jobs[0][0], pool.jobs[1][0])
+        self.assertEqual(pool.restarted, [])
+        self.assertEqual(len(pool.stats.queue_wait_seconds), 2)
+
+    def test_run_restarts_container_until_max_uses(self):
+        pool = FakeContainerPool("hostself:test", 1, [], max_uses=2)
+        pool.start()
+        pool.run("issue 1")
+        pool.run("issue 2")
+        pool.run("issue 3")
+        pool.shutdown()
+
+        names = [name for name, _ in pool.jobs]
+        self.assertEqual(names[0], names[1])
+        self.assertNotEqual(names[1], names[2])
+        # 1回目の後は再起動、2回目の後は置き換え、3回目の後は新しいコンテナの再起動
+        self.assertEqual(pool.restarted, [names[0], names[2]])
+
+    def test_restart_clears_previous_job_workspace(self):
+        pool = FakeContainerPool("hostself:test", 1, [], max_uses=2)
+        pool.start()
+        pool.run("issue 1")
+        pool.shutdown()
+
+        [name] = pool.restarted
+        self.assertEqual(pool.cleared, [(name, ["repo", "tool_outputs"])])
+        self.assertEqual(pool.workspaces[name], ["container.py"])
+
+    def test_start_replaces_containers_that_fail_to_start(self):
+        pool = FakeContainerPool("hostself:test", 2, [])
+        start_container = pool._start_container
+        failures = []
+
+        def flaky_start(name):
+            start_container(name)
+            if not failures:
+                failures.append(name)
+                raise subprocess.CalledProcessError(125, "docker run")
+
+        pool._start_container = flaky_start
+        pool.start()
+        self.assertEqual(len(pool.started), 3)
+        self.assertIn(failures[0], pool.removed)
+        self.assertEqual(pool.run("issue 1"), 0)
+        pool.shutdown()
+
+    def test_start_raises_when_no_container_becomes_ready(self):
+        pool = FakeContainerPool(
+            "hostself:test", 2, [], ready_timeout=0.01, spawn_attempts=2
+        )
+        pool._is_ready = lambda name: False
+        with self.assertRaises(RuntimeError):
+            pool.start()
+        self.assertEqual(len(pool.started), 4)
+        self.assertCountEqual(pool.removed, pool.started)
+
+    def test_run_raises_when_replacements_keep_failing(self):
+        pool = FakeContainerPool(
+            "hostself:test", 1, [], ready_timeout=0.01, spawn_attempts=1
+        )
+        pool.start()
+        pool._is_ready = lambda name: False
+        self.assertEqual(pool.run("issue 1"), 0)
+        # 置き換えのコンテナが起動しないので、待ち続けずにエラーにする
+        with self.assertRaises(RuntimeError):
+            pool.run("issue 2")
+        pool.shutdown()
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            ContainerPool("hostself:test", 0, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
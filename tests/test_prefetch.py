@@ -0,0 +1,97 @@
+import json
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from dotenv import load_dotenv
+
+from container import prefetch_issue_context
+from forgejo import ForgejoResponse
+
+load_dotenv(Path(__file__).parent.parent / ".env.example")
+
+API = "http://forgejo.local:3000/api/v1/repos/user/repo"
+RESPONSES = {
+    f"{API}/issues/9": {
+        "title": "Fix bug",
+        "state": "open",
+        "body": "It crashes",
+        "labels": [{"name": "bug"}],
+    },
+    f"{API}/issues/9/comments": [
+        {"user": {"login": "alice"}, "created_at": "2025-01-01", "body": "me too"}
+    ],
+    f"{API}/issues/9/timeline": [
+        {
+            "type": "pull_ref",
+            "ref_issue": {
+                "number": 3,
+                "title": "WIP",
+                "state": "open",
+                "pull_request": {},
+            },
+        },
+        {"type": "comment", "ref_issue": None},
+    ],
+    f"{API}": {
+        "default_branch": "develop",
+        "clone_url": "http://forgejo.local:3000/user/repo.git",
+    },
+    f"{API}/contents": [
+        {"name": "src", "type": "dir"},
+        {"name": "README.md", "type": "file"},
+    ],
+}
+
+
+class FakeClient:
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        if url in RESPONSES:
+            return ForgejoResponse(200, json.dumps(RESPONSES[url]))
+        return ForgejoResponse(404, "Not Found")
+
+
+class TestPrefetchIssueContext(unittest.TestCase):
+    def test_prefetch_builds_context(self):
+        client = FakeClient()
+        with patch("container.forgejo.get_client", return_value=client):
+            context, metrics = prefetch_issue_context(
+                "http://forgejo.local:3000/user/repo/issues/9 を直して"
+            )
+
+        self.assertEqual(len(client.urls), 5)
+        self.assertEqual(metrics["requests"], 5)
+        self.assertEqual(metrics["failed_requests"], 0)
+        for expected in [
+            "- title: Fix bug",
+            "- labels: bug",
+            "- default branch: develop",
+            "- top-level files: src/, README.md",
+            "#3 WIP (open)",
+            "It crashes",
+            "- alice (2025-01-01): me too",
+        ]:
+            self.assertIn(expected, context)
+
+    def test_prefetch_without_issue_url(self):
+        with patch("container.forgejo.get_client") as mock_get_client:
+            context, metrics = prefetch_issue_context("関数Xのバグを修正してください")
+        self.assertEqual((context, metrics), ("", {}))
+        mock_get_client.assert_not_called()
+
+    def test_prefetch_tolerates_failures(self):
+        client = FakeClient()
+        with patch("container.forgejo.get_client", return_value=client):
+            context, metrics = prefetch_issue_context(
+                "http://forgejo.local:3000/user/other/issues/1"
+            )
+        self.assertEqual(metrics["failed_requests"], 5)
+        self.assertIn("issueを取得できませんでした", context)
+
+
+if __name__ == "__main__":
+    unittest.main()
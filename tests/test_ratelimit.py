@@ -0,0 +1,174 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import openai
+import requests
+
+from container import create_with_retries
+from ratelimit import (
+    BrokerClient,
+    RateLimiter,
+    TokenBucket,
+    backoff_delay,
+    retry_after_seconds,
+    start_broker,
+)
+
+
+def status_error(error_class, status_code: int, headers: dict | None = None):
+    # openaiの例外が参照するのはstatus_code・headers・requestだけ
+    response = SimpleNamespace(
+        status_code=status_code, headers=headers or {}, request=None
+    )
+    return error_class("error", response=response, body=None)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(60, now=0.0)
+        bucket.level = 0
+        self.assertAlmostEqual(bucket.wait_time(3), 3.0)
+        bucket.refill(2.0)
+        self.assertAlmostEqual(bucket.level, 2.0)
+        # 上限より大きい要求は満杯になるまで待てば通る
+        self.assertAlmostEqual(bucket.wait_time(1000), 58.0)
+
+    def test_concurrency_limit_blocks_until_release(self):
+        limiter = RateLimiter(max_concurrency=2)
+        first = limiter.acquire()
+        limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(first)
+        self.assertTrue(acquired.wait(2))
+        thread.join()
+
+    def test_rate_limited_halves_concurrency_and_pauses(self):
+        limiter = RateLimiter(max_concurrency=8)
+        limiter.release(limiter.acquire(), status="rate_limited", retry_after=0.2)
+        self.assertEqual(limiter.concurrency, 4)
+
+        start = time.monotonic()
+        lease = limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+        # 成功が続くと少しずつ戻る
+        limiter.release(lease)
+        for _ in range(20):
+            limiter.release(limiter.acquire())
+        self.assertGreater(limiter.concurrency, 6)
+        self.assertLessEqual(limiter.concurrency, 8)
+        self.assertEqual(limiter.snapshot()["rate_limited"], 1)
+
+    def test_unused_tokens_are_returned(self):
+        limiter = RateLimiter(tokens_per_minute=1000)
+        lease = limiter.acquire(800)
+        limiter.release(lease, used_tokens=100)
+        start = time.monotonic()
+        limiter.release(limiter.acquire(850))
+        self.assertLess(time.monotonic() - start, 0.1)
+
+
+class TestBroker(unittest.TestCase):
+    def test_containers_share_one_limiter(self):
+        limiter = RateLimiter(max_concurrency=1)
+        server = start_broker(("127.0.0.1", 0), limiter)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            first, second = BrokerClient(url), BrokerClient(url)
+            lease = first.acquire(10)
+            self.assertEqual(limiter.snapshot()["in_flight"], 1)
+
+            acquired = threading.Event()
+            thread = threading.Thread(
+                target=lambda: (second.release(second.acquire(10)), acquired.set())
+            )
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+            first.release(lease, used_tokens=5)
+            self.assertTrue(acquired.wait(2))
+            thread.join()
+            self.assertEqual(limiter.snapshot()["granted"], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_broker_rejects_requests_without_the_token(self):
+        limiter = RateLimiter(max_concurrency=1)
+        server = start_broker(("127.0.0.1", 0), limiter, token="secret")
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            # トークンがないか違うクライアントは枠を取れず、制限せずに続ける
+            self.assertIsNone(BrokerClient(url).acquire(10))
+            self.assertIsNone(BrokerClient(url, token="wrong").acquire(10))
+            response = requests.get(f"{url}/stats", timeout=5)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(limiter.snapshot()["in_flight"], 0)
+
+            client = BrokerClient(url, token="secret")
+            client.release(client.acquire(10))
+            self.assertEqual(limiter.snapshot()["granted"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_unreachable_broker_does_not_block(self):
+        client = BrokerClient("http://127.0.0.1:9", timeout=0.5)
+        self.assertIsNone(client.acquire(10))
+        client.release(None)
+
+
+class TestRetry(unittest.TestCase):
+    def test_retry_after_headers(self):
+        self.assertEqual(retry_after_seconds({"retry-after-ms": "1500"}), 1.5)
+        self.assertEqual(retry_after_seconds({"retry-after": "3"}), 3.0)
+        self.assertIsNone(retry_after_seconds({}))
+        self.assertIsNone(retry_after_seconds(None))
+
+    def test_backoff_honors_retry_after(self):
+        for attempt in range(5):
+            self.assertGreaterEqual(backoff_delay(attempt, retry_after=2.0), 2.0)
+            self.assertLessEqual(backoff_delay(attempt, cap=4.0), 4.0)
+
+    def test_create_retries_rate_limited_calls(self):
+        limiter = RateLimiter(max_concurrency=4)
+        calls = []
+
+        def create():
+            calls.append(1)
+            if len(calls) < 3:
+                raise status_error(openai.RateLimitError, 429, {"retry-after-ms": "1"})
+            return "response"
+
+        with patch("container.time.sleep") as sleep:
+            result, lease, stats = create_with_retries(create, limiter, 100)
+        limiter.release(lease)
+
+        self.assertEqual(result, "response")
+        self.assertEqual(stats["attempts"], 3)
+        self.assertEqual(stats["rate_limited"], 2)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(limiter.snapshot()["rate_limited"], 2)
+        self.assertEqual(limiter.snapshot()["in_flight"], 0)
+
+    def test_create_does_not_retry_client_errors(self):
+        error = status_error(openai.BadRequestError, 400)
+
+        def create():
+            raise error
+
+        with (
+            patch("container.time.sleep") as sleep,
+            self.assertRaises(openai.BadRequestError),
+        ):
+            create_with_retries(create, None, 100)
+        sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
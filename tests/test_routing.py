@@ -0,0 +1,92 @@
+import unittest
+
+from container import (
+    OPENAI_MODEL,
+    OPENAI_SMALL_MODEL,
+    RoutingPolicy,
+    last_tool_outputs,
+    tool_failed,
+)
+
+
+def turn(*outputs: str) -> list:
+    messages = [
+        {"role": "user", "content": "fix the bug"},
+        {"role": "assistant", "content": None, "tool_calls": []},
+    ]
+    return messages + [{"role": "tool", "content": output} for output in outputs]
+
+
+class TestToolFailed(unittest.TestCase):
+    def test_detects_failures(self):
+        self.assertTrue(tool_failed("FAILED (failures=1)\n[exit code 1, 0.52s]"))
+        self.assertTrue(tool_failed("[timed out, 600.00s, output truncated]"))
+        self.assertTrue(tool_failed("Error patching file:\nno such file"))
+        self.assertTrue(tool_failed("Error creating PR: 422 - branch not found"))
+        self.assertTrue(
+            tool_failed(
+                "Pull request not created because the full test suite failed. ..."
+            )
+        )
+        self.assertTrue(
+            tool_failed("a.py: hunk 1 FAILED\npatch not applied: no files were changed")
+        )
+        self.assertTrue(
+            tool_failed("[exit code 2, 0.10s; output unchanged since step 3]")
+        )
+
+    def test_ignores_successes(self):
+        self.assertFalse(tool_failed("OK\n[exit code 0, 1.02s]"))
+        self.assertFalse(
+            tool_failed("[exit code 0, 0.10s; output unchanged since step 3]")
+        )
+        self.assertFalse(tool_failed("def main():\n    raise Error('[exit code 1')"))
+
+    def test_last_tool_outputs(self):
+        self.assertEqual(last_tool_outputs(turn("a", "b")), ["a", "b"])
+        self.assertEqual(last_tool_outputs(turn()[:-1]), [])
+
+
+class TestRoutingPolicy(unittest.TestCase):
+    def test_plans_with_the_large_model(self):
+        route = RoutingPolicy().choose(1, turn())
+        self.assertEqual((route.tier, route.model), ("large", OPENAI_MODEL))
+        self.assertEqual(route.reason, "planning")
+
+    def test_routine_steps_use_the_small_model(self):
+        route = RoutingPolicy().choose(3, turn("OK\n[exit code 0, 0.1s]"))
+        self.assertEqual((route.tier, route.model), ("small", OPENAI_SMALL_MODEL))
+
+    def test_failures_are_analyzed_by_the_large_model(self):
+        route = RoutingPolicy().choose(3, turn("ok", "FAILED\n[exit code 1, 0.1s]"))
+        self.assertEqual((route.tier, route.reason), ("large", "failure"))
+
+        policy = RoutingPolicy(escalate_on_failure=False)
+        route = policy.choose(3, turn("FAILED\n[exit code 1, 0.1s]"))
+        self.assertEqual(route.tier, "small")
+
+    def test_patches_from_the_small_model_are_escalated(self):
+        policy = RoutingPolicy()
+        small = policy.choose(3, turn())
+        escalated = policy.escalation(small, ["read_file", "apply_patch"])
+        self.assertEqual((escalated.tier, escalated.reason), ("large", "escalated"))
+        self.assertIsNone(policy.escalation(small, ["read_file"]))
+        self.assertIsNone(policy.escalation(escalated, ["apply_patch"]))
+
+    def test_configured_from_json(self):
+        policy = RoutingPolicy.from_json(
+            '{"small_model": "small", "planning_steps": 2, "escalate_tools": ["x"]}'
+        )
+        self.assertEqual(policy.choose(2, turn()).tier, "large")
+        self.assertEqual(policy.choose(3, turn()).model, "small")
+        self.assertEqual(policy.escalate_tools, ("x",))
+
+        single = RoutingPolicy.from_json('{"small_model": null}')
+        self.assertEqual(single.choose(5, turn()).reason, "single")
+        self.assertEqual(RoutingPolicy.from_json(None), RoutingPolicy())
+        with self.assertRaises(ValueError):
+            RoutingPolicy.from_json('{"small": "x"}')
+
+
+if __name__ == "__main__":
+    unittest.main()
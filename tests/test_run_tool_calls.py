@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from container import is_read_only_command, run_tool_calls
+
+
+def tool_call(call_id: str, name: str, **arguments):
+    return SimpleNamespace(
+        id=call_id,
+        function=SimpleNamespace(name=name, arguments=json.dumps(arguments)),
+    )
+
+
+class TestIsReadOnlyCommand(unittest.TestCase):
+    def test_read_only_commands(self):
+        for command in [
+            "ls -la",
+            "cat README.md | head -n 20",
+            "git status",
+            "git -C repo log --oneline",
+            "grep -rn foo src && wc -l src/main.py",
+            "find . -name '*.py'",
+            "git diff --stat HEAD~1",
+            "rg -n --glob '*.py' foo",
+        ]:
+            with self.subTest(command=command):
+                self.assertTrue(is_read_only_command(command))
+
+    def test_mutating_commands(self):
+        for command in [
+            "git commit -m 'x'",
+            "git checkout -b fix",
+            "echo hi > file.txt",
+            "ls; rm -rf build",
+            "find . -name '*.pyc' -delete",
+            "python setup.py",
+            "cat $(rm foo)",
+            "cat <(touch /tmp/x)",
+            "diff <(ls) <(rm -rf build)",
+            "ls | tee >(wc -l)",
+            "find . -fprintf out %p",
+            "find -fprint0 out",
+            "git diff --output=x.patch",
+            "git log --output=o",
+            "git -C repo diff -o x.patch",
+            "git grep -O foo",
+            "git -c core.fsmonitor=./x status",
+            "rg --pre ./x foo",
+            "rg --pre=./x foo",
+            "tree -o tree.txt",
+        ]:
+            with self.subTest(command=command):
+                self.assertFalse(is_read_only_command(command))
+
+
+class TestRunToolCalls(unittest.TestCase):
+    def test_read_only_calls_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fake_run_tool(name, arguments):
+            # 3つが同時に実行されていなければBarrierがタイムアウトする
+            barrier.wait()
+            return arguments["command"]
+
+        calls = [
+            tool_call("a", "execute_command", command="ls"),
+            tool_call("b", "execute_command", command="git status"),
+            tool_call("c", "execute_command", command="cat README.md"),
+        ]
+        with patch("container.run_tool", side_effect=fake_run_tool):
+            contents, timing = run_tool_calls(calls)
+
+        self.assertEqual(contents, ["ls", "git status", "cat README.md"])
+        self.assertEqual(
+            [tool["name"] for tool in timing["tools"]], ["execute_command"] * 3
+        )
+
+    def test_mutating_calls_keep_order(self):
+        events = []
+
+        def fake_run_tool(name, arguments):
+            label = arguments.get("command") or arguments.get("file_path")
+            events.append(("start", label))
+            time.sleep(0.01)
+            events.append(("end", label))
+            return label
+
+        calls = [
+            tool_call("a", "execute_command", command="ls"),
+            tool_call("b", "patch_file", file_path="x.py", patch=""),
+            tool_call("c", "execute_command", command="cat x.py"),
+            tool_call("d", "execute_command", command="git commit -m x"),
+        ]
+        with patch("container.run_tool", side_effect=fake_run_tool):
+            contents, _ = run_tool_calls(calls)
+
+        self.assertEqual(contents, ["ls", "x.py", "cat x.py", "git commit -m x"])
+        # 変更を伴う呼び出しは、前の呼び出しが終わってから始まる
+        self.assertLess(events.index(("end", "ls")), events.index(("start", "x.py")))
+        self.assertLess(
+            events.index(("end", "x.py")), events.index(("start", "cat x.py"))
+        )
+        self.assertLess(
+            events.index(("end", "cat x.py")),
+            events.index(("start", "git commit -m x")),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
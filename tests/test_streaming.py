@@ -0,0 +1,156 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import openai
+
+from cassette import start_replay_server, stream_chunks
+from container import ToolCallRunner, busy_seconds, consume_stream
+
+
+def completion(tool_calls: list[tuple[str, str, dict]], content=None) -> dict:
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = [
+            {
+                "id": call_id,
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments)},
+            }
+            for call_id, name, arguments in tool_calls
+        ]
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4o-2024-11-20",
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_calls else "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def parsed_chunks(response: dict):
+    return [
+        openai.types.chat.ChatCompletionChunk.model_validate(chunk)
+        for chunk in stream_chunks(response)
+    ]
+
+
+class TestConsumeStream(unittest.TestCase):
+    def test_dispatches_tool_calls_before_the_stream_ends(self):
+        response = completion(
+            [
+                ("call_a", "read_file", {"file_path": "a.py"}),
+                ("call_b", "search_code", {"root": ".", "query": "x"}),
+            ]
+        )
+        chunks = parsed_chunks(response)
+        consumed = []
+        dispatched = []
+
+        def stream():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+
+        def on_tool_call(call_id, name, arguments):
+            dispatched.append((call_id, name, json.loads(arguments), len(consumed)))
+
+        assembled, timing = consume_stream(stream(), on_tool_call=on_tool_call)
+
+        self.assertEqual(
+            [call[:2] for call in dispatched],
+            [("call_a", "read_file"), ("call_b", "search_code")],
+        )
+        self.assertEqual(dispatched[0][2], {"file_path": "a.py"})
+        # 引数が揃った時点で、残りのチャンクを待たずに渡される
+        self.assertLess(dispatched[0][3], len(chunks))
+        self.assertLess(dispatched[1][3], len(chunks))
+
+        message = assembled.choices[0].message
+        self.assertEqual(
+            [call.function.name for call in message.tool_calls],
+            ["read_file", "search_code"],
+        )
+        self.assertEqual(assembled.choices[0].finish_reason, "tool_calls")
+        self.assertEqual(assembled.usage.prompt_tokens, 10)
+        self.assertIn("ttfb_seconds", timing)
+
+    def test_content_only(self):
+        texts = []
+        assembled, _ = consume_stream(
+            parsed_chunks(completion([], content="完了しました")),
+            on_content=texts.append,
+        )
+        self.assertEqual("".join(texts), "完了しました")
+        self.assertEqual(assembled.choices[0].message.content, "完了しました")
+        self.assertIsNone(assembled.choices[0].message.tool_calls)
+        self.assertEqual(assembled.choices[0].finish_reason, "stop")
+
+
+class TestToolCallRunner(unittest.TestCase):
+    def test_mutating_call_waits_for_earlier_calls(self):
+        events = []
+
+        def fake_run_tool(name, arguments):
+            events.append(("start", arguments["label"]))
+            events.append(("end", arguments["label"]))
+            return arguments["label"]
+
+        with patch("container.run_tool", side_effect=fake_run_tool):
+            runner = ToolCallRunner()
+            runner.submit("read_file", {"label": "a", "file_path": "x"})
+            runner.submit("patch_file", {"label": "b"})
+            runner.submit("read_file", {"label": "c", "file_path": "x"})
+            contents, timing = runner.finish(stream_end=0.0)
+
+        self.assertEqual(contents, ["a", "b", "c"])
+        self.assertLess(events.index(("end", "a")), events.index(("start", "b")))
+        self.assertLess(events.index(("end", "b")), events.index(("start", "c")))
+        self.assertEqual(timing["overlap_seconds"], 0.0)
+
+    def test_busy_seconds(self):
+        intervals = [(0.0, 1.0), (0.5, 2.0), (3.0, 4.0)]
+        self.assertEqual(busy_seconds(intervals), 3.0)
+        self.assertEqual(busy_seconds(intervals, until=1.5), 1.5)
+        self.assertEqual(busy_seconds([]), 0.0)
+
+
+class TestReplayStreaming(unittest.TestCase):
+    def test_openai_client_reads_replayed_stream(self):
+        response = completion([("call_a", "read_file", {"file_path": "a.py"})])
+        server = start_replay_server(
+            ("127.0.0.1", 0), [{"key": "", "response": response}]
+        )
+        try:
+            client = openai.Client(
+                api_key="dummy",
+                base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                max_retries=0,
+            )
+            assembled, _ = consume_stream(
+                client.chat.completions.create(
+                    model="gpt-4o-2024-11-20",
+                    messages=[{"role": "user", "content": "x"}],
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        call = assembled.choices[0].message.tool_calls[0]
+        self.assertEqual(call.id, "call_a")
+        self.assertEqual(json.loads(call.function.arguments), {"file_path": "a.py"})
+        self.assertEqual(assembled.usage.completion_tokens, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from tracing import Tracer, estimate_cost, load_events, summarize, usage_fields
+
+
+def completion(prompt_tokens: int, completion_tokens: int, cached_tokens: int):
+    return SimpleNamespace(
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+        ),
+        choices=[SimpleNamespace(finish_reason="tool_calls")],
+    )
+
+
+def tool_call(name: str):
+    return SimpleNamespace(function=SimpleNamespace(name=name))
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_writes_one_event_per_call(self):
+        tracer = Tracer(self.log_dir, run_id="run-1")
+        tracer.llm_call(1, "gpt-4o-2024-11-20", 1.5, completion(1000, 200, 400))
+        tracer.tool_calls(
+            1,
+            [tool_call("read_file"), tool_call("execute_command")],
+            ["abc", "あ"],
+            {
+                "wall_seconds": 0.3,
+                "sequential_seconds": 0.4,
+                "tools": [
+                    {"name": "read_file", "seconds": 0.1},
+                    {"name": "execute_command", "seconds": 0.3},
+                ],
+            },
+            failed=[False, True],
+        )
+
+        lines = (self.log_dir / "run-1.jsonl").read_text().splitlines()
+        events = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [event["type"] for event in events],
+            ["llm_call", "tool_call", "tool_call", "tool_turn"],
+        )
+        self.assertEqual(events[0]["prompt_tokens"], 1000)
+        self.assertEqual(events[0]["cached_tokens"], 400)
+        self.assertEqual(events[0]["latency_seconds"], 1.5)
+        self.assertEqual(events[2]["name"], "execute_command")
+        self.assertEqual(events[2]["output_bytes"], 3)
+        self.assertEqual([events[1]["ok"], events[2]["ok"]], [True, False])
+
+    def test_disabled_without_log_dir(self):
+        tracer = Tracer(None)
+        tracer.event("run_start")
+        self.assertIsNone(tracer.path)
+
+    def test_usage_without_details(self):
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+        self.assertEqual(
+            usage_fields(usage),
+            {"prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0},
+        )
+        self.assertEqual(usage_fields(None)["prompt_tokens"], 0)
+
+    def test_estimate_cost(self):
+        # キャッシュされた入力は半額
+        self.assertAlmostEqual(
+            estimate_cost("gpt-4o-2024-11-20", 1_000_000, 0, 1_000_000), 1.25
+        )
+        self.assertAlmostEqual(estimate_cost("gpt-4o-2024-11-20", 0, 1_000_000), 10.0)
+        self.assertIsNone(estimate_cost("unknown-model", 1, 1))
+
+
+class TestSummarize(unittest.TestCase):
+    def test_aggregates_across_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_dir = Path(tmp)
+            for index, latency in enumerate([1.0, 2.0, 3.0]):
+                tracer = Tracer(log_dir, run_id=f"run-{index}")
+                tracer.event("run_start")
+                tracer.llm_call(1, "gpt-4o-2024-11-20", latency, completion(100, 10, 0))
+            # 途中で止まった実行の壊れた行は無視される
+            with (log_dir / "run-0.jsonl").open("a") as f:
+                f.write('{"type": "llm_')
+            summary = summarize(load_events(log_dir))
+
+        self.assertEqual(summary["runs"], 3)
+        self.assertEqual(summary["llm_latency_seconds"]["count"], 3)
+        self.assertEqual(summary["llm_latency_seconds"]["p50"], 2.0)
+        self.assertEqual(summary["llm_latency_seconds"]["p95"], 3.0)
+        self.assertEqual(summary["tokens"]["prompt_tokens"], 300)
+        self.assertGreater(summary["cost_usd"]["total"], 0)
+
+    def test_tool_durations_by_name(self):
+        events = [
+            {
+                "type": "tool_call",
+                "run_id": "a",
+                "ts": 0.0,
+                "name": "read_file",
+                "duration_seconds": 0.1,
+            },
+            {
+                "type": "tool_call",
+                "run_id": "a",
+                "ts": 1.0,
+                "name": "execute_command",
+                "duration_seconds": 5.0,
+            },
+        ]
+        summary = summarize(events)
+        self.assertEqual(
+            list(summary["tool_seconds"]), ["execute_command", "read_file"]
+        )
+        self.assertEqual(summary["run_seconds"]["p50"], 1.0)
+
+    def test_tiers(self):
+        def llm_call(step, tier, model, latency, **fields):
+            return {
+                "type": "llm_call",
+                "run_id": "a",
+                "ts": float(step),
+                "step": step,
+                "tier": tier,
+                "model": model,
+                "latency_seconds": latency,
+                "prompt_tokens": 100,
+                "completion_tokens": 10,
+                **fields,
+            }
+
+        events = [
+            llm_call(1, "large", "big", 3.0),
+            llm_call(2, "small", "mini", 0.5),
+            # 小さいモデルがパッチを書こうとしたので、大きいモデルで呼び直した
+            llm_call(3, "small", "mini", 0.6, escalated=True),
+            llm_call(3, "large", "big", 2.0),
+            llm_call(4, "small", "mini", 0.4),
+            {
+                "type": "tool_turn",
+                "run_id": "a",
+                "ts": 4.0,
+                "step": 4,
+                "failed_tools": 1,
+            },
+        ]
+        tiers = summarize(events)["tiers"]
+
+        self.assertEqual(list(tiers), ["large", "small"])
+        self.assertEqual(tiers["large"]["models"], ["big"])
+        self.assertEqual(tiers["large"]["success_rate"], 1.0)
+        self.assertEqual(tiers["small"]["latency_seconds"]["count"], 3)
+        self.assertEqual(tiers["small"]["tokens"]["prompt_tokens"], 300)
+        self.assertEqual(tiers["small"]["escalated"], 1)
+        self.assertAlmostEqual(tiers["small"]["success_rate"], 0.333)
+
+    def test_prompt_cache(self):
+        events = [
+            {"type": "run_start", "run_id": "a", "ts": 0.0, "prompt_prefix": "p1"},
+            {"type": "run_start", "run_id": "b", "ts": 0.0, "prompt_prefix": "p1"},
+        ]
+        for run_id, latency, cached_tokens in [
+            ("a", 2.0, 0),
+            ("a", 1.0, 1024),
+            ("b", 1.2, 1024),
+            ("b", 0.8, 2048),
+        ]:
+            events.append(
+                {
+                    "type": "llm_call",
+                    "run_id": run_id,
+                    "ts": 1.0,
+                    "step": 1,
+                    "model": "gpt-4o-2024-08-06",
+                    "latency_seconds": latency,
+                    "ttfb_seconds": latency / 2,
+                    "prompt_tokens": 2048,
+                    "completion_tokens": 10,
+                    "cached_tokens": cached_tokens,
+                }
+            )
+        cache = summarize(events)["prompt_cache"]
+
+        self.assertEqual(cache["hit_rate"], 0.5)
+        self.assertEqual(cache["calls_with_hits"], 3)
+        self.assertEqual(cache["calls"], 4)
+        self.assertEqual(cache["prefixes"], 1)
+        self.assertEqual(cache["latency_seconds"]["miss"]["p50"], 2.0)
+        self.assertEqual(cache["latency_seconds"]["hit"]["p50"], 1.0)
+        self.assertEqual(cache["ttfb_seconds"]["hit"]["count"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,375 @@
+import argparse
+import json
+import math
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# モデルごとの料金（USD / 100万トークン）。入力・キャッシュされた入力・出力の順
+MODEL_PRICES = {
+    "gpt-4o-2024-11-20": (2.50, 1.25, 10.00),
+    "gpt-4o-mini-2024-07-18": (0.15, 0.075, 0.60),
+}
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """
+    最近傍法でパーセンタイルを求める
+    params:
+        values: 値のリスト
+        q: 0〜100のパーセンタイル
+    returns:
+        パーセンタイル値。valuesが空ならNone
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[max(0, rank - 1)]
+
+
+def usage_fields(usage) -> dict:
+    """
+    ChatCompletionのusageからトークン数を取り出す
+    params:
+        usage: response.usage。Noneでもよい
+    returns:
+        prompt_tokens・completion_tokens・cached_tokensの辞書
+    """
+    if usage is None:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0)
+        if details is not None
+        else 0,
+    }
+
+
+def estimate_cost(
+    model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0
+) -> float | None:
+    """
+    トークン数から料金を見積もる
+    returns:
+        USDでの料金。料金表にないモデルならNone
+    """
+    if model not in MODEL_PRICES:
+        return None
+    input_price, cached_price, output_price = MODEL_PRICES[model]
+    cost = (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    )
+    return round(cost / 1_000_000, 6)
+
+
+def new_run_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class Tracer:
+    """
+    1回の実行のイベントをJSONLで書き出す。
+    ディレクトリが指定されていなければ何もしない
+    """
+
+    def __init__(self, log_dir: Path | None, run_id: str | None = None):
+        self.run_id = run_id or new_run_id()
+        self.path = None
+        self._lock = threading.Lock()
+        if log_dir is not None:
+            log_dir.mkdir(parents=True, exist_ok=True)
+            self.path = log_dir / f"{self.run_id}.jsonl"
+
+    def event(self, event_type: str, **fields):
+        if self.path is None:
+            return
+        record = {"type": event_type, "run_id": self.run_id, "ts": time.time()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False)
+        # tool callは並列に実行されるので、行が混ざらないように書き込みを直列化する
+        with self._lock, self.path.open("a") as f:
+            f.write(line + "\n")
+
+    def llm_call(self, step: int, model: str, latency: float, response, **fields):
+        """
+        モデル呼び出し1回分のイベントを書き出す
+        params:
+            step: ループの何回目の呼び出しか
+            model: モデル名
+            latency: 呼び出しにかかった時間（秒）
+            response: ChatCompletion
+        """
+        usage = usage_fields(response.usage)
+        self.event(
+            "llm_call",
+            step=step,
+            model=model,
+            latency_seconds=round(latency, 3),
+            **usage,
+            cost_usd=estimate_cost(model, **usage),
+            finish_reason=response.choices[0].finish_reason,
+            **fields,
+        )
+
+    def tool_calls(
+        self,
+        step: int,
+        tool_calls,
+        contents: list[str],
+        timing: dict,
+        failed: list[bool] | None = None,
+        **fields,
+    ):
+        """
+        1ターン分のtool callのイベントを書き出す
+        params:
+            step: ループの何回目の呼び出しか
+            tool_calls: アシスタントのメッセージのtool_calls
+            contents: run_tool_callsの実行結果
+            timing: run_tool_callsの時間の内訳
+            failed: tool callごとに、実行が失敗したか
+            fields: ターンのイベントに加える項目
+        """
+        if failed is None:
+            failed = [False] * len(contents)
+        for tool, content, tool_timing, tool_failed in zip(
+            tool_calls, contents, timing["tools"], failed
+        ):
+            self.event(
+                "tool_call",
+                step=step,
+                name=tool.function.name,
+                duration_seconds=tool_timing["seconds"],
+                output_bytes=len(content.encode()),
+                ok=not tool_failed,
+            )
+        self.event(
+            "tool_turn",
+            step=step,
+            wall_seconds=timing["wall_seconds"],
+            sequential_seconds=timing["sequential_seconds"],
+            overlap_seconds=timing.get("overlap_seconds", 0.0),
+            **fields,
+        )
+
+
+def load_events(log_dir: Path) -> list[dict]:
+    events = []
+    for path in sorted(log_dir.glob("*.jsonl")):
+        for line in path.read_text().splitlines():
+            if not line.strip():
+                continue
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 書き込み途中で止まった実行の最後の行は読み飛ばす
+                continue
+    return events
+
+
+def _distribution(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "total": round(sum(values), 3),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+    }
+
+
+def _summarize_tiers(events: list[dict]) -> dict:
+    """
+    モデルの階層ごとに、レイテンシ・トークン数・料金と成功率を集計する。
+    応答が捨てられず、続くツールの実行に失敗がなかった呼び出しを成功とみなす
+    """
+    failed_turns = {
+        (event["run_id"], event["step"])
+        for event in events
+        if event["type"] == "tool_turn" and event.get("failed_tools")
+    }
+    tiers: dict[str, dict] = {}
+    for event in events:
+        if event["type"] != "llm_call":
+            continue
+        tier = tiers.setdefault(
+            event.get("tier", "untiered"),
+            {
+                "models": set(),
+                "latencies": [],
+                "tokens": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cached_tokens": 0,
+                },
+                "cost": 0.0,
+                "escalated": 0,
+                "succeeded": 0,
+            },
+        )
+        tier["models"].add(event["model"])
+        tier["latencies"].append(event["latency_seconds"])
+        for key in tier["tokens"]:
+            tier["tokens"][key] += event.get(key, 0)
+        tier["cost"] += event.get("cost_usd") or 0.0
+        if event.get("escalated"):
+            tier["escalated"] += 1
+        elif (event["run_id"], event["step"]) not in failed_turns:
+            tier["succeeded"] += 1
+    return {
+        name: {
+            "models": sorted(tier["models"]),
+            "latency_seconds": _distribution(tier["latencies"]),
+            "tokens": tier["tokens"],
+            "cost_usd": round(tier["cost"], 6),
+            "escalated": tier["escalated"],
+            "success_rate": round(tier["succeeded"] / len(tier["latencies"]), 3),
+        }
+        for name, tier in sorted(tiers.items())
+    }
+
+
+def _summarize_prompt_cache(events: list[dict]) -> dict:
+    """
+    プロンプトキャッシュのヒット率と、ヒットした呼び出しとしなかった呼び出しのレイテンシを集計する
+    """
+    calls = [event for event in events if event["type"] == "llm_call"]
+    prompt_tokens = sum(event.get("prompt_tokens", 0) for event in calls)
+    cached_tokens = sum(event.get("cached_tokens", 0) for event in calls)
+    hits = [event for event in calls if event.get("cached_tokens")]
+    misses = [event for event in calls if not event.get("cached_tokens")]
+    return {
+        "hit_rate": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+        "calls_with_hits": len(hits),
+        "calls": len(calls),
+        # 実行ごとのプロンプトの先頭の種類。1でなければ先頭が実行ごとに変わっている
+        "prefixes": len(
+            {
+                event["prompt_prefix"]
+                for event in events
+                if event["type"] == "run_start" and "prompt_prefix" in event
+            }
+        ),
+        "latency_seconds": {
+            "hit": _distribution([event["latency_seconds"] for event in hits]),
+            "miss": _distribution([event["latency_seconds"] for event in misses]),
+        },
+        "ttfb_seconds": {
+            "hit": _distribution(
+                [event["ttfb_seconds"] for event in hits if "ttfb_seconds" in event]
+            ),
+            "miss": _distribution(
+                [event["ttfb_seconds"] for event in misses if "ttfb_seconds" in event]
+            ),
+        },
+    }
+
+
+def summarize(events: list[dict]) -> dict:
+    """
+    複数の実行のイベントを集計する
+    params:
+        events: load_eventsで読み込んだイベント
+    returns:
+        実行・モデル呼び出し・tool callごとのp50/p95と、トークン数・料金の合計、
+        プロンプトキャッシュのヒット率、モデルの階層ごとの集計
+    """
+    runs: dict[str, dict] = {}
+    llm_latencies = []
+    ttfbs = []
+    overlaps = []
+    tool_durations: dict[str, list[float]] = {}
+    tokens = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+    for event in events:
+        run = runs.setdefault(
+            event["run_id"], {"start": event["ts"], "end": event["ts"], "cost": 0.0}
+        )
+        run["start"] = min(run["start"], event["ts"])
+        run["end"] = max(run["end"], event["ts"])
+        match event["type"]:
+            case "llm_call":
+                llm_latencies.append(event["latency_seconds"])
+                if "ttfb_seconds" in event:
+                    ttfbs.append(event["ttfb_seconds"])
+                for key in tokens:
+                    tokens[key] += event.get(key, 0)
+                run["cost"] += event.get("cost_usd") or 0.0
+            case "tool_turn":
+                overlaps.append(event.get("overlap_seconds", 0.0))
+            case "tool_call":
+                tool_durations.setdefault(event["name"], []).append(
+                    event["duration_seconds"]
+                )
+
+    run_seconds = [round(run["end"] - run["start"], 3) for run in runs.values()]
+    run_costs = [run["cost"] for run in runs.values()]
+    return {
+        "runs": len(runs),
+        "run_seconds": _distribution(run_seconds),
+        "llm_latency_seconds": _distribution(llm_latencies),
+        "llm_ttfb_seconds": _distribution(ttfbs),
+        # tool callの実行がモデルの生成と重なって、待たずに済んだ時間
+        "tool_overlap_seconds": _distribution(overlaps),
+        "tool_seconds": {
+            name: _distribution(durations)
+            for name, durations in sorted(
+                tool_durations.items(), key=lambda item: -sum(item[1])
+            )
+        },
+        "tokens": tokens,
+        "prompt_cache": _summarize_prompt_cache(events),
+        "tiers": _summarize_tiers(events),
+        "cost_usd": {
+            "total": round(sum(run_costs), 6),
+            "p50": percentile(run_costs, 50),
+            "p95": percentile(run_costs, 95),
+        },
+    }
+
+
+def pull_request_times(
+    events: list[dict], starts: dict[int, tuple[str, float]]
+) -> dict[int, float]:
+    """
+    ジョブを始めてから最初にPRを作れるまでの時間を求める。作成に失敗した呼び出しは数えない
+    params:
+        events: load_eventsで読み込んだイベント
+        starts: ジョブのidごとの、issue_strと開始時刻（UNIX時間）
+    returns:
+        PRを作ったジョブの、idごとの秒数
+    """
+    # 実行とジョブはrun_startに記録したissue_strで対応づける。
+    # 同じissue_strのジョブが複数あれば、先に始まったジョブから順に割り当てる
+    pending = sorted(starts.items(), key=lambda item: item[1][1])
+    run_jobs: dict[str, int] = {}
+    for event in sorted(events, key=lambda event: event["ts"]):
+        if event["type"] not in ("run_start", "run_resume"):
+            continue
+        for index, (job_id, (issue_str, started)) in enumerate(pending):
+            if issue_str == event.get("issue_str") and started <= event["ts"]:
+                run_jobs[event["run_id"]] = job_id
+                del pending[index]
+                break
+
+    times: dict[int, float] = {}
+    for event in sorted(events, key=lambda event: event["ts"]):
+        if event["type"] != "tool_call" or event["name"] != "create_pull_request":
+            continue
+        if not event.get("ok"):
+            continue
+        job_id = run_jobs.get(event["run_id"])
+        if job_id is not None and job_id not in times:
+            times[job_id] = round(event["ts"] - starts[job_id][1], 3)
+    return times
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Summarize run traces")
+    argparser.add_argument("log_dir", nargs="?", default="logs")
+    args = argparser.parse_args()
+    print(json.dumps(summarize(load_events(Path(args.log_dir))), indent=2))